@@ -0,0 +1,441 @@
+import os
+import sys
+import glob
+import argparse
+import datetime
+import numpy as np
+import pydicom
+import pydicom.uid
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.sr.codedict import codes
+from PIL import Image
+'''
+Save annotations of a converted slide (i.e. cell detections of a model) as a Microscopy Bulk Simple Annotations
+instance, and read them back.
+Annotations are given as NumPy arrays: points (n, 2), boxes (n, 4) as x0, y0, x1, y1, or polylines/polygons as all
+their points (N, 2) with the index of the first point of each one. Coordinates are in pixels of the slide level 0
+(its total pixel matrix), (0, 0) being the top left corner of the top left pixel.
+Annotations are grouped by label, each label is an annotation group holding the coordinates of all its annotations as
+one packed float array (PointCoordinatesData) and, for polylines, the index of each annotation in it
+(LongPrimitivePointIndexList), instead of one dataset per graphic object: millions of annotations are written and read
+as a few arrays.
+The instance is in the Study of the slide, in its own series, and references the level 0 instances of the slide.
+Save it outside the slide directory: the reader and incremental conversions expect only the slide instances there.
+Usage:
+    annotations = bulk_annotations("/path/to/converted/slide", ContentLabel="CELLS", algorithm=("detector", "1.0"))
+    annotations.add_points(centroids, labels=cell_types)
+    annotations.add_boxes(boxes, labels="tumor region")
+    annotations.save("/path/to/cells.dcm")
+    groups = read_annotations("/path/to/cells.dcm")
+or, to check them over a level of the slide:
+    python WSI_DICOM_Annotation.py /path/to/cells.dcm --slide /path/to/converted/slide --level 2 --output cells.png
+'''
+
+BULK_ANNOTATIONS_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.91.1"
+WSI_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.77.1.6"
+FIXED_POINTS = {"POINT": 1, "RECTANGLE": 4, "ELLIPSE": 4}   # points of each annotation, for graphic types of fixed size
+CLOSED_GRAPHIC_TYPES = ("POLYGON", "RECTANGLE", "ELLIPSE")
+# elements of the slide copied into the annotation instance
+SLIDE_ELEMENTS = ("SpecificCharacterSet", "PatientName", "PatientID", "PatientBirthDate", "PatientSex", "StudyInstanceUID",
+                  "StudyDate", "StudyTime", "ReferringPhysicianName", "StudyID", "AccessionNumber", "Manufacturer",
+                  "ManufacturerModelName", "DeviceSerialNumber", "SoftwareVersions")
+COLORS = [(230, 25, 75), (60, 180, 75), (0, 130, 200), (245, 130, 48), (145, 30, 180), (70, 240, 240),
+          (240, 50, 230), (210, 245, 60), (0, 128, 128), (170, 110, 40)]
+
+
+# Dicom code item from a pydicom Code, or a (CodeValue, CodingSchemeDesignator, CodeMeaning) tuple
+def code_item(code):
+    if hasattr(code, "scheme_designator"):
+        value, scheme, meaning = code.value, code.scheme_designator, code.meaning
+    else:
+        value, scheme, meaning = code
+    item = Dataset()
+    item.CodeValue = value
+    item.CodingSchemeDesignator = scheme
+    item.CodeMeaning = meaning
+    return item
+
+
+def slide_references(dicom_dir):
+    '''
+    elements of a converted slide needed to reference it
+    :param dicom_dir: directory of the Dicom instances of the slide
+    :return: dict with the elements of SLIDE_ELEMENTS found in the slide, SeriesInstanceUID and instances
+    [(SOPClassUID, SOPInstanceUID), ...] of level 0, and the number of series of the slide
+    '''
+    headers = []
+    for fn in sorted(glob.glob(os.path.join(dicom_dir, "*.dcm"))):
+        ds = pydicom.dcmread(fn, stop_before_pixels=True, specific_tags=list(SLIDE_ELEMENTS) + [
+            "SOPClassUID", "SOPInstanceUID", "SeriesInstanceUID", "TotalPixelMatrixColumns", "TotalPixelMatrixRows"])
+        if ds.get("SOPClassUID") == WSI_SOP_CLASS_UID and "TotalPixelMatrixColumns" in ds:
+            headers.append(ds)
+    if not headers:
+        raise Exception("No whole slide image instance found in %s" % dicom_dir)
+    columns = max(ds.TotalPixelMatrixColumns for ds in headers)
+    level0 = [ds for ds in headers if ds.TotalPixelMatrixColumns == columns]
+    references = {keyword: level0[0].get(keyword) for keyword in SLIDE_ELEMENTS if keyword in level0[0]}
+    references["SeriesInstanceUID"] = level0[0].SeriesInstanceUID
+    references["instances"] = [(ds.SOPClassUID, ds.SOPInstanceUID) for ds in level0]
+    references["TotalPixelMatrix"] = (columns, level0[0].TotalPixelMatrixRows)
+    references["series_count"] = len(set(ds.SeriesInstanceUID for ds in headers))
+    return references
+
+
+class annotation_group:
+    def __init__(self, label, graphic_type, coordinates, offsets=None, uid=None, description=None,
+                 property_category=codes.SCT.AnatomicalStructure, property_type=codes.SCT.Cell, algorithm=None):
+        '''
+        annotations of one label and graphic type
+        :param label: AnnotationGroupLabel
+        :param graphic_type: 'POINT', 'RECTANGLE', 'ELLIPSE', 'POLYLINE' or 'POLYGON'
+        :param coordinates: (N, 2) array, points of all the annotations
+        :param offsets: (n, ) array, index of the first point of each annotation in coordinates,
+        None for graphic types with a fixed number of points
+        :param uid: AnnotationGroupUID, generated if None
+        :param description: AnnotationGroupDescription
+        :param property_category: code of AnnotationPropertyCategoryCodeSequence, a pydicom Code or a
+        (CodeValue, CodingSchemeDesignator, CodeMeaning) tuple
+        :param property_type: code of AnnotationPropertyTypeCodeSequence
+        :param algorithm: (AlgorithmName, AlgorithmVersion) of the model which made the annotations, None if manual
+        '''
+        if graphic_type not in FIXED_POINTS and graphic_type not in ("POLYLINE", "POLYGON"):
+            raise Exception("Unknown graphic type %s" % graphic_type)
+        self.label = str(label)
+        self.graphic_type = graphic_type
+        self.coordinates = coordinates
+        if offsets is None:
+            if graphic_type not in FIXED_POINTS:
+                raise Exception("%s annotations need the offset of each annotation" % graphic_type)
+            offsets = np.arange(0, len(coordinates), FIXED_POINTS[graphic_type], dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.uid = uid if uid is not None else pydicom.uid.generate_uid()
+        self.description = description
+        self.property_category = property_category
+        self.property_type = property_type
+        self.algorithm = algorithm
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # (k, 2) points of an annotation
+    def annotation(self, idx):
+        end = self.offsets[idx + 1] if idx + 1 < len(self.offsets) else len(self.coordinates)
+        return self.coordinates[self.offsets[idx]:end]
+
+    # Dicom item of AnnotationGroupSequence
+    def dataset(self, number, double_precision=False):
+        item = Dataset()
+        item.AnnotationGroupNumber = number
+        item.AnnotationGroupUID = self.uid
+        item.AnnotationGroupLabel = self.label
+        if self.description is not None:
+            item.AnnotationGroupDescription = self.description
+        if self.algorithm is not None:
+            item.AnnotationGroupGenerationType = "AUTOMATIC"
+            algorithm = Dataset()
+            algorithm.AlgorithmFamilyCodeSequence = Sequence([code_item(codes.DCM.ArtificialIntelligence)])
+            algorithm.AlgorithmName, algorithm.AlgorithmVersion = self.algorithm
+            item.AnnotationGroupAlgorithmIdentificationSequence = Sequence([algorithm])
+        else:
+            item.AnnotationGroupGenerationType = "MANUAL"
+        item.AnnotationPropertyCategoryCodeSequence = Sequence([code_item(self.property_category)])
+        item.AnnotationPropertyTypeCodeSequence = Sequence([code_item(self.property_type)])
+        item.GraphicType = self.graphic_type
+        item.NumberOfAnnotations = len(self)
+        item.AnnotationAppliesToAllOpticalPaths = "YES"
+        if double_precision:
+            item.DoublePointCoordinatesData = np.ascontiguousarray(self.coordinates, dtype="<f8").tobytes()
+        else:
+            item.PointCoordinatesData = np.ascontiguousarray(self.coordinates, dtype="<f4").tobytes()
+        if self.graphic_type not in FIXED_POINTS:
+            # 1-based index of the first value (x of the first point) of each annotation
+            item.LongPrimitivePointIndexList = (self.offsets * 2 + 1).astype("<u4").tobytes()
+        return item
+
+
+# indices of the annotations of each label: [(label, indices), ...], in the order of the labels
+def split_labels(labels, count):
+    if labels is None or np.ndim(labels) == 0:
+        return [(labels, np.arange(count))]
+    labels = np.asarray(labels)
+    if len(labels) != count:
+        raise Exception("Got %d labels for %d annotations" % (len(labels), count))
+    if labels.dtype.kind in "iu" and count and int(labels.max()) - int(labels.min()) < 2 ** 16:
+        # small integer labels (i.e. classes of a model), counted without sorting
+        shifted = (labels - labels.min()).astype(np.int64)
+        present = np.flatnonzero(np.bincount(shifted))
+        values = present + labels.min()
+        lookup = np.zeros(int(shifted.max()) + 1, dtype=np.uint16)
+        lookup[present] = np.arange(len(present))
+        inverse = lookup[shifted]
+    else:
+        values, inverse = np.unique(labels, return_inverse=True)
+        if len(values) < 2 ** 16:
+            inverse = inverse.astype(np.uint16)   # stable sort of 16 bits integers is a radix sort
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=len(values)))))
+    return [(value, order[start:end]) for value, start, end in zip(values.tolist(), bounds[:-1], bounds[1:])]
+
+
+class bulk_annotations:
+    def __init__(self, dicom_dir, ContentLabel="ANNOTATIONS", ContentDescription=None, algorithm=None,
+                 SeriesInstanceUID=None, SOPInstanceUID=None, double_precision=False):
+        '''
+        :param dicom_dir: directory of the converted slide the annotations are made on
+        :param ContentLabel: label of the annotation instance, upper case letters, digits and underscores
+        :param ContentDescription: description of the annotation instance
+        :param algorithm: default (AlgorithmName, AlgorithmVersion) of the groups, None for manual annotations
+        :param SeriesInstanceUID: series of the annotations, derived from the slide if None, so the annotations of a
+        slide are in one series
+        :param SOPInstanceUID: generated if None
+        :param double_precision: save coordinates as float64 (DoublePointCoordinatesData) instead of float32
+        '''
+        self.references = slide_references(dicom_dir)
+        self.ContentLabel = ContentLabel
+        self.ContentDescription = ContentDescription
+        self.algorithm = algorithm
+        self.SeriesInstanceUID = SeriesInstanceUID or pydicom.uid.generate_uid(
+            entropy_srcs=[self.references["SeriesInstanceUID"], "annotations"])
+        self.SOPInstanceUID = SOPInstanceUID or pydicom.uid.generate_uid()
+        self.double_precision = double_precision
+        self.groups = []
+
+    def add_group(self, group):
+        self.groups.append(group)
+        return group
+
+    def _add(self, graphic_type, coordinates, offsets, labels, label, count, **options):
+        options.setdefault("algorithm", self.algorithm)
+        groups = []
+        lengths = np.diff(np.append(offsets, len(coordinates)))
+        for value, indices in split_labels(labels, count):
+            if len(indices) == count:
+                group_coordinates, group_offsets = coordinates, offsets
+            else:
+                # points of the selected annotations, in order
+                group_lengths = lengths[indices]
+                group_offsets = np.concatenate(([0], np.cumsum(group_lengths)[:-1]))
+                points = np.repeat(offsets[indices] - group_offsets, group_lengths) + np.arange(group_lengths.sum())
+                group_coordinates = coordinates[points]
+            groups.append(self.add_group(annotation_group(label if value is None else value, graphic_type,
+                                                          group_coordinates, group_offsets, **options)))
+        return groups
+
+    def add_points(self, points, labels=None, label="points", **options):
+        '''
+        :param points: (n, 2) array of x, y
+        :param labels: (n, ) array of the label of each point, or one label for all of them.
+        Each label is saved as an annotation group
+        :param label: group label if labels is None
+        :param options: other arguments of annotation_group, i.e. property_type, description
+        :return: the annotation groups
+        '''
+        points = np.asarray(points)
+        if points.ndim != 2 or points.shape[1] != 2:
+            raise Exception("Points should be a (n, 2) array, got shape %s" % (points.shape, ))
+        return self._add("POINT", points, np.arange(len(points), dtype=np.int64), labels, label, len(points), **options)
+
+    def add_boxes(self, boxes, labels=None, label="boxes", **options):
+        '''
+        :param boxes: (n, 4) array of x0, y0, x1, y1, saved as RECTANGLE annotations
+        see add_points for the other parameters
+        '''
+        boxes = np.asarray(boxes)
+        if boxes.ndim != 2 or boxes.shape[1] != 4:
+            raise Exception("Boxes should be a (n, 4) array, got shape %s" % (boxes.shape, ))
+        x0, y0, x1, y1 = boxes.T
+        corners = np.stack([x0, y0, x1, y0, x1, y1, x0, y1], axis=1).reshape(-1, 2)
+        return self._add("RECTANGLE", corners, np.arange(0, len(corners), 4, dtype=np.int64), labels, label, len(boxes), **options)
+
+    def add_polylines(self, polylines, offsets=None, labels=None, label="polylines", closed=False, **options):
+        '''
+        :param polylines: list of (k, 2) arrays, or (N, 2) array of the points of all the polylines with offsets
+        :param offsets: (n, ) array, index of the first point of each polyline in polylines
+        :param closed: save as POLYGON annotations, the last point is implicitly joined to the first one
+        see add_points for the other parameters
+        '''
+        if offsets is None:
+            lengths = [len(polyline) for polyline in polylines]
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+            polylines = np.concatenate([np.asarray(polyline).reshape(-1, 2) for polyline in polylines]) if lengths else np.zeros((0, 2))
+        polylines = np.asarray(polylines)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        return self._add("POLYGON" if closed else "POLYLINE", polylines, offsets, labels, label, len(offsets), **options)
+
+    def dataset(self):
+        references = self.references
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = BULK_ANNOTATIONS_SOP_CLASS_UID
+        file_meta.MediaStorageSOPInstanceUID = self.SOPInstanceUID
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        file_meta.ImplementationClassUID = "1.2.3.4"
+        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        for keyword in SLIDE_ELEMENTS:
+            if keyword in references:
+                setattr(ds, keyword, references[keyword])
+        for keyword in ("PatientName", "PatientID", "PatientBirthDate", "PatientSex", "StudyDate", "StudyTime",
+                        "ReferringPhysicianName", "StudyID", "AccessionNumber"):
+            if keyword not in ds:
+                setattr(ds, keyword, "")   # type 2 elements
+        ds.SOPClassUID = BULK_ANNOTATIONS_SOP_CLASS_UID
+        ds.SOPInstanceUID = self.SOPInstanceUID
+        ds.Modality = "ANN"
+        ds.SeriesInstanceUID = self.SeriesInstanceUID
+        ds.SeriesNumber = references["series_count"]   # after the series of the slide levels
+        ds.InstanceNumber = 1
+        now = datetime.datetime.now()
+        ds.SeriesDate = ds.ContentDate = now.strftime("%Y%m%d")
+        ds.SeriesTime = ds.ContentTime = now.strftime("%H%M%S.%f")
+        ds.ContentLabel = self.ContentLabel
+        ds.ContentDescription = self.ContentDescription or ""
+        ds.ContentCreatorName = ""
+        ds.AnnotationCoordinateType = "2D"
+        ds.PixelOriginInterpretation = "VOLUME"   # coordinates in the total pixel matrix
+        images = []
+        for SOPClassUID, SOPInstanceUID in references["instances"]:
+            item = Dataset()
+            item.ReferencedSOPClassUID = SOPClassUID
+            item.ReferencedSOPInstanceUID = SOPInstanceUID
+            images.append(item)
+        ds.ReferencedImageSequence = Sequence(images)
+        series = Dataset()
+        series.SeriesInstanceUID = references["SeriesInstanceUID"]
+        series.ReferencedInstanceSequence = Sequence([Dataset(item) for item in images])
+        ds.ReferencedSeriesSequence = Sequence([series])
+        ds.AnnotationGroupSequence = Sequence([group.dataset(number, self.double_precision)
+                                               for number, group in enumerate(self.groups, start=1)])
+        return ds
+
+    def save(self, filename):
+        self.dataset().save_as(filename, enforce_file_format=True)
+
+
+def read_annotations(filename):
+    '''
+    :param filename: Microscopy Bulk Simple Annotations instance
+    :return: list of annotation_group, coordinates being read-only views of the bulk data
+    '''
+    ds = pydicom.dcmread(filename)
+    if ds.SOPClassUID != BULK_ANNOTATIONS_SOP_CLASS_UID:
+        raise Exception("%s is not a Microscopy Bulk Simple Annotations instance" % filename)
+    dims = 3 if ds.AnnotationCoordinateType == "3D" else 2
+    groups = []
+    for item in ds.AnnotationGroupSequence:
+        if "DoublePointCoordinatesData" in item:
+            coordinates = np.frombuffer(item.DoublePointCoordinatesData, dtype="<f8").reshape(-1, dims)
+        else:
+            coordinates = np.frombuffer(item.PointCoordinatesData, dtype="<f4").reshape(-1, dims)
+        offsets = None
+        if "LongPrimitivePointIndexList" in item:
+            offsets = (np.frombuffer(item.LongPrimitivePointIndexList, dtype="<u4").astype(np.int64) - 1) // dims
+        algorithm = None
+        if "AnnotationGroupAlgorithmIdentificationSequence" in item:
+            algorithm_item = item.AnnotationGroupAlgorithmIdentificationSequence[0]
+            algorithm = (algorithm_item.get("AlgorithmName"), algorithm_item.get("AlgorithmVersion"))
+        category = item.AnnotationPropertyCategoryCodeSequence[0]
+        property_type = item.AnnotationPropertyTypeCodeSequence[0]
+        group = annotation_group(item.AnnotationGroupLabel, item.GraphicType, coordinates, offsets,
+                                 uid=item.AnnotationGroupUID, description=item.get("AnnotationGroupDescription"),
+                                 property_category=(category.CodeValue, category.CodingSchemeDesignator, category.CodeMeaning),
+                                 property_type=(property_type.CodeValue, property_type.CodingSchemeDesignator, property_type.CodeMeaning),
+                                 algorithm=algorithm)
+        if len(group) != item.NumberOfAnnotations:
+            raise Exception("Annotation group %s has %d annotations, NumberOfAnnotations is %d"
+                            % (group.label, len(group), item.NumberOfAnnotations))
+        groups.append(group)
+    return groups
+
+
+# line segments (n, 4) of x0, y0, x1, y1 between the points of each annotation of a group
+def group_segments(group):
+    coordinates = np.asarray(group.coordinates[:, :2], dtype=np.float64)
+    offsets = group.offsets
+    if group.graphic_type == "ELLIPSE":
+        # endpoints of the major then the minor axis, drawn as a 32 sides polygon
+        axes = coordinates.reshape(-1, 4, 2)
+        center = axes.mean(axis=1)
+        major, minor = (axes[:, 1] - axes[:, 0]) / 2, (axes[:, 3] - axes[:, 2]) / 2
+        angles = np.linspace(0, 2 * np.pi, 32, endpoint=False)
+        coordinates = (center[:, None] + major[:, None] * np.cos(angles)[None, :, None] +
+                       minor[:, None] * np.sin(angles)[None, :, None]).reshape(-1, 2)
+        offsets = np.arange(0, len(coordinates), 32)
+    ends = np.append(offsets[1:], len(coordinates)) - 1
+    follows = np.ones(max(len(coordinates) - 1, 0), dtype=bool)
+    follows[ends[:-1]] = False   # no segment from the last point of an annotation to the first of the next one
+    starts = np.flatnonzero(follows)
+    segments = np.concatenate([coordinates[starts], coordinates[starts + 1]], axis=1)
+    if group.graphic_type in CLOSED_GRAPHIC_TYPES:
+        segments = np.concatenate([segments, np.concatenate([coordinates[ends], coordinates[offsets]], axis=1)])
+    return segments
+
+
+def render_annotations(groups, size, downsample=1.0, image=None, colors=None, point_radius=1):
+    '''
+    draw annotation groups, to check them
+    :param groups: list of annotation_group, see read_annotations
+    :param size: (width, height) of the rendered image
+    :param downsample: level 0 pixels per rendered pixel
+    :param image: (height, width, 3) uint8 array to draw on (i.e. a level of the slide), white if None
+    :param colors: RGB color of each group, COLORS by default
+    :param point_radius: points are drawn as squares of 2 * point_radius + 1 pixels
+    :return: (height, width, 3) uint8 array
+    '''
+    width, height = size
+    canvas = np.full((height, width, 3), 255, dtype=np.uint8) if image is None else np.array(image[:, :, :3], dtype=np.uint8)
+    colors = colors or COLORS
+    for idx, group in enumerate(groups):
+        color = np.array(colors[idx % len(colors)], dtype=np.uint8)
+        if group.graphic_type == "POINT":
+            x = np.floor(group.coordinates[:, 0] / downsample).astype(np.int64)
+            y = np.floor(group.coordinates[:, 1] / downsample).astype(np.int64)
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            x, y = x[inside], y[inside]
+            for dy in range(-point_radius, point_radius + 1):
+                for dx in range(-point_radius, point_radius + 1):
+                    pixels = np.clip(y + dy, 0, height - 1) * width + np.clip(x + dx, 0, width - 1)
+                    canvas.reshape(-1, 3)[pixels] = color
+            continue
+        segments = group_segments(group) / downsample
+        # sample each segment every rendered pixel
+        samples = np.ceil(np.abs(segments[:, 2:] - segments[:, :2]).max(axis=1)).astype(np.int64) + 1
+        first = np.repeat(np.cumsum(samples) - samples, samples)
+        t = (np.arange(samples.sum()) - first) / np.repeat(np.maximum(samples - 1, 1), samples)
+        segment_idx = np.repeat(np.arange(len(segments)), samples)
+        x = np.floor(segments[segment_idx, 0] + t * (segments[segment_idx, 2] - segments[segment_idx, 0])).astype(np.int64)
+        y = np.floor(segments[segment_idx, 1] + t * (segments[segment_idx, 3] - segments[segment_idx, 1])).astype(np.int64)
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        canvas.reshape(-1, 3)[y[inside] * width + x[inside]] = color
+    return canvas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a Microscopy Bulk Simple Annotations instance, to check it")
+    parser.add_argument("annotations", help="annotation instance")
+    parser.add_argument("--output", required=True, help="PNG file to save")
+    parser.add_argument("--slide", default=None, help="directory of the converted slide, to draw on one of its levels")
+    parser.add_argument("--level", type=int, default=None, help="level of the slide to draw on, the smallest one by default")
+    parser.add_argument("--downsample", type=float, default=16, help="level 0 pixels per rendered pixel, without --slide")
+    args = parser.parse_args(argv)
+    groups = read_annotations(args.annotations)
+    for group in groups:
+        print("%s: %d %s annotations, %d points" % (group.label, len(group), group.graphic_type, len(group.coordinates)))
+    image = None
+    if args.slide is not None:
+        from WSI_DICOM_Reader import WSIDICOM_Reader
+        with WSIDICOM_Reader(args.slide) as reader:
+            level = args.level if args.level is not None else len(reader.level_dimensions) - 1
+            size = reader.level_dimensions[level]
+            downsample = reader.level_downsamples[level]
+            image = np.asarray(reader.read_region((0, 0), level, size))
+    else:
+        coordinates = [group.coordinates[:, :2] for group in groups if len(group.coordinates)]
+        corner = np.concatenate(coordinates).max(axis=0) if coordinates else np.zeros(2)
+        downsample = args.downsample
+        size = tuple(int(v) for v in np.ceil(corner / downsample) + 1)
+    Image.fromarray(render_annotations(groups, size, downsample, image)).save(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
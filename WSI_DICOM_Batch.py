@@ -0,0 +1,330 @@
+import os
+import sys
+import ast
+import copy
+import json
+import time
+import pickle
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import openslide
+from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+from WSI_DICOM_Upload import make_uploader
+'''
+Convert many slides with one shared process pool.
+Slides are scheduled largest first (by estimated number of tiles), each slide is split into tasks of one instance,
+so the instances of a huge slide are spread over all the workers while smaller slides fill in the gaps.
+Each slide gets its own output directory and its own UIDs (derived from the slide path), a failing slide is
+reported and skipped, the rest of the batch goes on, even if a worker process dies.
+The frame plan of each slide is made once by the coordinator and sent to the workers with its tasks.
+Usage:
+    python WSI_DICOM_Batch.py /path/to/slides_or_manifest.txt /path/to/output --workers 8 --report report.json
+Add --upload http://host:port/dicom-web to upload each instance with STOW-RS as soon as it is written, see WSI_DICOM_Upload.py
+'''
+
+SLIDE_EXTENSIONS = (".svs", ".tif", ".tiff", ".ndpi", ".vms", ".vmu", ".scn", ".mrxs", ".svslide", ".bif")
+
+
+def find_slides(path):
+    '''
+    list the slides of a batch
+    :param path: directory (searched recursively for slide files), or a manifest text file with one slide per line,
+        as "slide path" or "slide path,output name". Empty lines and lines starting with # are ignored,
+        relative paths are relative to the manifest
+    :return: [(slide path, output name), ...]
+    '''
+    slides = []
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(files):
+                if fn.lower().endswith(SLIDE_EXTENSIONS):
+                    slides.append((os.path.join(root, fn), os.path.splitext(fn)[0]))
+        return slides
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = [f.strip() for f in line.split(",")]
+            wsi_fn = os.path.join(os.path.dirname(os.path.abspath(path)), fields[0])
+            name = fields[1] if len(fields) > 1 and fields[1] else os.path.splitext(os.path.basename(wsi_fn))[0]
+            slides.append((wsi_fn, name))
+    return slides
+
+
+# estimated number of tiles to convert, only used for scheduling (tissue detection may skip some of them)
+def estimate_tiles(wsi_fn, p):
+    wsi_obj = openslide.open_slide(wsi_fn)
+    try:
+        level_dimensions = wsi_obj.level_dimensions
+        levels = range(len(level_dimensions)) if p.image_levels is None else p.image_levels
+        return sum(-(-level_dimensions[lv][0] // p.patch_size[0]) * -(-level_dimensions[lv][1] // p.patch_size[1])
+                   for lv in levels if lv < len(level_dimensions))
+    finally:
+        wsi_obj.close()
+
+
+# parameters of one slide of the batch: frames are encoded by the batch workers, UIDs are unique to the slide
+def slide_parameters(p, wsi_fn):
+    slide_p = copy.copy(p)
+    slide_p.workers = 1
+    slide_p.UID_seed = os.path.abspath(wsi_fn) if p.UID_seed is None else "%s/%s" % (p.UID_seed, os.path.abspath(wsi_fn))
+    return slide_p
+
+
+# converters of the last few slides a worker process worked on, so a slide isn't opened and planned for each instance
+_worker_converters = OrderedDict()
+_WORKER_CONVERTER_CACHE = 4
+
+
+# frame_plan: pickled frame plan of the slide made by the coordinator, so the workers don't plan it again (with tissue
+# detection), None to plan it in the worker. It's pickled once, and only unpickled by the workers which open the slide
+def _batch_convert(wsi_fn, save_to_dir, p, instance_indices, frame_plan=None):
+    start = time.time()
+    key = (wsi_fn, save_to_dir)
+    converter = _worker_converters.pop(key, None)
+    if converter is None:
+        converter = WSIDICOM_Converter(wsi_fn, save_to_dir, p, None if frame_plan is None else pickle.loads(frame_plan))
+    _worker_converters[key] = converter
+    while len(_worker_converters) > _WORKER_CONVERTER_CACHE:
+        _worker_converters.popitem(last=False)
+    written = []
+    converter.sinks = [written.append]
+    if instance_indices is None:
+        converter.convert()
+        frames = sum(len(info.locations) for info in converter.frame_items_info_list)
+    else:
+        converter.convert_instances(instance_indices)
+        frames = sum(len(converter.frame_items_info_list[idx].locations) for idx in instance_indices)
+    return frames, time.time() - start, written
+
+
+class slide_job:
+    def __init__(self, wsi_fn, save_to_dir, p):
+        self.wsi_fn = wsi_fn
+        self.save_to_dir = save_to_dir
+        self.p = p
+        self.estimated_tiles = 0
+        self.pending_tasks = 0
+        self.frames = 0
+        self.seconds = 0.0   # time spent by the workers on this slide
+        self.first_start = None
+        self.last_end = None
+        self.error = None
+        self.converter = None   # converter of the coordinator, holding the frame plan until the slide is done
+        self.frame_plan = None   # pickled frame plan, sent with each task of the slide
+
+    def report(self):
+        size = 0
+        if os.path.isdir(self.save_to_dir):
+            size = sum(os.path.getsize(os.path.join(self.save_to_dir, fn))
+                       for fn in os.listdir(self.save_to_dir) if fn.endswith(".dcm"))
+        wall = (self.last_end - self.first_start) if self.first_start is not None and self.last_end is not None else 0.0
+        return {
+            "slide": self.wsi_fn,
+            "output": self.save_to_dir,
+            "status": "failed" if self.error is not None else "done",
+            "error": self.error,
+            "estimated_tiles": self.estimated_tiles,
+            "frames": self.frames,
+            "bytes": size,
+            "worker_seconds": round(self.seconds, 3),
+            "wall_seconds": round(wall, 3),
+            "frames_per_second": round(self.frames / self.seconds, 2) if self.seconds > 0 else 0.0,
+        }
+
+
+def batch_convert(slides, save_to_root, p=None, workers=None, report_fn=None, sink=None):
+    '''
+    convert a batch of slides with one shared pool of worker processes
+    :param slides: [(slide path, output name), ...] see find_slides, or a list of slide paths
+    :param save_to_root: root output directory, each slide is saved into save_to_root/output name
+    :param p: conversion parameters (see class parameters), shared by all the slides. p.workers is ignored
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param report_fn: save the report of each slide into this json file
+    :param sink: called with the file name of each instance written, as soon as its task is done, i.e. to upload it
+    :return: report of each slide, [dict, ...]
+    '''
+    p = parameters() if p is None else p
+    workers = workers or os.cpu_count() or 1
+    jobs = []
+    names = set()
+    for slide in slides:
+        wsi_fn, name = slide if isinstance(slide, (tuple, list)) else (slide, os.path.splitext(os.path.basename(slide))[0])
+        # output directories are never shared, even if slides have the same name
+        unique_name, cnt = name, 1
+        while unique_name in names:
+            cnt += 1
+            unique_name = "%s_%d" % (name, cnt)
+        names.add(unique_name)
+        job = slide_job(wsi_fn, os.path.join(save_to_root, unique_name), slide_parameters(p, wsi_fn))
+        try:
+            job.estimated_tiles = estimate_tiles(wsi_fn, p)
+        except Exception as e:
+            job.error = "%s: %s" % (type(e).__name__, e)
+        jobs.append(job)
+    # largest slides first, so they don't end up running alone at the end of the batch
+    schedule = sorted((job for job in jobs if job.error is None), key=lambda job: -job.estimated_tiles)
+
+    # tasks are created slide by slide, as the window of tasks in flight empties
+    def iter_tasks():
+        for job in schedule:
+            try:
+                os.makedirs(job.save_to_dir, exist_ok=True)
+                if job.p.GENERATE_PYRAMID:
+                    # all the levels are built in one pass over level 0, the slide is a single task
+                    tasks = [None]
+                else:
+                    converter = WSIDICOM_Converter(job.wsi_fn, job.save_to_dir, job.p)
+                    converter.checkpoint.start(job.p.resume)
+                    sizes = [len(info.locations) for info in converter.frame_items_info_list]
+                    converter.wsi_obj.close()
+                    job.converter = converter
+                    job.frame_plan = pickle.dumps(converter.frame_items_info_list, protocol=pickle.HIGHEST_PROTOCOL)
+                    tasks = [[idx] for idx in sorted(range(len(sizes)), key=lambda idx: -sizes[idx])]
+            except Exception as e:
+                job.error = "%s: %s" % (type(e).__name__, e)
+                print("Failed to plan %s: %s" % (job.wsi_fn, job.error))
+                continue
+            job.pending_tasks = len(tasks)
+            for instance_indices in tasks:
+                yield job, instance_indices
+
+    # account for a task of a slide, done, failed or skipped after an earlier failure. After the last one, the spatial
+    # index of the slide is written
+    def task_done(job, error=None):
+        job.pending_tasks -= 1
+        job.last_end = time.time()
+        if error is not None and job.error is None:
+            job.error = "%s: %s" % (type(error).__name__, error)
+            print("Failed to convert %s: %s" % (job.wsi_fn, job.error))
+        if job.pending_tasks > 0:
+            return
+        if job.error is None and job.converter is not None and job.p.SPATIAL_INDEX:
+            # instances were written by the workers, their frame byte ranges are in the checkpoint
+            try:
+                job.converter.checkpoint.load()
+                job.converter.write_spatial_index()
+            except Exception as e:
+                job.error = "%s: %s" % (type(e).__name__, e)
+                print("Failed to index %s: %s" % (job.wsi_fn, job.error))
+        job.converter = None
+        job.frame_plan = None
+        if job.error is None:
+            print("Converted %s: %d frames in %.1f s" % (job.wsi_fn, job.frames, job.last_end - job.first_start))
+
+    # a worker process died (i.e. killed for using too much memory): every task in flight fails with BrokenProcessPool,
+    # their slides are reported as failed, and the batch goes on with a new pool
+    pool = ProcessPoolExecutor(max_workers=workers)
+    in_flight = {}   # future -> (slide job, pool running the task)
+    tasks = iter_tasks()
+    try:
+        while True:
+            for job, instance_indices in tasks:
+                if job.error is not None:
+                    task_done(job)   # the slide already failed, skip its remaining instances
+                    continue
+                if job.first_start is None:
+                    job.first_start = time.time()
+                try:
+                    future = pool.submit(_batch_convert, job.wsi_fn, job.save_to_dir, job.p, instance_indices, job.frame_plan)
+                except BrokenProcessPool as e:
+                    task_done(job, e)
+                    pool.shutdown(wait=False)
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                    continue
+                in_flight[future] = (job, pool)
+                if len(in_flight) >= workers * 2:
+                    break
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, task_pool = in_flight.pop(future)
+                try:
+                    frames, seconds, written = future.result()
+                    job.frames += frames
+                    job.seconds += seconds
+                    if sink is not None:
+                        for filename in written:
+                            sink(filename)
+                except BrokenProcessPool as e:
+                    task_done(job, e)
+                    if task_pool is pool:
+                        pool.shutdown(wait=False)
+                        pool = ProcessPoolExecutor(max_workers=workers)
+                except Exception as e:
+                    task_done(job, e)
+                else:
+                    task_done(job)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    reports = [job.report() for job in jobs]
+    for r in reports:
+        print("%-6s %8d frames %10.1f MB %8.2f frames/s  %s%s" % (
+            r["status"], r["frames"], r["bytes"] / 1e6, r["frames_per_second"], r["slide"],
+            "  (%s)" % r["error"] if r["error"] else ""))
+    if report_fn is not None:
+        with open(report_fn, "w") as fp:
+            json.dump(reports, fp, indent=2)
+    return reports
+
+
+# conversion options of the command line, shared with WSI_DICOM_Shard.py
+def add_parameter_arguments(parser):
+    parser.add_argument("--max-frame", type=int, default=500, help="maximum number of frames per instance")
+    parser.add_argument("--patch-size", type=int, nargs=2, default=(512, 512), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--levels", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="image levels to save, FIRST to LAST included (default: all)")
+    parser.add_argument("--quality", type=int, default=75, help="JPEG quality")
+    parser.add_argument("--uncompressed", action="store_true", help="save frames without compression")
+    parser.add_argument("--codec", default=None, help="codec of the frames, see frame_codecs.py (default: jpeg_baseline)")
+    parser.add_argument("--tissue-detection", action="store_true", help="skip patches on empty glass")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="any other argument of class parameters, i.e. --param GENERATE_PYRAMID=True")
+
+
+# class parameters from the options added by add_parameter_arguments
+def parameters_from_args(args):
+    kwargs = dict(max_frame=args.max_frame, patch_size=tuple(args.patch_size), Quality=args.quality,
+                  JPEG_COMPRESS=not args.uncompressed, TISSUE_DETECTION=args.tissue_detection, codec=args.codec)
+    if args.levels is not None:
+        kwargs["image_levels"] = range(args.levels[0], args.levels[1] + 1)
+    for param in args.param:
+        key, _, value = param.partition("=")
+        try:
+            kwargs[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            kwargs[key.strip()] = value.strip()
+    return parameters(**kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a batch of whole slide images into DICOM")
+    parser.add_argument("input", help="directory of slides, or manifest file (one slide path per line, optionally followed by ,output name)")
+    parser.add_argument("output", help="root output directory, each slide is saved into a sub directory")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    add_parameter_arguments(parser)
+    parser.add_argument("--report", default=None, help="save the per slide report into this json file")
+    parser.add_argument("--upload", default=None, metavar="URL",
+                        help="upload instances while converting, to a DICOMweb service root (STOW-RS) or dicom://AE_TITLE@host:port (C-STORE)")
+    args = parser.parse_args(argv)
+
+    p = parameters_from_args(args)
+    if args.upload is None:
+        reports = batch_convert(find_slides(args.input), args.output, p, args.workers, args.report)
+        return 1 if any(r["status"] != "done" for r in reports) else 0
+    with make_uploader(args.upload) as uploader:
+        reports = batch_convert(find_slides(args.input), args.output, p, args.workers, args.report,
+                                sink=uploader.submit)
+    upload_report = uploader.report()
+    print("%d instances uploaded, %d failed" % (upload_report["instances"] - upload_report["failed"], upload_report["failed"]))
+    return 1 if any(r["status"] != "done" for r in reports) or upload_report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,35 @@
 import openslide
 import os
 import logging
+import glob
+import contextlib
+import struct
+import threading
+import time
 from io import BytesIO
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from PIL import Image
 from pydicom.dataset import Dataset, FileDataset, DataElement
 from pydicom.sequence import Sequence
 from pydicom.tag import Tag
 import pydicom.uid
-from pydicom.encaps import encapsulate
-import matplotlib.pyplot as plt
+from tissue_detection import detect_tissue, tissue_grid
+from pyramid import pyramid_builder, pyramid_dimensions, downsample_2x
+from frame_sequence import encode_frame_sequence, PerFrameFunctionalGroupsSequence_TAG
+from checkpoint import conversion_checkpoint, frame_plan_hash
+from frame_codecs import get_codec
+from dicom_header import load_template, dataset_from_template, header_encoder
+from metrics import add_time, conversion_metrics, jsonl_observer, prometheus_observer
+from spatial_index import SPATIAL_INDEX_FILENAME, empty_grid, write_spatial_index, spatial_index
+from roi import level_regions, region_grid
+from region_reader import region_reader
+from scheduler import pipeline_memory, schedule_pipeline, pipeline_stage, parse_size, format_size
+try:
+    import tifffile   # optional, only needed for JPEG tile passthrough
+except ImportError:
+    tifffile = None
 
 
 def range_subset(range1, range2):
@@ -21,37 +43,562 @@ def range_subset(range1, range2):
     return range1.start in range2 and range1[-1] in range2
 
 
+# encode one RGB frame into the bytes to be saved in Dicom PixelData, with a codec of frame_codecs.py
+def encode_frame(img, codec, Quality):
+    return get_codec(codec).encode(img, Quality)
+
+
+# Adobe APP14 segment with transform 0, tells JPEG decoders that the components are RGB rather than YCbCr
+ADOBE_RGB_SEGMENT = b"\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00"
+
+
+# encode one frame as a baseline JPEG of RGB components, like the tiles of RGB passthrough levels, so the frames that
+# can't be passed through (i.e. missing or non baseline tiles) match the PhotometricInterpretation of the instance
+def encode_rgb_jpeg(img, Quality):
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=Quality, icc_profile=img.info.get('icc_profile'), progressive=False, keep_rgb=True, subsampling=0)
+    return buffer.getvalue()
+
+
+# whether Pillow saves RGB JPEG (keep_rgb, Pillow 10.3 and later), older versions silently convert to YCbCr
+def _saves_rgb_jpeg():
+    return ADOBE_RGB_SEGMENT in encode_rgb_jpeg(Image.new("RGB", (8, 8)), 75)
+
+
+RGB_JPEG = _saves_rgb_jpeg()
+
+
+# whether a JPEG stream is baseline (SOF0) with 8 bits precision, as required by transfer syntax 1.2.840.10008.1.2.4.50
+def is_baseline_jpeg(data):
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xC0:
+            return data[pos + 4] == 8
+        if 0xC1 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return False   # other SOF markers: extended, progressive, lossless or arithmetic coding
+        if marker == 0xDA:
+            return False   # reached start of scan without a frame header
+        pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    return False
+
+
+class jpeg_tile_source:
+    '''
+    Access the compressed JPEG tiles of a tiled TIFF (i.e. Aperio SVS), so they can be copied into Dicom frames
+    without decoding and re-encoding.
+    '''
+    def __init__(self, wsi_fn, wsi_obj):
+        if tifffile is None:
+            raise Exception("JPEG tile passthrough requires tifffile, install it with: pip install tifffile")
+        self.wsi_obj = wsi_obj
+        self.fp = open(wsi_fn, "rb")
+        self.lock = threading.Lock()  # file handle can be shared by worker threads
+        self.levels = {}   # image level -> tiled JPEG page of the same size
+        with tifffile.TiffFile(wsi_fn) as tif:
+            pages = [page for series in tif.series for level in series.levels for page in level.pages]
+            for img_lv, (w, h) in enumerate(wsi_obj.level_dimensions):
+                for page in pages:
+                    if (page.imagewidth, page.imagelength) == (w, h) and page.is_tiled and page.compression == 7 \
+                            and page.photometric in (2, 6) and page.samplesperpixel == 3 \
+                            and page.bitspersample == 8 and page.planarconfig == 1:
+                        self.levels[img_lv] = {
+                            "tile_size": (page.tilewidth, page.tilelength),
+                            "tiles_across": -(-w // page.tilewidth),
+                            "offsets": page.dataoffsets,
+                            "bytecounts": page.databytecounts,
+                            "jpegtables": page.jpegtables,
+                            "RGB": page.photometric == 2,
+                        }
+                        break
+
+    # Dicom PhotometricInterpretation of the passed through frames, None if the level can't be passed through
+    def PhotometricInterpretation(self, img_level, patch_size):
+        level = self.levels.get(img_level)
+        if level is None or tuple(level["tile_size"]) != tuple(patch_size):
+            return None
+        if level["RGB"] and not RGB_JPEG:
+            return None   # the frames that can't be passed through couldn't be encoded as RGB
+        # frames are located every int(patch_size * downsample) pixels on level 0, see generate_instance_info_list
+        ds = self.wsi_obj.level_downsamples[img_level]
+        if int(patch_size[0] * ds) / ds != patch_size[0] or int(patch_size[1] * ds) / ds != patch_size[1]:
+            return None
+        return "RGB" if level["RGB"] else "YBR_FULL_422"
+
+    # whether the frame at location (level 0 coordinates) lines up exactly with a native tile
+    def aligned(self, location, img_level, patch_size):
+        ds = self.wsi_obj.level_downsamples[img_level]
+        return (location[0] / ds) % patch_size[0] == 0 and (location[1] / ds) % patch_size[1] == 0
+
+    # compressed tile at location, None if it can't be passed through
+    def get_tile(self, location, img_level, patch_size):
+        if self.PhotometricInterpretation(img_level, patch_size) is None or not self.aligned(location, img_level, patch_size):
+            return None
+        level = self.levels[img_level]
+        ds = self.wsi_obj.level_downsamples[img_level]
+        tile_idx = int(location[1] / ds) // patch_size[1] * level["tiles_across"] + int(location[0] / ds) // patch_size[0]
+        if level["bytecounts"][tile_idx] == 0:
+            return None
+        with self.lock:
+            self.fp.seek(level["offsets"][tile_idx])
+            data = self.fp.read(level["bytecounts"][tile_idx])
+        if level["jpegtables"]:
+            # abbreviated stream, insert the quantization and Huffman tables after SOI
+            data = data[:2] + level["jpegtables"][2:-2] + data[2:]
+        if level["RGB"] and ADOBE_RGB_SEGMENT[:11] not in data:
+            data = data[:2] + ADOBE_RGB_SEGMENT + data[2:]
+        if not is_baseline_jpeg(data):
+            return None
+        return data
+
+
+class frame_encoder:
+    '''
+    Read and encode frames. Each method returns (results, times): times is a {stage: [seconds, count]} dict
+    (see metrics.py) if timed is set, None otherwise.
+    '''
+    def __init__(self, wsi_obj, codec, Quality, tile_source=None, timed=False, reader=None):
+        self.wsi_obj = wsi_obj   # openslide object, each worker process holds its own
+        self.reader = reader if reader is not None else region_reader(wsi_obj)  # reads frames by bands, see region_reader.py
+        self.codec = codec   # name of the codec, see frame_codecs.py
+        self.Quality = Quality
+        self.tile_source = tile_source  # jpeg_tile_source for JPEG tile passthrough, None to always re-encode
+        self.timed = timed
+        # ICC profile of the slide, frames are read as arrays so it's set on each image, and embedded by the JPEG codec
+        profile = getattr(wsi_obj, "color_profile", None)
+        self.icc_profile = profile.tobytes() if profile is not None else None
+
+    def _encode(self, img, times, rgb_jpeg=False):
+        if self.icc_profile is not None:
+            img.info["icc_profile"] = self.icc_profile
+        if times is None:
+            return encode_rgb_jpeg(img, self.Quality) if rgb_jpeg else encode_frame(img, self.codec, self.Quality)
+        start = time.perf_counter()
+        frame = encode_rgb_jpeg(img, self.Quality) if rgb_jpeg else encode_frame(img, self.codec, self.Quality)
+        add_time(times, "encode", time.perf_counter() - start)
+        return frame
+
+    # read and encode frames at the given locations, return encoded frames in the same order
+    def encode(self, img_level, patch_size, locations):
+        times = {} if self.timed else None
+        encoded_framed_items = [None] * len(locations)
+        to_read = []   # indices of the frames that aren't passed through
+        for idx, f_loc in enumerate(locations):
+            if self.tile_source is not None:
+                start = time.perf_counter()
+                tile = self.tile_source.get_tile(f_loc, img_level, patch_size)
+                if tile is not None:
+                    if times is not None:
+                        add_time(times, "passthrough", time.perf_counter() - start)
+                    encoded_framed_items[idx] = tile
+                    continue
+            to_read.append(idx)
+        # frames of RGB passthrough levels are all RGB, see open_instance
+        rgb_jpeg = self.tile_source is not None and self.tile_source.PhotometricInterpretation(img_level, patch_size) == "RGB"
+        images = self.reader.read(img_level, patch_size, [locations[idx] for idx in to_read], times)
+        for idx, img in zip(to_read, images):
+            encoded_framed_items[idx] = self._encode(Image.fromarray(img), times, rgb_jpeg)
+        return encoded_framed_items, times
+
+    # read frames at the given locations as RGB arrays, factor: read factor times larger regions and downsample them
+    # by 2 until they are patch_size (factor is a power of 2)
+    def read(self, img_level, patch_size, locations, factor=1):
+        times = {} if self.timed else None
+        images = self.reader.read(img_level, (patch_size[0] * factor, patch_size[1] * factor), locations, times)
+        if factor > 1:
+            start = time.perf_counter()
+            for _ in range(factor.bit_length() - 1):
+                images = [downsample_2x(img) for img in images]
+            if times is not None:
+                add_time(times, "downsample", time.perf_counter() - start)
+        return images, times
+
+    # encode RGB arrays into frames
+    def encode_images(self, images):
+        times = {} if self.timed else None
+        return [self._encode(Image.fromarray(img), times) for img in images], times
+
+
+# frame encoder of a worker process, created by _init_worker
+_worker_frame_encoder = None
+
+
+def _init_worker(wsi_fn, codec, Quality, JPEG_PASSTHROUGH, timed=False, read_cache_size=256 * 2 ** 20):
+    global _worker_frame_encoder
+    wsi_obj = openslide.open_slide(wsi_fn)
+    tile_source = jpeg_tile_source(wsi_fn, wsi_obj) if JPEG_PASSTHROUGH else None
+    reader = region_reader(wsi_obj, wsi_fn, read_cache_size)
+    _worker_frame_encoder = frame_encoder(wsi_obj, codec, Quality, tile_source, timed, reader)
+
+
+def _worker_encode(img_level, patch_size, locations):
+    return _worker_frame_encoder.encode(img_level, patch_size, locations)
+
+
+def _worker_read(img_level, patch_size, locations, factor=1):
+    return _worker_frame_encoder.read(img_level, patch_size, locations, factor)
+
+
+def _worker_encode_images(images):
+    return _worker_frame_encoder.encode_images(images)
+
+
+# a finished future, for running tasks without a worker pool
+def done_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+# LossyImageCompressionRatio of an instance is only known once its frames are encoded: the header is written with this
+# placeholder, a DS value of the maximum length, and patched by instance_writer.close
+LOSSY_RATIO_PLACEHOLDER = "1.00000000000000"
+
+
+# 16 bytes DS value of a compression ratio, padded with spaces
+def lossy_ratio_value(ratio):
+    return ("%.6g" % ratio).ljust(len(LOSSY_RATIO_PLACEHOLDER)).encode("ascii")
+
+
+# position of the value of LossyImageCompressionRatio (set to LOSSY_RATIO_PLACEHOLDER) in an encoded header
+def lossy_ratio_pos(header, is_implicit_VR, is_little_endian):
+    endian = "<" if is_little_endian else ">"
+    length = len(LOSSY_RATIO_PLACEHOLDER)
+    if is_implicit_VR:
+        element = struct.pack(endian + "HHI", 0x0028, 0x2112, length)
+    else:
+        element = struct.pack(endian + "HH", 0x0028, 0x2112) + b"DS" + struct.pack(endian + "H", length)
+    pos = header.find(element + LOSSY_RATIO_PLACEHOLDER.encode("ascii"))
+    if pos < 0:
+        raise Exception("LossyImageCompressionRatio not found in the header")
+    return pos + len(element)
+
+
+class instance_writer:
+    '''
+    Stream a multi-frame Dicom instance to disk, one frame at a time.
+    The header (everything but PixelData) is written by pydicom first, then frames are appended as they are encoded.
+    For encapsulated pixel data, space for the Basic Offset Table (or the Extended Offset Table) is reserved and
+    patched with the frame offsets and lengths when the instance is closed.
+    The instance is written into filename + '.partial' and renamed when it is complete, so an interrupted conversion
+    never leaves a partial instance behind under its final name.
+    '''
+    def __init__(self, filename, dcm_instance, NumberOfFrames, encapsulated, frame_length=None, offset_table="BOT",
+                 PerFrameFunctionalGroupsSequence=None, on_close=None, metrics=None, ratio_pos=None):
+        '''
+        :param filename: file name of the Dicom instance
+        :param dcm_instance: Dicom dataset with file_meta, holding all the tags except PixelData, or the header already
+        encoded (preamble, file meta information and every element before PixelData, see dicom_header.py)
+        :param NumberOfFrames: number of frames that will be written
+        :param encapsulated: whether frames are compressed and encapsulated, or native (uncompressed)
+        :param frame_length: byte length of each native frame, the decoded size of encapsulated frames
+        :param offset_table: 'BOT' for Basic Offset Table, 'EOT' for Extended Offset Table (allows instances over 4GB)
+        :param PerFrameFunctionalGroupsSequence: encoded PerFrameFunctionalGroupsSequence (see frame_sequence.py), written
+        after the header. If None, the sequence (if any) is written by pydicom from dcm_instance
+        :param on_close: called with the writer once the instance is complete and renamed to filename
+        :param metrics: conversion_metrics (see metrics.py) timing the header, encapsulate and write stages, or None
+        :param ratio_pos: position in the encoded header of the 16 bytes value of LossyImageCompressionRatio, patched
+        when the instance is closed with the ratio of the decoded size of the frames (frame_length) to their encoded size
+        '''
+        if offset_table not in ("BOT", "EOT"):
+            raise Exception("offset_table should be either 'BOT' or 'EOT'")
+        self.filename = filename
+        self.on_close = on_close
+        self.metrics = metrics
+        self.NumberOfFrames = NumberOfFrames
+        self.encapsulated = encapsulated
+        self.frame_length = frame_length
+        self.offset_table = offset_table
+        self.ratio_pos = ratio_pos
+        self.frame_cnt = 0
+        self.offsets = []   # offset of each frame item, relative to the first byte of the first frame item
+        self.lengths = []   # byte length of each (padded) frame
+        self.frame_offsets = []   # byte offset of each encoded frame in the file, see spatial_index.py
+        self.frame_lengths = []   # byte length of each encoded frame, without padding
+        if isinstance(dcm_instance, bytes):
+            if PerFrameFunctionalGroupsSequence is not None:
+                raise Exception("PerFrameFunctionalGroupsSequence should be part of the encoded header")
+        elif "PixelData" in dcm_instance:
+            del dcm_instance.PixelData
+        if PerFrameFunctionalGroupsSequence is not None:
+            if "PerFrameFunctionalGroupsSequence" in dcm_instance:
+                del dcm_instance.PerFrameFunctionalGroupsSequence
+            if any(tag > PerFrameFunctionalGroupsSequence_TAG for tag in dcm_instance.keys()):
+                raise Exception("Encoded PerFrameFunctionalGroupsSequence should be the last element before PixelData")
+        self.fp = open(filename + ".partial", "wb")
+        start = time.perf_counter()
+        try:
+            if isinstance(dcm_instance, bytes):
+                self.fp.write(dcm_instance)
+            else:
+                dcm_instance.save_as(self.fp, write_like_original=False)
+            if PerFrameFunctionalGroupsSequence is not None:
+                self.fp.write(PerFrameFunctionalGroupsSequence)
+            if encapsulated:
+                self._write_encapsulated_header()
+            else:
+                total_length = NumberOfFrames * frame_length
+                self.fp.write(struct.pack("<HHI", 0x7FE0, 0x0010, total_length + total_length % 2))
+        except BaseException:
+            self.abort()
+            raise
+        if metrics is not None:
+            metrics.add_time("header", time.perf_counter() - start)
+            metrics.frames_written(0, self.fp.tell())
+
+    def _write_encapsulated_header(self):
+        if self.offset_table == "EOT":
+            # ExtendedOffsetTable and ExtendedOffsetTableLengths, both reserved here and patched in close()
+            self.eot_pos = self.fp.tell()
+            for element in (0x0001, 0x0002):
+                self.fp.write(struct.pack("<HH2sHI", 0x7FE0, element, b"OV", 0, 8 * self.NumberOfFrames))
+                self.fp.write(b"\0" * (8 * self.NumberOfFrames))
+            bot_length = 0   # the Basic Offset Table shall be empty if the Extended Offset Table is present
+        else:
+            bot_length = 4 * self.NumberOfFrames
+        self.fp.write(struct.pack("<HH2sHI", 0x7FE0, 0x0010, b"OB", 0, 0xFFFFFFFF))
+        self.fp.write(struct.pack("<HHI", 0xFFFE, 0xE000, bot_length))
+        self.bot_pos = self.fp.tell()
+        self.fp.write(b"\0" * bot_length)
+        self.first_item_pos = self.fp.tell()
+
+    # append one encoded frame
+    def write_frame(self, frame):
+        if self.frame_cnt >= self.NumberOfFrames:
+            raise Exception("More frames than NumberOfFrames=%d" % self.NumberOfFrames)
+        if self.metrics is not None:
+            start = time.perf_counter()
+        if self.encapsulated:
+            padded_length = len(frame) + len(frame) % 2
+            self.offsets.append(self.fp.tell() - self.first_item_pos)
+            self.lengths.append(padded_length)
+            data = [struct.pack("<HHI", 0xFFFE, 0xE000, padded_length), frame, b"\0" if len(frame) % 2 else b""]
+        else:
+            if len(frame) != self.frame_length:
+                raise Exception("Frame length %d doesn't match %d" % (len(frame), self.frame_length))
+            data = [frame]
+        self.frame_offsets.append(self.fp.tell() + (8 if self.encapsulated else 0))
+        self.frame_lengths.append(len(frame))
+        if self.metrics is not None:
+            encapsulated = time.perf_counter()
+            self.metrics.add_time("encapsulate", encapsulated - start)
+        for chunk in data:
+            self.fp.write(chunk)
+        self.frame_cnt += 1
+        if self.metrics is not None:
+            self.metrics.add_time("write", time.perf_counter() - encapsulated)
+            self.metrics.frames_written(1, sum(len(chunk) for chunk in data))
+
+    # finish the pixel data, patch the offset table, close the file and move it to its final name
+    def close(self):
+        start = time.perf_counter()
+        try:
+            if self.frame_cnt != self.NumberOfFrames:
+                raise Exception("%d frames written, %d expected" % (self.frame_cnt, self.NumberOfFrames))
+            if self.encapsulated:
+                self.fp.write(struct.pack("<HHI", 0xFFFE, 0xE0DD, 0))   # sequence delimitation item
+                if self.offset_table == "EOT":
+                    self.fp.seek(self.eot_pos + 12)
+                    self.fp.write(struct.pack("<%dQ" % self.NumberOfFrames, *self.offsets))
+                    self.fp.seek(12, os.SEEK_CUR)
+                    self.fp.write(struct.pack("<%dQ" % self.NumberOfFrames, *self.lengths))
+                else:
+                    if self.offsets and self.offsets[-1] > 0xFFFFFFFF:
+                        raise Exception("Frame offsets exceed the Basic Offset Table limit, use offset_table='EOT'")
+                    self.fp.seek(self.bot_pos)
+                    self.fp.write(struct.pack("<%dI" % self.NumberOfFrames, *self.offsets))
+            elif (self.NumberOfFrames * self.frame_length) % 2:
+                self.fp.write(b"\0")
+            if self.ratio_pos is not None and self.frame_lengths:
+                self.fp.seek(self.ratio_pos)
+                self.fp.write(lossy_ratio_value(self.frame_length * self.frame_cnt / max(sum(self.frame_lengths), 1)))
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+        except BaseException:
+            self.abort()
+            raise
+        self.fp.close()
+        os.replace(self.fp.name, self.filename)
+        if self.metrics is not None:
+            self.metrics.add_time("write", time.perf_counter() - start)
+        if self.on_close is not None:
+            self.on_close(self)
+
+    # close and remove an unfinished instance
+    def abort(self):
+        self.fp.close()
+        if os.path.exists(self.fp.name):
+            os.remove(self.fp.name)
+
+
+class pyramid_level_writer:
+    '''
+    Write the instances of one image level while the pyramid is being built.
+    Tiles arrive in the same order as the frames of the level (see generate_instance_info_list), tiles not in
+    the frame plan (i.e. on empty glass) are skipped.
+    '''
+    def __init__(self, converter, instance_indices, file_meta):
+        self.converter = converter
+        self.instance_indices = deque(instance_indices)  # indices of this level's instances in frame_items_info_list
+        self.file_meta = file_meta
+        self.frame_items_info = None
+        self.writer = None
+        self.next_frame = 0   # index of the next expected frame in frame_items_info
+        self.batch = []   # tiles waiting to be sent for encoding
+        self.pending = deque()   # (instance writer, future of encoded frames, whether they end the instance), in frame order
+        self.queue_name = "level_%d" % converter.frame_items_info_list[instance_indices[0]].img_level if instance_indices else "level"
+        self._open_next()
+
+    def _open_next(self):
+        if self.instance_indices:
+            instance_idx = self.instance_indices.popleft()
+            self.frame_items_info = self.converter.frame_items_info_list[instance_idx]
+            if self.converter.instance_done(instance_idx):
+                self.converter.skip_instance(instance_idx)
+                self.writer = None   # completed by a previous conversion, its tiles are only counted
+            else:
+                self.writer = self.converter.open_instance(instance_idx, self.file_meta)
+            self.next_frame = 0
+        else:
+            self.frame_items_info = None
+
+    def _submit(self, last=False):
+        if self.batch:
+            self.pending.append((self.writer, self.converter.submit(_worker_encode_images, self.converter.frame_encoder.encode_images, self.batch), last))
+            self.batch = []
+
+    # write encoded frames until at most max_pending batches are left
+    def drain(self, max_pending=0):
+        while len(self.pending) > max_pending:
+            writer, future, last = self.pending.popleft()
+            for frame in self.converter.task_result(future):
+                self.converter.write_stage.put(writer.write_frame, frame)
+            if last:
+                self.converter.write_stage.put(writer.close)
+
+    def add(self, column, row, tile):
+        if self.frame_items_info is None:
+            return
+        dim_idx = self.frame_items_info.DimensionIndexValues[self.next_frame]
+        if dim_idx[0] != column + 1 or dim_idx[1] != row + 1:
+            return
+        if self.writer is not None:
+            self.batch.append(tile)
+        self.next_frame += 1
+        if self.next_frame == len(self.frame_items_info.locations):
+            self._submit(last=True)
+            self._open_next()
+        elif len(self.batch) >= self.converter.frames_per_task:
+            self._submit()
+        if self.converter.metrics is not None:
+            self.converter.metrics.set_queue_depth(self.queue_name, len(self.pending))
+        self.drain(self.converter.tasks_in_flight)
+
+    # the write stage should be cancelled first, see WSIDICOM_Converter.write_pyramid
+    def abort(self):
+        for writer, future, last in self.pending:
+            future.cancel()
+            if writer.frame_cnt < writer.NumberOfFrames and not writer.fp.closed:
+                writer.abort()
+        if self.writer is not None and not self.writer.fp.closed:
+            self.writer.abort()
+
+
 class frame_info:
     def __init__(self, img_level, locations, DimensionIndexValues, patch_size):
         self.img_level = img_level   # designate a image level for patch extraction
-        self.locations = locations   # [[x1, y1], [x2, y2]...]  patch locations on the designated image level
-        self.DimensionIndexValues = DimensionIndexValues  # [[1,1], [1, 2], [1, 3] ...] patch indexing
+        self.locations = locations   # [[x1, y1], [x2, y2]...]  patch locations on level 0, (n, 2) int32 array or list
+        self.DimensionIndexValues = DimensionIndexValues  # [[1,1], [1, 2], [1, 3] ...] patch indexing, (n, 2) uint32 array or list
         self.patch_size = patch_size  # [512, 512] patch size
 
 
+def plan_grid(grid_size, step, row_major=False):
+    '''
+    patch indexing and locations of a whole patch grid, in frame order
+    :param grid_size: (columns, rows) of the grid
+    :param step: (x, y) step between patches, in level 0 pixels
+    :param row_major: frames along rows first (TILED_FULL), otherwise along columns first
+    :return: DimensionIndexValues (n, 2) uint32 array, 1-based; locations (n, 2) int32 array
+    '''
+    columns, rows = grid_size
+    if row_major:
+        column_idx = np.tile(np.arange(columns, dtype=np.uint32), rows)
+        row_idx = np.repeat(np.arange(rows, dtype=np.uint32), columns)
+    else:
+        column_idx = np.repeat(np.arange(columns, dtype=np.uint32), rows)
+        row_idx = np.tile(np.arange(rows, dtype=np.uint32), columns)
+    DimensionIndexValues = np.stack([column_idx + 1, row_idx + 1], axis=1)
+    locations = np.stack([column_idx * step[0], row_idx * step[1]], axis=1).astype(np.int32)
+    return DimensionIndexValues, locations
+
+
 class parameters:
-    def __init__(self, max_frame=500, patch_size=(512, 512), image_levels=None, JPEG_COMPRESS=True, Quality=75):
+    def __init__(self, max_frame=500, patch_size=(512, 512), image_levels=None, JPEG_COMPRESS=True, Quality=75,
+                 workers=1, worker_type="process", frames_per_task=16, read_cache_size=256 * 2 ** 20, memory_limit=None, offset_table="BOT",
+                 JPEG_PASSTHROUGH=False, TISSUE_DETECTION=False, tissue_threshold=20, tissue_mask_size=1024,
+                 GENERATE_PYRAMID=False, pyramid_thumbnail_size=None, FAST_FRAME_SEQUENCE=True, TILED_FULL=False,
+                 UID_seed=None, resume=False, codec=None, metrics_jsonl=None, metrics_prometheus=None, metrics_interval=1.0,
+                 SPATIAL_INDEX=True, header_template=None, regions=None, incremental=False):
         self.max_frame = max_frame   # maximum frame count in one .dcm file
         self.patch_size = patch_size  # patch size of each frame
         self.image_levels = image_levels  # image levels that would like to be saved into Dicom files, i.e, range(0, 3). if None, save all the image levels
-        self.JPEG_COMPRESS = JPEG_COMPRESS
+        self.regions = regions  # only save the patches intersecting these regions, {image level: [box, polygon or mask, ...]} or a list for all the levels, see roi.py
+        if incremental and (TILED_FULL or GENERATE_PYRAMID or not SPATIAL_INDEX):
+            raise Exception("Incremental conversion needs SPATIAL_INDEX, and can't be used with TILED_FULL or GENERATE_PYRAMID")
+        self.incremental = incremental  # add the patches of image_levels and regions to the instances already in the output directory, without redoing them
+        if codec is None:
+            codec = "jpeg_baseline" if JPEG_COMPRESS else "uncompressed"
+        get_codec(codec).check()
+        self.codec = codec  # codec of the frames, see frame_codecs.CODECS, i.e. 'jpeg2000_lossless'. if None, set by JPEG_COMPRESS
+        self.JPEG_COMPRESS = get_codec(codec).encapsulated  # whether frames are compressed, follows the codec
+        self.workers = workers  # number of workers for reading and encoding frames, 1 means no parallelism, None for the number of CPUs
+        if worker_type not in ("process", "thread"):
+            raise Exception("worker_type should be either 'process' or 'thread'")
+        self.worker_type = worker_type  # 'process': a process pool, one OpenSlide handle per process; 'thread': a thread pool sharing one handle
+        self.frames_per_task = frames_per_task  # frames read and encoded by a worker in one task, adjacent frames of a task are read as one band
+        self.read_cache_size = read_cache_size  # bytes of decoded source tiles kept by each worker for the next bands, see region_reader.py
+        if memory_limit is not None:
+            parse_size(memory_limit)
+        self.memory_limit = memory_limit  # memory budget of the conversion, i.e. '2GB': workers, frames_per_task, read_cache_size and queues are reduced to fit, see scheduler.py
+        self.TISSUE_DETECTION = TISSUE_DETECTION  # skip patches on empty glass, instances are saved as TILED_SPARSE
+        self.tissue_threshold = tissue_threshold  # minimum color saturation of tissue pixels, see tissue_detection.detect_tissue
+        self.tissue_mask_size = tissue_mask_size  # maximum width/height of the low resolution tissue mask
+        self.GENERATE_PYRAMID = GENERATE_PYRAMID  # build a 2x pyramid from level 0 in one pass, instead of reading each level from WSI
+        self.pyramid_thumbnail_size = pyramid_thumbnail_size  # the pyramid goes down to this size, if None, down to a single patch
+        self.FAST_FRAME_SEQUENCE = FAST_FRAME_SEQUENCE  # encode PerFrameFunctionalGroupsSequence from a template (frame_sequence.py) instead of pydicom datasets
+        if TILED_FULL and (TISSUE_DETECTION or regions is not None):
+            raise Exception("TILED_FULL needs all the patches, it can't be used with TISSUE_DETECTION or regions")
+        self.TILED_FULL = TILED_FULL  # frames in row-major order without PerFrameFunctionalGroupsSequence, a level split into instances is a concatenation
+        self.UID_seed = UID_seed  # if None, use the hard coded UIDs; otherwise UIDs are derived from it, i.e. the slide path, so each slide gets its own
+        self.metrics_jsonl = metrics_jsonl  # append conversion metrics (stage timers, frames/s, ETA...) to this json-lines file, see metrics.py
+        self.metrics_prometheus = metrics_prometheus  # keep the latest conversion metrics in this file, in Prometheus text format
+        self.metrics_interval = metrics_interval  # seconds between two progress updates of the metrics
+        self.resume = resume or incremental  # skip the instances completed by a previous, interrupted conversion into the same directory, see checkpoint.py
+        self.header_template = header_template  # JSON or YAML file (or dict) of header elements, added to or replacing those of header_template.json
+        self.SPATIAL_INDEX = SPATIAL_INDEX  # save the tile grid of each level with frame byte ranges next to the instances, see spatial_index.py
+        self.offset_table = offset_table  # 'BOT': Basic Offset Table; 'EOT': Extended Offset Table, for compressed instances over 4GB
         if self.JPEG_COMPRESS:
             self.IS_LITTLE_ENDIAN = True
             self.IS_IMPLICIT_VR = False
-            self.Quality = Quality   # image quality of JPEG compression [0-100]
+            self.Quality = Quality   # image quality of lossy compression [0-100]
+            self.JPEG_PASSTHROUGH = JPEG_PASSTHROUGH and codec == "jpeg_baseline"  # copy JPEG tiles of the source TIFF into frames when they line up with patches
         else:
+            self.JPEG_PASSTHROUGH = False
             self.IS_LITTLE_ENDIAN = True
             self.IS_IMPLICIT_VR = True
 
 
 class WSIDICOM_Converter:
-    def __init__(self, wsi_fn, save_to_dir, parameters):
+    def __init__(self, wsi_fn, save_to_dir, parameters, frame_plan=None):
         '''
         init function of WSI-to-DICOM converter
         :param wsi_fn: file name of WSI
         :param save_to_dir: directory to save the output dicom files
         :param parameters: parameters for convention, see class parameters
+        :param frame_plan: frame_items_info_list planned beforehand with the same parameters, i.e. by the coordinator of
+        a sharded conversion (see WSI_DICOM_Shard.py). If None, frames are planned from the slide
         '''
+        self.wsi_fn = wsi_fn
         self.wsi_obj = openslide.open_slide(wsi_fn)
         self.save_to_dir = save_to_dir
         self.instance_cnt = 0
@@ -60,263 +607,561 @@ class WSIDICOM_Converter:
         self.max_frame = parameters.max_frame
         self.patch_size = parameters.patch_size
         self.image_levels = parameters.image_levels
+        self.regions = parameters.regions
+        self.incremental = parameters.incremental
+        self.codec = parameters.codec
         self.JPEG_COMPRESS = parameters.JPEG_COMPRESS
         if self.JPEG_COMPRESS:
             self.IS_LITTLE_ENDIAN = True
             self.IS_IMPLICIT_VR = False
             self.Quality = parameters.Quality
+            self.JPEG_PASSTHROUGH = parameters.JPEG_PASSTHROUGH
         else:
             self.IS_LITTLE_ENDIAN = True
             self.IS_IMPLICIT_VR = True
+            self.Quality = None
+            self.JPEG_PASSTHROUGH = False
+        self.worker_type = parameters.worker_type
+        self.offset_table = parameters.offset_table
+        self.TISSUE_DETECTION = parameters.TISSUE_DETECTION
+        self.tissue_threshold = parameters.tissue_threshold
+        self.tissue_mask_size = parameters.tissue_mask_size
+        self.FAST_FRAME_SEQUENCE = parameters.FAST_FRAME_SEQUENCE
+        self.UID_seed = parameters.UID_seed
+        self.resume = parameters.resume
+        self.SPATIAL_INDEX = parameters.SPATIAL_INDEX
+        self.header_template = parameters.header_template
+        self.TILED_FULL = parameters.TILED_FULL
+        self.GENERATE_PYRAMID = parameters.GENERATE_PYRAMID
+        if self.GENERATE_PYRAMID:
+            # image levels refer to the generated 2x pyramid, all of them are built from WSI level 0
+            thumbnail_size = parameters.pyramid_thumbnail_size or max(self.patch_size)
+            self.level_dimensions = pyramid_dimensions(self.wsi_obj.dimensions, thumbnail_size)
+            self.level_downsamples = [2.0 ** lv for lv in range(len(self.level_dimensions))]
+            self.JPEG_PASSTHROUGH = False  # every frame is encoded from decoded pixels
+        else:
+            self.level_dimensions = self.wsi_obj.level_dimensions
+            self.level_downsamples = self.wsi_obj.level_downsamples
+        # workers, frames per task, read cache and queue depths, within parameters.memory_limit if any
+        pyramid_grid_sizes = None
+        if self.GENERATE_PYRAMID:
+            pyramid_grid_sizes = [(-(-self.wsi_obj.dimensions[0] // int(self.patch_size[0] * ds)), -(-self.wsi_obj.dimensions[1] // int(self.patch_size[1] * ds)))
+                                  for ds in self.level_downsamples]
+        self.schedule = schedule_pipeline(pipeline_memory(self.patch_size, get_codec(self.codec), self.worker_type, pyramid_grid_sizes),
+                                          parameters.workers, parameters.frames_per_task, parameters.read_cache_size, parameters.memory_limit)
+        self.workers = self.schedule["workers"]
+        self.frames_per_task = self.schedule["frames_per_task"]
+        self.read_cache_size = self.schedule["read_cache_size"]
+        self.tasks_in_flight = self.schedule["tasks_in_flight"]  # tasks submitted to the workers and not yet written
+        self.write_queue_frames = self.schedule["write_queue_frames"]  # encoded frames waiting for the writer thread
+        if self.schedule["memory_limit"] is not None:
+            print("Memory limit %s, estimated peak %s: %d workers, %d frames per task, %s read cache, %d tasks in flight, %d frames in the write queue%s" % (
+                format_size(self.schedule["memory_limit"]), format_size(self.schedule["estimate"]["total"]), self.workers,
+                self.frames_per_task, format_size(self.read_cache_size), self.tasks_in_flight, self.write_queue_frames,
+                "".join("; " + adjustment for adjustment in self.schedule["adjustments"])))
+        self.tile_source = jpeg_tile_source(wsi_fn, self.wsi_obj) if self.JPEG_PASSTHROUGH else None
+        self.reader = region_reader(self.wsi_obj, wsi_fn, self.read_cache_size)
+        self.frame_encoder = frame_encoder(self.wsi_obj, self.codec, self.Quality, self.tile_source, reader=self.reader)
+        self.pool = None  # worker pool, only exists during convert()
+        self.write_stage = None  # writer thread behind a bounded queue of encoded frames, only exists during convert()
+        self.open_writers = {}   # instance index -> instance_writer of the instances being written
+        self.open_writers_lock = threading.Lock()   # opened by the main thread, closed or aborted by the writer thread
+        self.metrics = None  # conversion_metrics, only if metrics are saved or observed, see add_observer
+        if parameters.metrics_jsonl is not None:
+            self.add_observer(jsonl_observer(parameters.metrics_jsonl), parameters.metrics_interval)
+        if parameters.metrics_prometheus is not None:
+            self.add_observer(prometheus_observer(parameters.metrics_prometheus), parameters.metrics_interval)
+        self.checkpoint = conversion_checkpoint(save_to_dir, parameters)
+        self.sinks = []  # called with the file name of each completed instance, see add_sink
 
-        # add default tags into a Dicom instance
+        # elements shared by all the instances, encoded once
         self.dcm_instance = self.add_default_elements()
+        self.header = header_encoder(self.dcm_instance, self.IS_IMPLICIT_VR, self.IS_LITTLE_ENDIAN)
         # generate essential information for patch extraction, so the patches can be saved into Dicom instances
-        self.frame_items_info_list = self.generate_instance_info_list()
+        if frame_plan is None:
+            self.frame_items_info_list = self.generate_instance_info_list()
+        else:
+            self.frame_items_info_list = frame_plan
+
+    # call observer(event, snapshot) during the conversion, see metrics.py for events and snapshot content
+    def add_observer(self, observer, interval=1.0):
+        if self.metrics is None:
+            self.metrics = conversion_metrics(self.wsi_fn, interval)
+        self.metrics.add_observer(observer)
+
+    # call sink(filename) each time an instance is complete, i.e. WSI_DICOM_Upload.stow_uploader.submit to upload
+    # instances while the next ones are encoded. Instances skipped on resume are not passed to the sinks
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    # time a stage if metrics are enabled
+    def timer(self, stage):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.timer(stage)
+
+    # the hard coded UID, or a UID derived from it and parameters.UID_seed. Same seed, same UIDs, in any process
+    def make_UID(self, default):
+        if self.UID_seed is None:
+            return default
+        return pydicom.uid.generate_uid(entropy_srcs=[str(self.UID_seed), default])
 
-    # add information to default tags. (currently hard coded, can be loaded from yaml file)
+    # static header of the instances: elements of the header template (see dicom_header.py), and the elements
+    # which follow from the slide and the parameters
     def add_default_elements(self):
-        filename = os.path.join(self.save_to_dir, "compressed_instance_" + str(self.instance_cnt) + ".dcm")
-        ds = FileDataset(filename, {}, preamble=b"\0" * 128,
-                         is_implicit_VR=self.IS_IMPLICIT_VR, is_little_endian=self.IS_LITTLE_ENDIAN)
-        ds.SpecificCharacterSet = 'ISO_IR 100'
-        # ds.ImageType = ['ORIGINAL', 'PRIMARY', 'VOLUME', 'NONE']
-        ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.77.1.6'  # VL Whole Slide Microscopy Image Storage
-        # ds.SOPInstanceUID = '1.2.276.0.7230010.3.1.4.296485376.1.1484917438.721089'
-        ds.StudyDate = '20170120'
-        ds.SeriesDate = '20170120'
-        ds.ContentDate = '20170120'
-        ds.AcquisitionDateTime = '20170120130353.000000'
-        ds.StudyTime = '130353.000000'
-        ds.SeriesTime = '130353.000000'
-        ds.ContentTime = '130353.000000'
-        ds.AccessionNumber = '123456789'
-        ds.Modality = 'SM'
-        ds.Manufacturer = 'MyManufacturer'
-        ds.ReferringPhysicianName = 'SOME^PHYSICIAN'
-        ds.ManufacturerModelName = 'MyModel'
-        ds.VolumetricProperties = 'VOLUME'
-        if self.JPEG_COMPRESS:
-            ds.PatientName = 'compressed_' + self._wsi_fn_
-            ds.PatientID = 'compressed_' + self._wsi_fn_
-        else:
-            ds.PatientName = 'uncompressed_' + self._wsi_fn_
-            ds.PatientID = 'uncompressed_' + self._wsi_fn_
-        ds.PatientBirthDate = '19700101'
-        ds.PatientSex = 'M'
-        ds.DeviceSerialNumber = 'MySerialNumber'
-        ds.SoftwareVersions = 'MyVersion'
-        ds.AcquisitionDuration = 100
-        ds.StudyInstanceUID = '1.2.276.0.7230010.3.1.2.296485376.1.1484917433.721084'
-        # ds.SeriesInstanceUID = '1.2.276.0.7230010.3.1.3.296485376.1.1484917433.721085'
-        ds.StudyID = 'NONE'
-        # ds.SeriesNumber = 1
-        ds.PatientOrientation = ''
-        ds.ImageComments = 'http://openslide.cs.cmu.edu/download/openslide-testdata/Aperio/'
-
-        ds_DimensionOrganization = Dataset()
-        ds_DimensionOrganization.DimensionOrganizationUID = '1.2.276.0.7230010.3.1.4.296485376.1.1484917433.721087'
-        ds.DimensionOrganizationSequence = Sequence([ds_DimensionOrganization])
-
-        ds_DimensionIndex0 = Dataset()
-        ds_DimensionIndex0.DimensionOrganizationUID = '1.2.276.0.7230010.3.1.4.296485376.1.1484917433.721087'
-        ds_DimensionIndex0.DimensionIndexPointer = Tag(0x0048021E)
-        ds_DimensionIndex0.FunctionalGroupPointer = Tag(0x0048021A)
-        ds_DimensionIndex1 = Dataset()
-        ds_DimensionIndex1.DimensionOrganizationUID = '1.2.276.0.7230010.3.1.4.296485376.1.1484917433.721087'
-        ds_DimensionIndex1.DimensionIndexPointer = Tag(0x0048021F)
-        ds_DimensionIndex1.FunctionalGroupPointer = Tag(0x0048021A)
-        ds.DimensionIndexSequence = Sequence([ds_DimensionIndex0, ds_DimensionIndex1])
-
-        ds_WholeSlideMicroscopyImageFrameType = Dataset()
-        ds_WholeSlideMicroscopyImageFrameType.FrameType = ['ORIGINAL', 'PRIMARY', 'VOLUME', 'NONE']
-        ds.WholeSlideMicroscopyImageFrameTypeSequence = Sequence([ds_WholeSlideMicroscopyImageFrameType])
-
-        ds.SamplesPerPixel = 3
-        # ds.PhotometricInterpretation = 'RGB'
-        ds.PhotometricInterpretation = 'MONOCHROME2'
-
-        ds.PlanarConfiguration = 0
+        elements = load_template(self.header_template)
+        ds = dataset_from_template(elements)
+        # UIDs of the template are derived from UID_seed, like the other UIDs
+        ds.StudyInstanceUID = self.make_UID(ds.StudyInstanceUID)
+        for item in list(ds.get("DimensionOrganizationSequence", [])) + list(ds.get("DimensionIndexSequence", [])):
+            item.DimensionOrganizationUID = self.make_UID(item.DimensionOrganizationUID)
+        for item in ds.get("SpecimenDescriptionSequence", []):
+            item.SpecimenUID = self.make_UID(item.SpecimenUID)
+        if self.TISSUE_DETECTION or self.regions is not None or self.incremental:
+            ds.DimensionOrganizationType = 'TILED_SPARSE'   # patches on empty glass or out of the regions are not saved
+        if self.TILED_FULL:
+            ds.DimensionOrganizationType = 'TILED_FULL'   # frame positions are implied by the frame order
+            ds.TotalPixelMatrixFocalPlanes = 1
+            ds.NumberOfOpticalPaths = 1
+        prefix = 'compressed_' if self.JPEG_COMPRESS else 'uncompressed_'
+        if "PatientName" not in elements:
+            ds.PatientName = prefix + self._wsi_fn_
+        if "PatientID" not in elements:
+            ds.PatientID = prefix + self._wsi_fn_
+        ds.PhotometricInterpretation = get_codec(self.codec).PhotometricInterpretation
         ds.Rows = self.patch_size[1]
         ds.Columns = self.patch_size[0]
-        ds.BitsAllocated = 8
-        ds.BitsStored = 8
-        ds.HighBit = 7
-        ds.PixelRepresentation = 0
-        ds.BurnedInAnnotation = 'NO'
-        ds.LossyImageCompression = '01'
-        ds.LossyImageCompressionRatio = 10
-        ds.LossyImageCompressionMethod = 'ISO_10918_1'
-        # ds.LossyImageCompressionMethod = 'ISO_14495_1'
-        ds.ContainerIdentifier = 'CI_12345'
-        ds.IssuerOfTheContainerIdentifierSequence = []
-        ds.ContainerTypeCodeSequence = []
-        ds.AcquisitionContextSequence = []
-        ds.ColorSpace = 'sRGB'
-
-        ds_SpecimenDescription = Dataset()
-        ds_SpecimenDescription.SpecimenIdentifier = 'Specimen^Identifier'
-        ds_SpecimenDescription.SpecimenUID = '1.2.276.0.7230010.3.1.4.3252829876.4112.1426166133.871'
-        ds_SpecimenDescription.IssuerOfTheSpecimenIdentifierSequence = []
-        ds_SpecimenDescription.SpecimenPreparationSequence = []
-        ds.SpecimenDescriptionSequence = Sequence([ds_SpecimenDescription])
-
-        ds.ImagedVolumeWidth = 15
-        ds.ImagedVolumeHeight = 15
-        ds.ImagedVolumeDepth = 1
-
-        ds_TotalPixelMatrixOrigin = Dataset()
-        ds_TotalPixelMatrixOrigin.XOffsetInSlideCoordinateSystem = 20
-        ds_TotalPixelMatrixOrigin.YOffsetInSlideCoordinateSystem = 40
-        ds.TotalPixelMatrixOriginSequence = Sequence([ds_TotalPixelMatrixOrigin])
-
-        ds.SpecimenLabelInImage = 'NO'
-        ds.FocusMethod = 'AUTO'
-        ds.ExtendedDepthOfField = 'NO'
-        ds.ImageOrientationSlide = ['0', '-1', '0', '-1', '0', '0']
-
-        ds_OpticalPath = Dataset()
-        ds_IlluminationTypeCode = Dataset()
-        ds_IlluminationTypeCode.CodeValue = '111744'
-        ds_IlluminationTypeCode.CodingSchemeDesignator = 'DCM'
-        ds_IlluminationTypeCode.CodeMeaning = 'Brightfield illumination'
-        ds_OpticalPath.IlluminationTypeCodeSequence = Sequence([ds_IlluminationTypeCode])
-        ds_OpticalPath.ICCProfile = b'RGB'
-        ds_OpticalPath.OpticalPathIdentifier = '1'
-        ds_OpticalPath.OpticalPathDescription = 'Brightfield'
-        ds_IlluminationColorCode = Dataset()
-        ds_IlluminationColorCode.CodeValue = 'R-102C0'
-        ds_IlluminationColorCode.CodingSchemeDesignator = 'SRT'
-        ds_IlluminationColorCode.CodeMeaning = 'Full Spectrum'
-        ds_OpticalPath.IlluminationColorCodeSequence = Sequence([ds_IlluminationColorCode])
-        ds.OpticalPathSequence = Sequence([ds_OpticalPath])
-
-        ds_PixelMeasures = Dataset()
-        ds_PixelMeasures.SliceThickness = 1
-        ds_PixelMeasures.PixelSpacing = ['0.00025', '0.00025']
-        PixelMeasuresSequence = Sequence([ds_PixelMeasures])
-        ds_OpticalPathIdentification = Dataset()
-        ds_OpticalPathIdentification.OpticalPathIdentifier = '1'
-        OpticalPathIdentificationSequence = Sequence([ds_OpticalPathIdentification])
-
-        SharedFunctionalGroupsSequence = Dataset()
-        SharedFunctionalGroupsSequence.OpticalPathIdentificationSequence = OpticalPathIdentificationSequence
-        SharedFunctionalGroupsSequence.PixelMeasuresSequence = PixelMeasuresSequence
-        ds.SharedFunctionalGroupsSequence = Sequence([SharedFunctionalGroupsSequence])
+        if get_codec(self.codec).lossy:
+            ds.LossyImageCompression = '01'
+            ds.LossyImageCompressionMethod = get_codec(self.codec).LossyImageCompressionMethod
+        else:
+            ds.LossyImageCompression = '00'
         return ds
 
     # Generate patch extraction information for Dicom instance saving
     def generate_instance_info_list(self):
         frame_items_info_list = []
+        covered = {}   # image level -> (columns, rows) grid of the patches already saved
+        if self.incremental:
+            frame_items_info_list, covered = self.previous_instances()
         org_w, org_h = self.wsi_obj.dimensions
-        down_rate = self.wsi_obj.level_downsamples
+        down_rate = self.level_downsamples
         image_level_list = self.image_levels
         if image_level_list is None:
-            image_level_list = range(self.wsi_obj.level_count)
+            image_level_list = range(len(self.level_dimensions))
         else:
-            if not range_subset(image_level_list, range(self.wsi_obj.level_count)):
+            if not range_subset(image_level_list, range(len(self.level_dimensions))):
                 raise Exception("Designated image levels exceed the range of original WSI image levels")
+        tissue_mask = None
+        if self.TISSUE_DETECTION:
+            tissue_mask = detect_tissue(self.wsi_obj, self.tissue_threshold, self.tissue_mask_size)
         for img_lv in image_level_list:
-            fi_temp = frame_info(img_lv, [], [], self.patch_size)
-            w_idx = 0
-            for w in range(0, org_w, int(self.patch_size[0] * down_rate[img_lv])):
-                w_idx += 1
-                h_idx = 0
-                for h in range(0, org_h, int(self.patch_size[1] * down_rate[img_lv])):
-                    h_idx += 1
-                    logging.debug("DimensionIndexValues: %d, %d" % (w_idx, h_idx))
-                    if len(fi_temp.locations) < self.max_frame:
-                        fi_temp.DimensionIndexValues.append([w_idx, h_idx])
-                        fi_temp.locations.append([w, h])
-                    else:
-                        frame_items_info_list.append(fi_temp)
-                        fi_temp = frame_info(img_lv, [], [], self.patch_size)
-            if len(fi_temp.locations) > 0:
-                frame_items_info_list.append(fi_temp)
+            step = (int(self.patch_size[0] * down_rate[img_lv]), int(self.patch_size[1] * down_rate[img_lv]))
+            grid_size = (-(-org_w // step[0]), -(-org_h // step[1]))
+            DimensionIndexValues, locations = plan_grid(grid_size, step, self.TILED_FULL)
+            if tissue_mask is not None:
+                tissue = tissue_grid(tissue_mask, (org_w, org_h), step, grid_size)
+                keep = tissue[DimensionIndexValues[:, 0] - 1, DimensionIndexValues[:, 1] - 1]
+                DimensionIndexValues, locations = DimensionIndexValues[keep], locations[keep]
+            regions = level_regions(self.regions, img_lv)
+            if regions is not None:
+                keep = region_grid(regions, (org_w, org_h), step, grid_size)[DimensionIndexValues[:, 0] - 1, DimensionIndexValues[:, 1] - 1]
+                DimensionIndexValues, locations = DimensionIndexValues[keep], locations[keep]
+            if img_lv in covered:
+                done = covered[img_lv]
+                columns, rows = DimensionIndexValues[:, 0] - 1, DimensionIndexValues[:, 1] - 1
+                keep = np.ones(len(locations), dtype=bool)
+                inside = (columns < done.shape[0]) & (rows < done.shape[1])
+                keep[inside] = ~done[columns[inside], rows[inside]]
+                DimensionIndexValues, locations = DimensionIndexValues[keep], locations[keep]
+            logging.debug("Image level %d: %d x %d patches, %d to save" % (img_lv, grid_size[0], grid_size[1], len(locations)))
+            # instances are views into the level arrays
+            for start in range(0, len(locations), self.max_frame):
+                frame_items_info_list.append(frame_info(img_lv, locations[start:start + self.max_frame],
+                                                        DimensionIndexValues[start:start + self.max_frame], self.patch_size))
         return frame_items_info_list
 
-    # add frame sequence information into Dicom instance
+    # frame plan of the instances of a previous conversion into the same directory, read from its spatial index,
+    # so they are skipped like on resume, and (columns, rows) grids of the patches they cover
+    def previous_instances(self):
+        index_fn = os.path.join(self.save_to_dir, SPATIAL_INDEX_FILENAME)
+        if not os.path.exists(index_fn):
+            raise Exception("Incremental conversion needs the spatial index of a complete previous conversion in %s" % self.save_to_dir)
+        with spatial_index(index_fn) as index:
+            if not index.is_current() or len(glob.glob(os.path.join(self.save_to_dir, "*.dcm"))) != len(index.instances):
+                raise Exception("Instances in %s don't match their spatial index, resume the previous conversion first" % self.save_to_dir)
+            instance_frames = index.instance_frames()
+            tile_sizes = set(tuple(level["tile_size"]) for level in index.levels)
+        if tile_sizes and tile_sizes != {tuple(self.patch_size)}:
+            raise Exception("Previous conversion in %s used patches of %s, not %s" % (self.save_to_dir, sorted(tile_sizes), self.patch_size))
+        frame_items_info_list = []
+        covered = {}
+        for img_lv, DimensionIndexValues in instance_frames:
+            step = (int(self.patch_size[0] * self.level_downsamples[img_lv]), int(self.patch_size[1] * self.level_downsamples[img_lv]))
+            locations = ((DimensionIndexValues - 1) * np.array(step, dtype=np.uint32)).astype(np.int32)
+            frame_items_info_list.append(frame_info(img_lv, locations, DimensionIndexValues, self.patch_size))
+            if img_lv not in covered:
+                grid_size = (-(-self.wsi_obj.dimensions[0] // step[0]), -(-self.wsi_obj.dimensions[1] // step[1]))
+                covered[img_lv] = np.zeros(grid_size, dtype=bool)
+            covered[img_lv][DimensionIndexValues[:, 0] - 1, DimensionIndexValues[:, 1] - 1] = True
+        return frame_items_info_list, covered
+
+    # frame sequence information of an instance, PerFrameFunctionalGroupsSequence
     def add_Frame_Sequence_data(self, frame_items_info):
-        self.dcm_instance.PerFrameFunctionalGroupsSequence = Sequence()
+        PerFrameFunctionalGroupsSequence = Sequence()
         for idx, dim_idx in enumerate(frame_items_info.DimensionIndexValues):
             ds_FrameContent = Dataset()
-            ds_FrameContent.DimensionIndexValues = dim_idx
+            ds_FrameContent.DimensionIndexValues = [int(v) for v in dim_idx]
             FrameContentSequence = Sequence([ds_FrameContent])
             ds_PlanePositionSlide = Dataset()
-            ds_PlanePositionSlide.XOffsetInSlideCoordinateSystem = 20 + (frame_items_info.locations[idx][0]) * 0.00025  # TODO: pixel size
-            ds_PlanePositionSlide.YOffsetInSlideCoordinateSystem = 40 + (frame_items_info.locations[idx][1]) * 0.00025  # TODO
+            ds_PlanePositionSlide.XOffsetInSlideCoordinateSystem = 20 + int(frame_items_info.locations[idx][0]) * 0.00025  # TODO: pixel size
+            ds_PlanePositionSlide.YOffsetInSlideCoordinateSystem = 40 + int(frame_items_info.locations[idx][1]) * 0.00025  # TODO
             ds_PlanePositionSlide.ZOffsetInSlideCoordinateSystem = 0
-            ds_PlanePositionSlide.ColumnPositionInTotalImagePixelMatrix = int(frame_items_info.locations[idx][0] / self.wsi_obj.level_downsamples[frame_items_info.img_level]) + 1  # TODO
-            ds_PlanePositionSlide.RowPositionInTotalImagePixelMatrix = int(frame_items_info.locations[idx][1] / self.wsi_obj.level_downsamples[frame_items_info.img_level]) + 1  # TODO
+            ds_PlanePositionSlide.ColumnPositionInTotalImagePixelMatrix = int(frame_items_info.locations[idx][0] / self.level_downsamples[frame_items_info.img_level]) + 1  # TODO
+            ds_PlanePositionSlide.RowPositionInTotalImagePixelMatrix = int(frame_items_info.locations[idx][1] / self.level_downsamples[frame_items_info.img_level]) + 1  # TODO
             PlanePositionSlideSequence = Sequence([ds_PlanePositionSlide])
-            PerFrameFunctionalGroupsSequence = Dataset()
-            PerFrameFunctionalGroupsSequence.PlanePositionSlideSequence = PlanePositionSlideSequence
-            PerFrameFunctionalGroupsSequence.FrameContentSequence = FrameContentSequence
-            self.dcm_instance.PerFrameFunctionalGroupsSequence.append(PerFrameFunctionalGroupsSequence)
+            ds_FrameFunctionalGroups = Dataset()
+            ds_FrameFunctionalGroups.PlanePositionSlideSequence = PlanePositionSlideSequence
+            ds_FrameFunctionalGroups.FrameContentSequence = FrameContentSequence
+            PerFrameFunctionalGroupsSequence.append(ds_FrameFunctionalGroups)
+        return PerFrameFunctionalGroupsSequence
+
+    # encode frame sequence information into bytes, see frame_sequence.py
+    def encode_Frame_Sequence_data(self, frame_items_info):
+        return encode_frame_sequence(frame_items_info.locations, frame_items_info.DimensionIndexValues,
+                                     self.level_downsamples[frame_items_info.img_level],
+                                     (20, 40), 0.00025, self.IS_IMPLICIT_VR)  # TODO: origin and pixel size
+
+    # add the concatenation tags of an instance to ds, a TILED_FULL level saved into multiple instances is a concatenation
+    def add_Concatenation_data(self, instance_idx, ds):
+        img_level = self.frame_items_info_list[instance_idx].img_level
+        level_instances = [idx for idx, frame_items_info in enumerate(self.frame_items_info_list) if frame_items_info.img_level == img_level]
+        if len(level_instances) > 1:
+            ds.ConcatenationUID = self.make_UID('1.2.276.0.7230010.3.1.4.296485376.1.1484917438.721090.' + str(img_level))
+            ds.SOPInstanceUIDOfConcatenationSource = self.make_UID('1.2.276.0.7230010.3.1.4.296485376.1.1484917438.721091.' + str(img_level))
+            ds.InConcatenationNumber = level_instances.index(instance_idx) + 1
+            ds.InConcatenationTotalNumber = len(level_instances)
+            ds.ConcatenationFrameOffsetNumber = sum(len(self.frame_items_info_list[idx].locations) for idx in level_instances if idx < instance_idx)
+
+    # start the worker pool for reading and encoding frames, and the writer thread
+    def start_pool(self):
+        self.frame_encoder.timed = self.metrics is not None
+        if self.write_stage is None:
+            self.write_stage = pipeline_stage("write_queue", self.write_queue_frames, self.metrics,
+                                              on_error=self.abort_open_instances)
+        if self.workers <= 1 or self.pool is not None:
+            return
+        if self.worker_type == "process":
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            initargs=(self.wsi_fn, self.codec, self.Quality, self.JPEG_PASSTHROUGH,
+                                                      self.frame_encoder.timed, self.read_cache_size))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.write_stage is not None:
+            self.write_stage.close()
+            self.write_stage = None
+
+    # run a task on the worker pool, worker_task for process workers, task for thread workers or without a pool
+    def submit(self, worker_task, task, *args):
+        if self.pool is None:
+            return done_future(task(*args))
+        if self.worker_type == "process":
+            return self.pool.submit(worker_task, *args)
+        return self.pool.submit(task, *args)
+
+    # result of a frame_encoder task, its stage times are added to the metrics
+    def task_result(self, future):
+        if self.metrics is None:
+            return future.result()[0]
+        with self.metrics.timer("wait"):   # main thread waiting for the workers
+            result, times = future.result()
+        self.metrics.add_times(times)
+        return result
+
+    # yield results of tasks in order, keeping a bounded number of tasks in flight so results don't pile up in memory
+    def imap(self, worker_task, task, args_list):
+        in_flight = deque()
+        for args in args_list:
+            in_flight.append(self.submit(worker_task, task, *args))
+            if self.metrics is not None:
+                self.metrics.set_queue_depth("in_flight", len(in_flight))
+            if len(in_flight) >= self.tasks_in_flight:
+                yield self.task_result(in_flight.popleft())
+        while in_flight:
+            yield self.task_result(in_flight.popleft())
+
+    # yield encoded frames in the order of frame_items_info.DimensionIndexValues
+    def iter_PixelData(self, frame_items_info):
+        locations = frame_items_info.locations
+        args_list = ((frame_items_info.img_level, frame_items_info.patch_size, locations[start:start + self.frames_per_task])
+                     for start in range(0, len(locations), self.frames_per_task))
+        for encoded_framed_items in self.imap(_worker_encode, self.frame_encoder.encode, args_list):
+            yield from encoded_framed_items
 
     # create pixel data for Dicom instance
     def add_PixelData(self, frame_items_info):
         if self.JPEG_COMPRESS:
-            encoded_framed_items = []
-            for idx, f_loc in enumerate(frame_items_info.locations):
-                img = self.wsi_obj.read_region(f_loc, frame_items_info.img_level, frame_items_info.patch_size).convert("RGB")
-                instance_byte_str_buffer = BytesIO()
-                img.save(instance_byte_str_buffer, "JPEG", quality=self.Quality, icc_profile=img.info.get('icc_profile'), progressive=False)
-                t = instance_byte_str_buffer.getvalue()
-                encoded_framed_items.append(t)
-            return encoded_framed_items
+            return list(self.iter_PixelData(frame_items_info))
         else:
-            instance_byte_str = b''
-            for idx, f_loc in enumerate(frame_items_info.locations):
-                img = self.wsi_obj.read_region(f_loc, frame_items_info.img_level, frame_items_info.patch_size).convert("RGB")
-                instance_byte_str += img.tobytes()
-            return instance_byte_str
+            return b''.join(self.iter_PixelData(frame_items_info))
 
-    # write data to Dicom files.
-    def convert(self):
-        # create file meta information
+    # create file meta information
+    def create_file_meta(self):
         file_meta = Dataset()
         file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.77.1.2'  # VL Microscopic Image Storage
         file_meta.MediaStorageSOPInstanceUID = "1.2.276.0.7230010.3.1.4.296485376.1.1484917438.721089"
         file_meta.ImplementationClassUID = "1.2.3.4"
         file_meta.FileMetaInformationVersion = b'\x00\x01'
         file_meta.FileMetaInformationGroupLength = len(file_meta)
-        if self.JPEG_COMPRESS:
-            # file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.4.80'  # JPEG 2k
-            # file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.4.70'  # JPEG
-            file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.4.50'    # JPEG baseline
-        else:
-            file_meta.TransferSyntaxUID = '1.2.840.10008.1.2'  # default uncompressed
+        file_meta.TransferSyntaxUID = get_codec(self.codec).TransferSyntaxUID
+        return file_meta
 
+    # write data to Dicom files.
+    def convert(self):
+        file_meta = self.create_file_meta()
+        self.checkpoint.start(self.resume)
+        self.start_metrics(range(len(self.frame_items_info_list)))
         # write data into Dicom instances
-        self.instance_cnt = 0
-        for frame_items_info in self.frame_items_info_list:
-            print("Saving to instance %d/%d" % (self.instance_cnt, len(self.frame_items_info_list)))
-            # update relevant tags
-            self.dcm_instance.InstanceNumber = self.instance_cnt
-            self.dcm_instance.SeriesInstanceUID = '1.2.276.0.7230010.3.1.3.296485376.1.1484917433.721085.'+str(frame_items_info.img_level)
-            self.dcm_instance.SeriesNumber = frame_items_info.img_level
-            print(frame_items_info.img_level)
-            # self.dcm_instance.SOPInstanceUID = self.dcm_instance.SOPInstanceUID + str(self.instance_cnt)
-            self.dcm_instance.SOPInstanceUID = '1.2.276.0.7230010.3.1.4.296485376.1.1484917438.721089.' + str(self.instance_cnt)
-            self.dcm_instance.NumberOfFrames = len(frame_items_info.locations)
-            self.dcm_instance.TotalPixelMatrixColumns, self.dcm_instance.TotalPixelMatrixRows = self.wsi_obj.level_dimensions[frame_items_info.img_level]
-            self.add_Frame_Sequence_data(frame_items_info)
-            # create encoded pixel data
-            PixelData_encoded = self.add_PixelData(frame_items_info)
-            if self.JPEG_COMPRESS:
-                filename = os.path.join(self.save_to_dir, "compressed_instance_" + str(self.instance_cnt) + ".dcm")
-                data_elem_tag = pydicom.tag.TupleTag((0x7FE0, 0x0010))
-                enc_frames = encapsulate(PixelData_encoded, has_bot=True)
-                pd_ele = DataElement(data_elem_tag, 'OB', enc_frames, is_undefined_length=True)
-                self.dcm_instance.add(pd_ele)
+        self.start_pool()
+        try:
+            if self.GENERATE_PYRAMID:
+                self.write_pyramid(file_meta)
             else:
-                filename = os.path.join(self.save_to_dir, "instance_" + str(self.instance_cnt) + ".dcm")
-                self.dcm_instance.PixelData = PixelData_encoded
+                self.write_instances(file_meta)
+            self.write_stage.join()
+        except BaseException:
+            self.abort_writes()
+            raise
+        finally:
+            self.stop_pool()
+        if self.SPATIAL_INDEX:
+            self.write_spatial_index()
+        if self.metrics is not None:
+            self.metrics.done()
+
+    def start_metrics(self, instance_indices):
+        if self.metrics is not None:
+            self.metrics.schedule = self.schedule
+            self.metrics.start(sum(len(self.frame_items_info_list[idx].locations) for idx in instance_indices),
+                               len(instance_indices))
+
+    # set the tags of an instance and start writing it
+    def open_instance(self, instance_idx, file_meta):
+        frame_items_info = self.frame_items_info_list[instance_idx]
+        self.instance_cnt = instance_idx
+        print("Saving to instance %d/%d" % (self.instance_cnt, len(self.frame_items_info_list)))
+        if self.metrics is not None:
+            self.metrics.instance_start(instance_idx)
+        # elements of this instance, the others are those of the static header
+        ds = Dataset()
+        ds.InstanceNumber = self.instance_cnt
+        ds.SeriesInstanceUID = self.make_UID('1.2.276.0.7230010.3.1.3.296485376.1.1484917433.721085.'+str(frame_items_info.img_level))
+        ds.SeriesNumber = frame_items_info.img_level
+        ds.SOPInstanceUID = self.make_UID('1.2.276.0.7230010.3.1.4.296485376.1.1484917438.721089.' + str(self.instance_cnt))
+        ds.NumberOfFrames = len(frame_items_info.locations)
+        ds.TotalPixelMatrixColumns, ds.TotalPixelMatrixRows = self.level_dimensions[frame_items_info.img_level]
+        if self.tile_source is not None:
+            # frames copied from the source tiles keep the color space of the source, the other frames of the level
+            # are encoded in the same color space, see frame_encoder.encode
+            PhotometricInterpretation = self.tile_source.PhotometricInterpretation(frame_items_info.img_level, frame_items_info.patch_size)
+            if PhotometricInterpretation is not None:
+                ds.PhotometricInterpretation = PhotometricInterpretation
+        encoded_elements = {}
+        with self.timer("functional_groups"):
+            if self.TILED_FULL:
+                self.add_Concatenation_data(instance_idx, ds)
+            elif self.FAST_FRAME_SEQUENCE:
+                encoded_elements[PerFrameFunctionalGroupsSequence_TAG] = self.encode_Frame_Sequence_data(frame_items_info)
+            else:
+                ds.PerFrameFunctionalGroupsSequence = self.add_Frame_Sequence_data(frame_items_info)
+        lossy = get_codec(self.codec).lossy
+        if lossy:
+            ds.LossyImageCompressionRatio = LOSSY_RATIO_PLACEHOLDER   # set from the frame sizes when the instance is closed
+        with self.timer("header"):
+            header = self.header.encode(file_meta, ds, encoded_elements)
+        filename = self.instance_filename(instance_idx)
+
+        def on_close(writer):
+            with self.open_writers_lock:
+                self.open_writers.pop(instance_idx, None)
+            self.checkpoint.done(instance_idx, self.frame_plan_hash(instance_idx), filename, len(frame_items_info.locations),
+                                 writer.frame_offsets, writer.frame_lengths)
+            if self.metrics is not None:
+                self.metrics.instance_done(instance_idx, len(frame_items_info.locations))
+            for sink in self.sinks:
+                sink(filename)
+
+        # stream encoded pixel data into the file, frame by frame
+        writer = instance_writer(filename, header, len(frame_items_info.locations), self.JPEG_COMPRESS,
+                                 frame_length=self.patch_size[0] * self.patch_size[1] * 3, offset_table=self.offset_table,
+                                 on_close=on_close, metrics=self.metrics,
+                                 ratio_pos=lossy_ratio_pos(header, self.IS_IMPLICIT_VR, self.IS_LITTLE_ENDIAN) if lossy else None)
+        with self.open_writers_lock:
+            self.open_writers[instance_idx] = writer
+        return writer
+
+    # close and remove the .partial file of every instance being written, i.e. after an error of the writer thread
+    def abort_open_instances(self, error=None):
+        with self.open_writers_lock:
+            writers, self.open_writers = self.open_writers, {}
+        for instance_idx, writer in sorted(writers.items()):
+            if not writer.fp.closed:
+                print("Instance %d aborted, %d/%d frames written%s" % (instance_idx, writer.frame_cnt, writer.NumberOfFrames,
+                                                                       ": %r" % error if error is not None else ""))
+            writer.abort()
+
+    def instance_filename(self, instance_idx):
+        if self.JPEG_COMPRESS:
+            return os.path.join(self.save_to_dir, "compressed_instance_" + str(instance_idx) + ".dcm")
+        else:
+            return os.path.join(self.save_to_dir, "instance_" + str(instance_idx) + ".dcm")
+
+    def frame_plan_hash(self, instance_idx):
+        frame_items_info = self.frame_items_info_list[instance_idx]
+        return frame_plan_hash(frame_items_info, self.level_dimensions[frame_items_info.img_level])
+
+    # whether the instance was completed by a previous conversion (see checkpoint.py), only when resuming
+    def instance_done(self, instance_idx):
+        return self.checkpoint.is_done(instance_idx, self.frame_plan_hash(instance_idx), self.instance_filename(instance_idx))
+
+    def skip_instance(self, instance_idx):
+        print("Instance %d/%d already converted, skipped" % (instance_idx, len(self.frame_items_info_list)))
+        if self.metrics is not None:
+            self.metrics.instance_done(instance_idx, len(self.frame_items_info_list[instance_idx].locations), skipped=True)
+
+    def write_instance(self, instance_idx, file_meta):
+        if self.instance_done(instance_idx):
+            self.skip_instance(instance_idx)
+            return
+        writer = self.open_instance(instance_idx, file_meta)
+        for frame in self.iter_PixelData(self.frame_items_info_list[instance_idx]):
+            self.write_stage.put(writer.write_frame, frame)
+        self.write_stage.put(writer.close)
+
+    # after an error: drop the queued writes, then abort the instances being written
+    def abort_writes(self):
+        if self.write_stage is not None:
+            self.write_stage.cancel()
+        self.abort_open_instances()
 
-            self.dcm_instance.file_meta = file_meta
-            self.dcm_instance.save_as(filename, write_like_original=False)
-            self.instance_cnt += 1
+    def write_instances(self, file_meta):
+        for instance_idx in range(len(self.frame_items_info_list)):
+            self.write_instance(instance_idx, file_meta)
+        self.instance_cnt = len(self.frame_items_info_list)
+
+    # write only some of the instances (indices into frame_items_info_list), i.e. when the instances of a slide are
+    # spread over multiple processes or machines. Not available with GENERATE_PYRAMID, which needs a single pass
+    def convert_instances(self, instance_indices):
+        if self.GENERATE_PYRAMID:
+            raise Exception("Instances can't be converted separately with GENERATE_PYRAMID")
+        file_meta = self.create_file_meta()
+        self.start_metrics(instance_indices)
+        self.start_pool()
+        try:
+            for instance_idx in instance_indices:
+                self.write_instance(instance_idx, file_meta)
+            self.write_stage.join()
+        except BaseException:
+            self.abort_writes()
+            raise
+        finally:
+            self.stop_pool()
+        if self.metrics is not None:
+            self.metrics.done()
+
+    # save the spatial index of the slide (see spatial_index.py) from the frame plan and the byte ranges of the frames,
+    # recorded in the checkpoint when each instance was written. Every instance should be complete
+    def write_spatial_index(self):
+        records = self.checkpoint.instances
+        missing = [idx for idx in range(len(self.frame_items_info_list)) if "frame_offsets" not in records.get(idx, {})]
+        if missing:
+            raise Exception("Can't write the spatial index, frame byte ranges of instances %s are not recorded" % missing)
+        levels = {}
+        for instance_idx, frame_items_info in enumerate(self.frame_items_info_list):
+            img_lv = frame_items_info.img_level
+            if img_lv not in levels:
+                level_w, level_h = self.level_dimensions[img_lv]
+                level_instances = [info for info in self.frame_items_info_list if info.img_level == img_lv]
+                max_idx = np.max([np.max(info.DimensionIndexValues, axis=0) for info in level_instances], axis=0)
+                grid_size = (max(-(-level_w // self.patch_size[0]), int(max_idx[0])),
+                             max(-(-level_h // self.patch_size[1]), int(max_idx[1])))
+                levels[img_lv] = empty_grid(grid_size)
+            grid = levels[img_lv]
+            record = records[instance_idx]
+            DimensionIndexValues = np.asarray(frame_items_info.DimensionIndexValues, dtype=np.int64)
+            rows, columns = DimensionIndexValues[:, 1] - 1, DimensionIndexValues[:, 0] - 1
+            grid["instance"][rows, columns] = instance_idx
+            grid["frame"][rows, columns] = np.arange(1, len(DimensionIndexValues) + 1)
+            grid["offset"][rows, columns] = record["frame_offsets"]
+            grid["length"][rows, columns] = record["frame_lengths"]
+            grid["flags"][rows, columns] = 0
+        instances = [(records[idx]["filename"], records[idx]["size"]) for idx in range(len(self.frame_items_info_list))]
+        write_spatial_index(os.path.join(self.save_to_dir, SPATIAL_INDEX_FILENAME), get_codec(self.codec).TransferSyntaxUID, instances,
+                            [dict(img_level=img_lv, dimensions=self.level_dimensions[img_lv], tile_size=self.patch_size,
+                                  downsample=self.level_downsamples[img_lv], grid=levels[img_lv]) for img_lv in sorted(levels)])
+
+    # WSI level to read generated level img_level from: the lowest resolution level whose downsample divides the one of
+    # img_level by a power of 2, and that power of 2
+    def pyramid_source_level(self, img_level):
+        ds = int(self.level_downsamples[img_level])
+        for wsi_lv in reversed(range(self.wsi_obj.level_count)):
+            wsi_ds = self.wsi_obj.level_downsamples[wsi_lv]
+            if wsi_ds == int(wsi_ds) and ds % int(wsi_ds) == 0 and (ds // int(wsi_ds)) & (ds // int(wsi_ds) - 1) == 0:
+                return wsi_lv, ds // int(wsi_ds)
+        return 0, ds
+
+    # read the finest image level to convert once and build the lower image levels from it, see pyramid.py
+    def write_pyramid(self, file_meta):
+        org_w, org_h = self.wsi_obj.dimensions
+        levels = sorted(set(self.frame_items_info_list[idx].img_level for idx in range(len(self.frame_items_info_list))
+                            if not self.instance_done(idx)))
+        if not levels:
+            return
+        base = levels[0]
+        grid_sizes = [(-(-org_w // int(self.patch_size[0] * ds)), -(-org_h // int(self.patch_size[1] * ds)))
+                      for ds in self.level_downsamples[base:levels[-1] + 1]]
+        builder = pyramid_builder(grid_sizes, self.patch_size, level_dimensions=self.level_dimensions[base:levels[-1] + 1])
+        step = (int(self.patch_size[0] * self.level_downsamples[base]), int(self.patch_size[1] * self.level_downsamples[base]))
+        # base level patches to read, patches on empty glass are filled with background
+        read_mask = np.ones(grid_sizes[0], dtype=bool)
+        if self.TISSUE_DETECTION:
+            read_mask = tissue_grid(detect_tissue(self.wsi_obj, self.tissue_threshold, self.tissue_mask_size),
+                                    (org_w, org_h), step, grid_sizes[0])
+        background = np.full((self.patch_size[1], self.patch_size[0], 3), 255, dtype=np.uint8)
+        # same order as the frames of each level, see generate_instance_info_list
+        DimensionIndexValues, locations = plan_grid(grid_sizes[0], step, self.TILED_FULL)
+        positions = (DimensionIndexValues - 1).tolist()
+        locations_to_read = locations[read_mask[DimensionIndexValues[:, 0] - 1, DimensionIndexValues[:, 1] - 1]]
+        wsi_lv, factor = self.pyramid_source_level(base)
+        args_list = ((wsi_lv, self.patch_size, locations_to_read[start:start + self.frames_per_task], factor)
+                     for start in range(0, len(locations_to_read), self.frames_per_task))
+        tiles = (tile for images in self.imap(_worker_read, self.frame_encoder.read, args_list) for tile in images)
+
+        level_writers = {}
+        for img_lv in levels:
+            instance_indices = [idx for idx, frame_items_info in enumerate(self.frame_items_info_list) if frame_items_info.img_level == img_lv]
+            level_writers[img_lv] = pyramid_level_writer(self, instance_indices, file_meta)
+        try:
+            for c, r in positions:
+                tile = next(tiles) if read_mask[c, r] else background
+                with self.timer("downsample"):
+                    level_tiles = builder.push(c, r, tile)
+                for lv, column, row, level_tile in [(0, c, r, tile)] + level_tiles:
+                    if base + lv in level_writers:
+                        level_writers[base + lv].add(column, row, level_tile)
+            for level_writer in level_writers.values():
+                level_writer.drain()
+        except BaseException:
+            self.write_stage.cancel()
+            for level_writer in level_writers.values():
+                level_writer.abort()
+            raise
+        self.instance_cnt = len(self.frame_items_info_list)
 
 
 if __name__ == "__main__":
@@ -331,20 +1176,6 @@ if __name__ == "__main__":
     wsi_c = WSIDICOM_Converter(wsi_fn, wsi_dicom_dir, p)
     wsi_c.convert()
 
-    # validate saved dicom
-    fn = os.path.join(wsi_dicom_dir, 'instance_0.dcm')
-    dcm = pydicom.dcmread(fn)
-    img = dcm.pixel_array[0, :, :, :]
-    plt.imshow(img)
-    plt.title("uncompressed")
-    plt.savefig("uncompressed_frame_10.jpg")
-    plt.show()
-
-    fn = os.path.join(wsi_dicom_dir, 'compressed_instance_0.dcm')
-    compressed_dcm = pydicom.dcmread(fn)
-    cmp_img = compressed_dcm.pixel_array[0, :, :, :]
-    plt.imshow(cmp_img)
-    plt.title("compressed")
-    plt.savefig("compressed_frame_10.jpg")
-    plt.show()
-
+    # validate saved dicom: frame counts, offset tables and positions of every instance, 1% of the frames compared to the WSI
+    from WSI_DICOM_Verify import verify_slide
+    verify_slide(wsi_fn, wsi_dicom_dir, p, sample_rate=0.01)
@@ -0,0 +1,307 @@
+import os
+import sys
+import mmap
+import glob
+import struct
+import threading
+from collections import OrderedDict
+import numpy as np
+import pydicom
+from PIL import Image
+from frame_codecs import CODECS
+from spatial_index import SPATIAL_INDEX_FILENAME, spatial_index
+'''
+Random access to the frames of the multi-frame Dicom instances of a converted slide.
+When the reader is opened, the instances are indexed: for each image level, a (row, column) grid of the file,
+byte offset and length of the frame at that grid position. It is built from the frame positions (per-frame functional
+groups, or the frame order for TILED_FULL) and the item headers of the encapsulated pixel data, pixel data itself is
+never read. If the converter saved a spatial index (see spatial_index.py), it is loaded instead, without opening the
+instances. Frames are then read from memory-mapped files and decoded one at a time, with an LRU cache of decoded tiles.
+Usage:
+    reader = WSIDICOM_Reader("/path/to/converted/slide")
+    tile = reader.read_tile(0, column, row)   # (rows, columns, 3) uint8 array
+    region = reader.read_region((x, y), level, (width, height))   # location in level 0 pixels, like OpenSlide
+'''
+
+ITEM_TAG = 0xE000FFFE   # (FFFE,E000) read as a little endian uint32
+SEQUENCE_DELIMITER_TAG = 0xE0DDFFFE
+
+
+class level_index:
+    def __init__(self, dimensions, tile_size):
+        '''
+        frames of one image level
+        :param dimensions: (width, height) of the level, TotalPixelMatrixColumns/Rows
+        :param tile_size: (width, height) of frames
+        '''
+        self.dimensions = dimensions
+        self.tile_size = tile_size
+        self.grid_size = (-(-dimensions[0] // tile_size[0]), -(-dimensions[1] // tile_size[1]))   # (columns, rows)
+        shape = (self.grid_size[1], self.grid_size[0])
+        self.file_idx = np.full(shape, -1, dtype=np.int32)   # -1: no frame (i.e. empty glass skipped in TILED_SPARSE)
+        self.offset = np.zeros(shape, dtype=np.int64)
+        self.length = np.zeros(shape, dtype=np.int64)
+        self.downsample = 1.0
+
+
+# downsample of each level, largest first, from the dimensions as OpenSlide level_downsamples. Instances don't tell the
+# downsample from the source level 0: if it wasn't converted, downsamples are relative to the largest converted level.
+# The spatial index records the downsamples of the source, they are used instead when it's loaded
+def set_level_downsamples(levels):
+    for level in levels:
+        level.downsample = (levels[0].dimensions[0] / level.dimensions[0] + levels[0].dimensions[1] / level.dimensions[1]) / 2
+
+
+# byte ranges of the frames of an encapsulated pixel data element, each starting at the header of its first item
+def encapsulated_frames(mm, value_pos, NumberOfFrames, offset_table=None):
+    tag, length = struct.unpack_from("<II", mm, value_pos)
+    if tag != ITEM_TAG:
+        raise Exception("Basic Offset Table item expected at %d" % value_pos)
+    first_item_pos = value_pos + 8 + length
+    if offset_table is None and length > 0:
+        offset_table = np.frombuffer(mm, dtype="<u4", count=length // 4, offset=value_pos + 8)
+    # walk the item headers, only 8 bytes are read per item
+    items = []
+    pos = first_item_pos
+    while True:
+        tag, length = struct.unpack_from("<II", mm, pos)
+        if tag == SEQUENCE_DELIMITER_TAG:
+            break
+        if tag != ITEM_TAG:
+            raise Exception("Item expected at %d" % pos)
+        items.append(pos)
+        pos += 8 + length
+    end_pos = pos
+    if offset_table is not None and len(offset_table) == NumberOfFrames:
+        starts = first_item_pos + np.asarray(offset_table, dtype=np.int64)
+    elif len(items) == NumberOfFrames:
+        starts = np.asarray(items, dtype=np.int64)   # one fragment per frame
+    else:
+        raise Exception("%d fragments for %d frames, and no offset table" % (len(items), NumberOfFrames))
+    ends = np.append(starts[1:], end_pos)
+    return starts, ends - starts
+
+
+# value of each fragment (item) in a byte range, joined
+def join_fragments(data):
+    fragments = []
+    pos = 0
+    while pos + 8 <= len(data):
+        tag, length = struct.unpack_from("<II", data, pos)
+        fragments.append(data[pos + 8:pos + 8 + length])
+        pos += 8 + length
+    return fragments[0] if len(fragments) == 1 else b"".join(fragments)
+
+
+class WSIDICOM_Reader:
+    def __init__(self, dicom_dir, cache_size=256, background=255, use_spatial_index=True):
+        '''
+        :param dicom_dir: directory of the Dicom instances of one slide, as written by WSIDICOM_Converter
+        :param cache_size: number of decoded tiles kept in memory, 0 to disable the cache
+        :param background: value of pixels without any frame
+        :param use_spatial_index: load the spatial index saved by the converter if it matches the instances,
+        otherwise the index is built from the instances
+        '''
+        self.dicom_dir = dicom_dir
+        self.cache_size = cache_size
+        self.background = background
+        self.files = []   # per file: [file name, codec, items], items: frame byte ranges hold the items of encapsulated pixel data
+        self.mmaps = {}
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()   # (level, column, row) -> decoded tile
+        self.spatial_index = None
+        # whether level_downsamples and read_region locations refer to level 0 of the source slide, as in OpenSlide,
+        # even if it wasn't converted. Only known from the spatial index, otherwise they refer to the largest converted level
+        self.source_downsamples = False
+        index_fn = os.path.join(dicom_dir, SPATIAL_INDEX_FILENAME)
+        if use_spatial_index and os.path.exists(index_fn):
+            self.spatial_index = spatial_index(index_fn)
+            if not self.spatial_index.is_current():
+                self.spatial_index.close()
+                self.spatial_index = None
+        if self.spatial_index is not None:
+            self.levels = self._load_spatial_index(self.spatial_index)
+        else:
+            self.levels = self._build_index(sorted(glob.glob(os.path.join(dicom_dir, "*.dcm"))))
+        if not self.levels:
+            raise Exception("No multi-frame instance found in %s" % dicom_dir)
+
+    @property
+    def level_dimensions(self):
+        return [level.dimensions for level in self.levels]
+
+    @property
+    def level_downsamples(self):
+        return [level.downsample for level in self.levels]
+
+    # levels from the record grids of a spatial index, arrays are views into the index file
+    def _load_spatial_index(self, index):
+        codec = [c for c in CODECS.values() if c.TransferSyntaxUID == index.TransferSyntaxUID]
+        if not codec:
+            raise Exception("Unsupported transfer syntax %s in %s" % (index.TransferSyntaxUID, index.filename))
+        self.files = [[os.path.join(self.dicom_dir, instance["filename"]), codec[0], False] for instance in index.instances]
+        levels = []
+        for level_header, grid in zip(index.levels, index.grids):
+            level = level_index(tuple(level_header["dimensions"]), tuple(level_header["tile_size"]))
+            level.grid_size = tuple(level_header["grid_size"])
+            level.file_idx = grid["instance"]
+            level.offset = grid["offset"]
+            level.length = grid["length"]
+            level.downsample = float(level_header["downsample"])
+            levels.append(level)
+        self.source_downsamples = True
+        return levels
+
+    def _build_index(self, filenames):
+        levels = {}   # (width, height) -> level_index
+        for filename in filenames:
+            with open(filename, "rb") as fp:
+                ds = pydicom.dcmread(fp, stop_before_pixels=True)
+                pixel_data_pos = fp.tell()
+            if "NumberOfFrames" not in ds or "TotalPixelMatrixColumns" not in ds:
+                continue
+            codec = [c for c in CODECS.values() if c.TransferSyntaxUID == ds.file_meta.TransferSyntaxUID]
+            if not codec:
+                raise Exception("Unsupported transfer syntax %s in %s" % (ds.file_meta.TransferSyntaxUID, filename))
+            dimensions = (int(ds.TotalPixelMatrixColumns), int(ds.TotalPixelMatrixRows))
+            tile_size = (int(ds.Columns), int(ds.Rows))
+            level = levels.setdefault(dimensions, level_index(dimensions, tile_size))
+            if level.tile_size != tile_size:
+                raise Exception("Frames of %s are %dx%d, other frames of the level are %dx%d" % ((filename,) + tile_size + level.tile_size))
+            NumberOfFrames = int(ds.NumberOfFrames)
+            columns, rows = self._frame_positions(ds, NumberOfFrames, level)
+            file_idx = len(self.files)
+            mm = self._mmap(file_idx, filename)
+            element = struct.unpack_from("<HH", mm, pixel_data_pos)
+            if element != (0x7FE0, 0x0010):
+                raise Exception("Pixel Data expected at %d in %s" % (pixel_data_pos, filename))
+            implicit_VR = ds.file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian
+            if implicit_VR:
+                value_length = struct.unpack_from("<I", mm, pixel_data_pos + 4)[0]
+                value_pos = pixel_data_pos + 8
+            else:
+                value_length = struct.unpack_from("<I", mm, pixel_data_pos + 8)[0]
+                value_pos = pixel_data_pos + 12
+            encapsulated = value_length == 0xFFFFFFFF
+            if encapsulated:
+                offset_table = None
+                if "ExtendedOffsetTable" in ds:
+                    offset_table = np.frombuffer(ds.ExtendedOffsetTable, dtype="<u8")
+                offsets, lengths = encapsulated_frames(mm, value_pos, NumberOfFrames, offset_table)
+            else:
+                frame_length = tile_size[0] * tile_size[1] * int(ds.SamplesPerPixel)
+                offsets = value_pos + np.arange(NumberOfFrames, dtype=np.int64) * frame_length
+                lengths = np.full(NumberOfFrames, frame_length, dtype=np.int64)
+            self.files.append([filename, codec[0], encapsulated])
+            level.file_idx[rows, columns] = file_idx
+            level.offset[rows, columns] = offsets
+            level.length[rows, columns] = lengths
+        ordered = sorted(levels.values(), key=lambda level: -level.dimensions[0])
+        set_level_downsamples(ordered)
+        return ordered
+
+    # (columns, rows) grid positions of the frames of an instance
+    def _frame_positions(self, ds, NumberOfFrames, level):
+        if "PerFrameFunctionalGroupsSequence" in ds:
+            positions = np.array([[item.PlanePositionSlideSequence[0].ColumnPositionInTotalImagePixelMatrix,
+                                   item.PlanePositionSlideSequence[0].RowPositionInTotalImagePixelMatrix]
+                                  for item in ds.PerFrameFunctionalGroupsSequence], dtype=np.int64)
+            # positions are not always multiples of the tile size on levels with a non-integer downsample, see
+            # add_Frame_Sequence_data, so the nearest grid position is taken
+            return ((positions[:, 0] - 1 + level.tile_size[0] // 2) // level.tile_size[0],
+                    (positions[:, 1] - 1 + level.tile_size[1] // 2) // level.tile_size[1])
+        # TILED_FULL: frames in row-major order, continuing the previous instances of a concatenation
+        frame_idx = int(ds.get("ConcatenationFrameOffsetNumber", 0)) + np.arange(NumberOfFrames)
+        return frame_idx % level.grid_size[0], frame_idx // level.grid_size[0]
+
+    def _mmap(self, file_idx, filename):
+        if file_idx not in self.mmaps:
+            with open(filename, "rb") as fp:
+                self.mmaps[file_idx] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmaps[file_idx]
+
+    # encoded frame at a grid position of a level, None if there is no frame there
+    def read_frame(self, level, column, row):
+        index = self.levels[level]
+        if not (0 <= column < index.grid_size[0] and 0 <= row < index.grid_size[1]):
+            return None
+        file_idx = int(index.file_idx[row, column])
+        if file_idx < 0:
+            return None
+        filename, codec, items = self.files[file_idx]
+        offset = int(index.offset[row, column])
+        data = self._mmap(file_idx, filename)[offset:offset + int(index.length[row, column])]
+        return join_fragments(data) if items else data
+
+    # decoded frame at a grid position of a level, (rows, columns, 3) uint8 array, background if there is no frame
+    def read_tile(self, level, column, row):
+        key = (level, column, row)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        index = self.levels[level]
+        data = self.read_frame(level, column, row)
+        if data is None:
+            tile = np.full((index.tile_size[1], index.tile_size[0], 3), self.background, dtype=np.uint8)
+        else:
+            tile = self.files[int(index.file_idx[row, column])][1].decode(data, index.tile_size)
+        tile.flags.writeable = False   # shared through the cache
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[key] = tile
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return tile
+
+    def read_region(self, location, level, size):
+        '''
+        read a region, only the tiles it overlaps are decoded
+        :param location: (x, y) top left corner of the region, in level 0 pixels (as OpenSlide read_region). The region
+        starts at pixel floor(location / downsample) of the level, there is no sub-pixel resampling
+        :param level: image level
+        :param size: (width, height) of the region, in pixels of the level
+        :return: (height, width, 3) uint8 array
+        '''
+        index = self.levels[level]
+        x0 = int(location[0] // index.downsample)
+        y0 = int(location[1] // index.downsample)
+        w, h = size
+        tw, th = index.tile_size
+        region = np.full((h, w, 3), self.background, dtype=np.uint8)
+        for row in range(max(y0 // th, 0), min((y0 + h - 1) // th + 1, index.grid_size[1])):
+            for column in range(max(x0 // tw, 0), min((x0 + w - 1) // tw + 1, index.grid_size[0])):
+                if index.file_idx[row, column] < 0:
+                    continue
+                tile = self.read_tile(level, column, row)
+                # intersection of the tile and the region, in level pixels
+                left, top = max(column * tw, x0), max(row * th, y0)
+                right, bottom = min((column + 1) * tw, x0 + w), min((row + 1) * th, y0 + h)
+                region[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile[top - row * th:bottom - row * th, left - column * tw:right - column * tw]
+        return region
+
+    def close(self):
+        for mm in self.mmaps.values():
+            mm.close()
+        self.mmaps = {}
+        self.cache.clear()
+        if self.spatial_index is not None:
+            self.levels = []   # views into the index file
+            self.spatial_index.close()
+            self.spatial_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    # python WSI_DICOM_Reader.py dicom_dir level x y width height output.png
+    dicom_dir, level, x, y, width, height, output_fn = sys.argv[1:8]
+    with WSIDICOM_Reader(dicom_dir) as reader:
+        for lv, (dimensions, downsample) in enumerate(zip(reader.level_dimensions, reader.level_downsamples)):
+            print("level %d: %dx%d, downsample %.2f" % (lv, dimensions[0], dimensions[1], downsample))
+        Image.fromarray(reader.read_region((int(x), int(y)), int(level), (int(width), int(height)))).save(output_fn)
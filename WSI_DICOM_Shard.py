@@ -0,0 +1,332 @@
+import os
+import sys
+import copy
+import glob
+import json
+import time
+import pickle
+import argparse
+import datetime
+import subprocess
+import pydicom
+from WSI_DICOM_Converter import WSIDICOM_Converter
+from WSI_DICOM_Batch import add_parameter_arguments, parameters_from_args
+from checkpoint import CHECKPOINT_FILENAME, RUNTIME_PARAMETERS, conversion_checkpoint, parameters_record, record_hash
+'''
+Convert one giant slide on several machines sharing a filesystem, without any broker.
+The instances of a slide are independent (see frame_items_info_list), so they are split into shards of consecutive
+instances with about the same number of frames:
+    plan:     the coordinator plans the frames once and saves the frame plan into the output directory
+    work:     each node converts one shard (or any range of instances) into the output directory, each shard records
+              its completed instances in its own checkpoint file, so nodes never write to the same file
+    finalize: once all the shards are done, checks that every planned instance is there, complete and consistent
+              (one study, one series per level, unique SOPInstanceUIDs, frame counts), merges the shard checkpoints
+              and writes the spatial index
+A shard that failed or was interrupted is simply run again, its completed instances are skipped.
+Usage:
+    python WSI_DICOM_Shard.py plan /shared/slide.svs /shared/output --shards 8 --tissue-detection
+    python WSI_DICOM_Shard.py work /shared/output --shard 3 --workers 16     # on each node, shard 0 to 7
+    python WSI_DICOM_Shard.py finalize /shared/output --report report.json
+or, to simulate the nodes with local processes:
+    python WSI_DICOM_Shard.py local /path/to/slide.svs /path/to/output --shards 4
+'''
+
+PLAN_FILENAME = "shard_plan.json"   # manifest of the plan: slide, parameters, shards and instances
+PLAN_DATA_FILENAME = "shard_plan.pickle"   # parameters and frame plan, loaded by the workers
+SHARD_CHECKPOINT_FILENAME = "shard_checkpoint_%d_%d.jsonl"   # checkpoint of the instances [start, stop) of a shard
+
+
+# split instances into shards of consecutive instances, with about the same number of frames
+def split_shards(frames, shards):
+    '''
+    :param frames: number of frames of each instance
+    :param shards: number of shards
+    :return: [(start, stop), ...] instance range of each shard, no more shards than instances
+    '''
+    shards = max(1, min(shards, len(frames)))
+    total = float(sum(frames))
+    ranges = []
+    start = 0
+    cumulated = 0
+    for idx, count in enumerate(frames):
+        cumulated += count
+        # cut when the shard reaches its share, leaving at least one instance for each of the next shards
+        if len(ranges) < shards - 1 and (cumulated >= total * (len(ranges) + 1) / shards or
+                                         len(frames) - idx - 1 == shards - len(ranges) - 1):
+            ranges.append((start, idx + 1))
+            start = idx + 1
+    ranges.append((start, len(frames)))
+    return ranges
+
+
+# write a file atomically, so workers never read a partial plan
+def _write_atomic(filename, data):
+    with open(filename + ".partial", "wb") as fp:
+        fp.write(data)
+    os.replace(filename + ".partial", filename)
+
+
+def plan_shards(wsi_fn, save_to_dir, p, shards):
+    '''
+    plan the frames of a slide and split its instances into shards, run once by the coordinator
+    :param wsi_fn: file name of the slide, on the shared filesystem
+    :param save_to_dir: output directory, on the shared filesystem
+    :param p: conversion parameters, see class parameters. UIDs are derived from the slide path if p.UID_seed is None,
+    like in a batch. With p.resume, instances completed by previous runs with the same plan are kept
+    :param shards: number of shards
+    :return: the plan, as saved into PLAN_FILENAME
+    '''
+    if p.GENERATE_PYRAMID or p.incremental:
+        raise Exception("Sharded conversion can't be used with GENERATE_PYRAMID or incremental conversion")
+    wsi_fn = os.path.abspath(wsi_fn)
+    p = copy.copy(p)
+    if p.UID_seed is None:
+        p.UID_seed = wsi_fn
+    converter = WSIDICOM_Converter(wsi_fn, save_to_dir, p)
+    converter.wsi_obj.close()
+    converter.checkpoint.start(p.resume)   # removes the partial instances of an interrupted run, no worker runs yet
+    if not p.resume:
+        for fn in glob.glob(os.path.join(save_to_dir, SHARD_CHECKPOINT_FILENAME.replace("%d", "*"))):
+            os.remove(fn)
+    frame_plan = converter.frame_items_info_list
+    frames = [len(info.locations) for info in frame_plan]
+    record = parameters_record(p)
+    plan = {"slide": wsi_fn,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "parameters": record,
+            "parameters_hash": record_hash(record),
+            "shards": [list(r) for r in split_shards(frames, shards)],
+            "instances": [{"filename": os.path.basename(converter.instance_filename(idx)), "img_level": int(info.img_level),
+                           "frames": frames[idx], "plan_hash": converter.frame_plan_hash(idx)}
+                          for idx, info in enumerate(frame_plan)]}
+    # the data first: a worker finding the manifest always finds the matching frame plan
+    _write_atomic(os.path.join(save_to_dir, PLAN_DATA_FILENAME),
+                  pickle.dumps({"parameters": p, "frame_plan": frame_plan}, protocol=pickle.HIGHEST_PROTOCOL))
+    _write_atomic(os.path.join(save_to_dir, PLAN_FILENAME), json.dumps(plan, indent=1).encode())
+    print("Planned %d instances, %d frames, into %d shards:" % (len(frames), sum(frames), len(plan["shards"])))
+    for shard_idx, (start, stop) in enumerate(plan["shards"]):
+        print("  shard %d: instances %d to %d, %d frames" % (shard_idx, start, stop - 1, sum(frames[start:stop])))
+    return plan
+
+
+# the plan of an output directory, and its parameters and frame plan, checked against each other
+def load_plan(save_to_dir):
+    plan_fn = os.path.join(save_to_dir, PLAN_FILENAME)
+    if not os.path.exists(plan_fn):
+        raise Exception("No shard plan in %s, run the plan step first" % save_to_dir)
+    with open(plan_fn) as fp:
+        plan = json.load(fp)
+    with open(os.path.join(save_to_dir, PLAN_DATA_FILENAME), "rb") as fp:
+        data = pickle.load(fp)
+    if record_hash(parameters_record(data["parameters"])) != plan["parameters_hash"] or \
+            len(data["frame_plan"]) != len(plan["instances"]):
+        raise Exception("Frame plan of %s doesn't match %s, run the plan step again" % (save_to_dir, PLAN_FILENAME))
+    return plan, data["parameters"], data["frame_plan"]
+
+
+# records of the completed instances, from the shard checkpoints and the checkpoint merged by finalize
+def completed_instances(save_to_dir, p):
+    instances = {}
+    filenames = [CHECKPOINT_FILENAME] + sorted(os.path.basename(fn) for fn in glob.glob(
+        os.path.join(save_to_dir, SHARD_CHECKPOINT_FILENAME.replace("%d", "*"))))
+    for fn in filenames:
+        for instance_idx, record in conversion_checkpoint(save_to_dir, p, fn).instances.items():
+            instances.setdefault(instance_idx, []).append(record)
+    return instances
+
+
+def work_shard(save_to_dir, shard=None, instance_range=None, runtime_parameters=None, wsi_fn=None):
+    '''
+    convert a shard of the plan, on one node
+    :param save_to_dir: output directory holding the plan
+    :param shard: index of the shard in the plan
+    :param instance_range: (start, stop) range of instances to convert, instead of a shard of the plan
+    :param runtime_parameters: parameters which don't change the output, for this node, i.e. {"workers": 16}
+    :param wsi_fn: file name of the slide on this node, if the shared filesystem is mounted elsewhere than on the coordinator
+    :return: {"instances": [start, stop], "frames": frames converted, "seconds": ...}
+    '''
+    plan, p, frame_plan = load_plan(save_to_dir)
+    if instance_range is None:
+        if shard is None or not 0 <= shard < len(plan["shards"]):
+            raise Exception("Shard should be between 0 and %d" % (len(plan["shards"]) - 1))
+        instance_range = plan["shards"][shard]
+    start, stop = instance_range
+    if not 0 <= start < stop <= len(frame_plan):
+        raise Exception("Instance range should be within [0, %d)" % len(frame_plan))
+    for key, value in (runtime_parameters or {}).items():
+        if key not in RUNTIME_PARAMETERS:
+            raise Exception("%s changes the output, it can only be set in the plan" % key)
+        setattr(p, key, value)
+    begin = time.time()
+    converter = WSIDICOM_Converter(wsi_fn or plan["slide"], save_to_dir, p, frame_plan=frame_plan)
+    # same slide and same plan as the coordinator, i.e. not another version of the slide or of OpenSlide
+    for instance_idx in range(start, stop):
+        if converter.frame_plan_hash(instance_idx) != plan["instances"][instance_idx]["plan_hash"]:
+            raise Exception("Frame plan of instance %d doesn't match the slide on this node" % instance_idx)
+    # instances are recorded into the checkpoint of the shard, completed instances of any shard are skipped
+    checkpoint = conversion_checkpoint(save_to_dir, p, SHARD_CHECKPOINT_FILENAME % (start, stop))
+    checkpoint.start(True, remove_partial=False)
+    for instance_idx, records in completed_instances(save_to_dir, p).items():
+        checkpoint.instances.setdefault(instance_idx, records[-1])
+    converter.checkpoint = checkpoint
+    converter.convert_instances(range(start, stop))
+    converter.wsi_obj.close()
+    frames = sum(len(frame_plan[idx].locations) for idx in range(start, stop))
+    seconds = time.time() - begin
+    print("Converted instances %d to %d: %d frames in %.1f s" % (start, stop - 1, frames, seconds))
+    return {"instances": [start, stop], "frames": frames, "seconds": round(seconds, 3)}
+
+
+# UIDs and frame counts of the instances, whichever node wrote them: problems found, [str, ...]
+def check_instances(save_to_dir, plan, instance_indices):
+    problems = []
+    studies, frames_of_reference, sop_instances = set(), set(), {}
+    level_series = {}   # image level -> SeriesInstanceUIDs
+    for instance_idx in instance_indices:
+        planned = plan["instances"][instance_idx]
+        ds = pydicom.dcmread(os.path.join(save_to_dir, planned["filename"]), stop_before_pixels=True, specific_tags=[
+            "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "FrameOfReferenceUID", "InstanceNumber", "NumberOfFrames"])
+        studies.add(ds.get("StudyInstanceUID"))
+        frames_of_reference.add(ds.get("FrameOfReferenceUID"))
+        level_series.setdefault(planned["img_level"], set()).add(ds.get("SeriesInstanceUID"))
+        sop_instances.setdefault(ds.get("SOPInstanceUID"), []).append(instance_idx)
+        if int(ds.get("NumberOfFrames", 0)) != planned["frames"]:
+            problems.append("instance %d has %s frames, %d planned" % (instance_idx, ds.get("NumberOfFrames"), planned["frames"]))
+        if ds.get("InstanceNumber") != instance_idx:
+            problems.append("instance %d has InstanceNumber %s" % (instance_idx, ds.get("InstanceNumber")))
+    if len(studies) > 1:
+        problems.append("instances belong to %d studies" % len(studies))
+    if len(frames_of_reference) > 1:
+        problems.append("instances have %d frames of reference" % len(frames_of_reference))
+    for img_lv, series in sorted(level_series.items()):
+        if len(series) > 1:
+            problems.append("instances of level %d belong to %d series" % (img_lv, len(series)))
+    all_series = [uid for series in level_series.values() for uid in series]
+    if len(set(all_series)) != len(all_series):
+        problems.append("levels share a series")
+    for uid, indices in sop_instances.items():
+        if len(indices) > 1:
+            problems.append("instances %s have the same SOPInstanceUID %s" % (indices, uid))
+    return problems
+
+
+def finalize(save_to_dir, report_fn=None):
+    '''
+    check that all the shards are complete and consistent, then merge their checkpoints and write the spatial index.
+    Nothing is written if an instance is missing or inconsistent
+    :param save_to_dir: output directory holding the plan
+    :param report_fn: save the report into this json file
+    :return: report, {"status": "done" or "failed", "missing": [instance indices], "problems": [str, ...], ...}
+    '''
+    plan, p, frame_plan = load_plan(save_to_dir)
+    records = {}
+    for instance_idx, candidates in completed_instances(save_to_dir, p).items():
+        if instance_idx >= len(plan["instances"]):
+            continue
+        planned = plan["instances"][instance_idx]
+        filename = os.path.join(save_to_dir, planned["filename"])
+        for record in candidates:
+            if record["plan_hash"] == planned["plan_hash"] and record["filename"] == planned["filename"] and \
+                    os.path.exists(filename) and os.path.getsize(filename) == record["size"]:
+                records[instance_idx] = record
+    missing = [idx for idx in range(len(plan["instances"])) if idx not in records]
+    problems = check_instances(save_to_dir, plan, sorted(records))
+    planned_files = set(instance["filename"] for instance in plan["instances"])
+    unexpected = sorted(fn for fn in os.listdir(save_to_dir) if fn.endswith(".dcm") and fn not in planned_files)
+    if unexpected:
+        problems.append("instances not in the plan: %s" % ", ".join(unexpected))
+    partial = sorted(fn for fn in os.listdir(save_to_dir) if fn.endswith(".dcm.partial"))
+    if partial:
+        problems.append("instances still being written: %s" % ", ".join(partial))
+    shard_status = []
+    for shard_idx, (start, stop) in enumerate(plan["shards"]):
+        done = sum(1 for idx in range(start, stop) if idx in records)
+        shard_status.append({"shard": shard_idx, "instances": [start, stop], "done": done,
+                             "status": "done" if done == stop - start else "incomplete"})
+    report = {"slide": plan["slide"], "output": save_to_dir, "status": "failed" if missing or problems else "done",
+              "instances": len(plan["instances"]), "frames": sum(instance["frames"] for instance in plan["instances"]),
+              "bytes": sum(record["size"] for record in records.values()),
+              "missing": missing, "problems": problems, "shards": shard_status}
+    if report["status"] == "done":
+        # one checkpoint for the whole slide, as after a conversion on a single machine
+        checkpoint = conversion_checkpoint(save_to_dir, p)
+        checkpoint.start(False, remove_partial=False)
+        for instance_idx in range(len(plan["instances"])):
+            record = records[instance_idx]
+            checkpoint.done(instance_idx, record["plan_hash"], os.path.join(save_to_dir, record["filename"]), record["frames"],
+                            record.get("frame_offsets"), record.get("frame_lengths"))
+        if p.SPATIAL_INDEX:
+            converter = WSIDICOM_Converter(plan["slide"], save_to_dir, p, frame_plan=frame_plan)
+            converter.wsi_obj.close()
+            converter.checkpoint = checkpoint
+            converter.write_spatial_index()
+        for fn in glob.glob(os.path.join(save_to_dir, SHARD_CHECKPOINT_FILENAME.replace("%d", "*"))):
+            os.remove(fn)
+    for status in shard_status:
+        print("shard %d: %d/%d instances" % (status["shard"], status["done"], status["instances"][1] - status["instances"][0]))
+    if missing:
+        print("Missing instances: %s" % missing)
+    for problem in problems:
+        print("Problem: %s" % problem)
+    print("%s: %d instances, %d frames, %.1f MB" % (report["status"], report["instances"], report["frames"], report["bytes"] / 1e6))
+    if report_fn is not None:
+        with open(report_fn, "w") as fp:
+            json.dump(report, fp, indent=2)
+    return report
+
+
+def run_local(wsi_fn, save_to_dir, p, shards, workers_per_shard=1, report_fn=None):
+    '''
+    plan, convert each shard in its own process as if on its own node, and finalize. For tests and single machines
+    :return: report of finalize
+    '''
+    plan = plan_shards(wsi_fn, save_to_dir, p, shards)
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "work", save_to_dir, "--shard", str(shard_idx),
+                                   "--workers", str(workers_per_shard)]) for shard_idx in range(len(plan["shards"]))]
+    failed = [shard_idx for shard_idx, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print("Shards %s failed" % failed)
+    return finalize(save_to_dir, report_fn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a whole slide image into DICOM on several nodes sharing a filesystem")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="plan the frames and split the instances into shards")
+    local_parser = commands.add_parser("local", help="plan, convert each shard in a local process and finalize")
+    for command_parser in (plan_parser, local_parser):
+        command_parser.add_argument("slide", help="file name of the slide")
+        command_parser.add_argument("output", help="output directory, shared by all the nodes")
+        command_parser.add_argument("--shards", type=int, required=True, help="number of shards")
+        add_parameter_arguments(command_parser)
+    local_parser.add_argument("--workers", type=int, default=1, help="number of workers of each shard")
+    local_parser.add_argument("--report", default=None, help="save the report of finalize into this json file")
+    work_parser = commands.add_parser("work", help="convert a shard of the plan")
+    work_parser.add_argument("output", help="output directory holding the plan")
+    work_parser.add_argument("--shard", type=int, default=None, help="index of the shard in the plan")
+    work_parser.add_argument("--range", type=int, nargs=2, default=None, metavar=("START", "STOP"),
+                             help="convert the instances START to STOP - 1 instead of a shard")
+    work_parser.add_argument("--workers", type=int, default=None, help="number of workers on this node")
+    work_parser.add_argument("--slide", default=None, help="file name of the slide on this node, if not the planned one")
+    finalize_parser = commands.add_parser("finalize", help="check the shards, merge their checkpoints and write the spatial index")
+    finalize_parser.add_argument("output", help="output directory holding the plan")
+    finalize_parser.add_argument("--report", default=None, help="save the report into this json file")
+    args = parser.parse_args(argv)
+
+    if args.command == "plan":
+        plan_shards(args.slide, args.output, parameters_from_args(args), args.shards)
+        return 0
+    if args.command == "work":
+        if (args.shard is None) == (args.range is None):
+            parser.error("work needs either --shard or --range")
+        work_shard(args.output, args.shard, args.range, {} if args.workers is None else {"workers": args.workers}, args.slide)
+        return 0
+    if args.command == "finalize":
+        report = finalize(args.output, args.report)
+    else:
+        report = run_local(args.slide, args.output, parameters_from_args(args), args.shards, args.workers, args.report)
+    return 0 if report["status"] == "done" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
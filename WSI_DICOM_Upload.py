@@ -0,0 +1,363 @@
+import os
+import ssl
+import sys
+import time
+import uuid
+import json
+import asyncio
+import argparse
+import threading
+import urllib.parse
+try:
+    import pynetdicom   # optional, only needed for C-STORE
+except ImportError:
+    pynetdicom = None
+'''
+Upload converted instances to a PACS while the conversion goes on, so slide-to-PACS time is about the longer of
+encoding and uploading instead of their sum.
+stow_uploader sends instances with DICOMweb STOW-RS (one multipart/related request per instance). Requests run on an
+asyncio event loop in a background thread, over a pool of keep-alive HTTP connections. Files are streamed from disk in
+chunks, so memory doesn't grow with instance size, and at most max_pending instances are queued: submit() blocks when
+the queue is full, which slows the conversion down to the upload speed. Failed requests (connection errors, 408, 429
+and 5xx responses) are retried with exponential backoff.
+cstore_uploader does the same with DIMSE C-STORE, on one association, it requires pynetdicom.
+Usage:
+    with stow_uploader("http://localhost:8042/dicom-web") as uploader:
+        converter.add_sink(uploader.submit)
+        converter.convert()
+    print(uploader.report())
+or, for instances already on disk:
+    python WSI_DICOM_Upload.py http://localhost:8042/dicom-web /path/to/converted/slide
+'''
+
+CHUNK_SIZE = 1 << 20
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+class upload_error(Exception):
+    def __init__(self, message, retry):
+        super().__init__(message)
+        self.retry = retry   # whether the request may succeed if sent again
+
+
+class http_connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class stow_uploader:
+    def __init__(self, url, max_connections=4, max_pending=16, retries=3, retry_delay=1.0, timeout=300,
+                 headers=None, delete=False, ssl_context=None):
+        '''
+        :param url: DICOMweb service root, i.e. http://localhost:8042/dicom-web, instances are posted to url/studies
+        :param max_connections: number of concurrent requests, each on its own keep-alive connection
+        :param max_pending: maximum number of instances submitted and not uploaded yet, submit() blocks beyond
+        :param retries: number of times a failed request is sent again
+        :param retry_delay: seconds before the first retry, doubled at each retry
+        :param timeout: seconds without progress before a request fails
+        :param headers: additional HTTP headers, i.e. {"Authorization": "Bearer ..."}
+        :param delete: remove each instance file once it is uploaded
+        :param ssl_context: ssl.SSLContext for https, if None the default context
+        '''
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https"):
+            raise Exception("STOW-RS url should start with http:// or https://, got %s" % url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.ssl = (ssl_context or ssl.create_default_context()) if parsed.scheme == "https" else None
+        self.path = parsed.path.rstrip("/") + "/studies"
+        self.host_header = parsed.netloc.rsplit("@", 1)[-1]
+        self.max_connections = max_connections
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.delete = delete
+        self.results = []   # one dict per submitted instance, see report()
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.idle = []   # idle keep-alive connections
+        self.slots = None   # asyncio.Semaphore of max_connections, created in the loop
+        self.closed = False
+
+    # queue an instance file for upload, blocks while max_pending instances are waiting
+    def submit(self, filename):
+        if self.closed:
+            raise Exception("Uploader is closed")
+        self.pending.acquire()
+        self.futures.append(asyncio.run_coroutine_threadsafe(self._upload(filename), self.loop))
+
+    # wait for all the submitted instances, then close the connections
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.futures:
+            future.result()
+        asyncio.run_coroutine_threadsafe(self._close_connections(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def report(self):
+        failed = [r for r in self.results if r["status"] != "uploaded"]
+        seconds = sum(r["seconds"] for r in self.results)
+        uploaded_bytes = sum(r["bytes"] for r in self.results if r["status"] == "uploaded")
+        return {"instances": len(self.results), "failed": len(failed), "bytes": uploaded_bytes,
+                "request_seconds": round(seconds, 3), "errors": [(r["filename"], r["error"]) for r in failed]}
+
+    async def _close_connections(self):
+        while self.idle:
+            self.idle.pop().close()
+
+    async def _connection(self):
+        if self.idle:
+            return self.idle.pop()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+        return http_connection(reader, writer)
+
+    async def _upload(self, filename):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        result = {"filename": filename, "status": "failed", "attempts": 0, "seconds": 0.0, "bytes": 0, "error": None}
+        self.results.append(result)
+        try:
+            async with self.slots:
+                for attempt in range(self.retries + 1):
+                    result["attempts"] += 1
+                    start = time.perf_counter()
+                    try:
+                        status = await self._post(filename)
+                        result["seconds"] += time.perf_counter() - start
+                        result["status"] = "uploaded"
+                        result["bytes"] = os.path.getsize(filename)
+                        result["error"] = None if status == 200 else "HTTP %d, stored with warnings" % status
+                        break
+                    except (upload_error, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                        result["seconds"] += time.perf_counter() - start
+                        result["error"] = "%s: %s" % (type(e).__name__, e)
+                        if isinstance(e, upload_error) and not e.retry or attempt == self.retries:
+                            print("Failed to upload %s: %s" % (filename, result["error"]))
+                            break
+                        await asyncio.sleep(self.retry_delay * 2 ** attempt)
+            if result["status"] == "uploaded" and self.delete:
+                os.remove(filename)
+        finally:
+            self.pending.release()
+
+    # send one instance, returns the HTTP status of a successful request
+    async def _post(self, filename):
+        boundary = uuid.uuid4().hex
+        part_header = ("--%s\r\nContent-Type: application/dicom\r\n\r\n" % boundary).encode()
+        part_end = ("\r\n--%s--\r\n" % boundary).encode()
+        headers = {"Host": self.host_header,
+                   "Content-Type": 'multipart/related; type="application/dicom"; boundary=%s' % boundary,
+                   "Content-Length": str(len(part_header) + os.path.getsize(filename) + len(part_end)),
+                   "Accept": "application/dicom+json", "Connection": "keep-alive"}
+        headers.update(self.headers)
+        request = "POST %s HTTP/1.1\r\n" % self.path + "".join("%s: %s\r\n" % item for item in headers.items()) + "\r\n"
+        connection = await self._connection()
+        try:
+            writer = connection.writer
+            writer.write(request.encode() + part_header)
+            with open(filename, "rb") as fp:
+                while True:
+                    chunk = fp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+            writer.write(part_end)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            status, response_headers, body = await asyncio.wait_for(self._read_response(connection.reader), self.timeout)
+        except BaseException:
+            connection.close()
+            raise
+        if response_headers.get("connection", "").lower() == "close":
+            connection.close()
+        else:
+            self.idle.append(connection)
+        if status in (200, 202):
+            return status
+        message = "HTTP %d %s" % (status, body[:200].decode("latin-1").strip())
+        raise upload_error(message, status in RETRY_STATUS)
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+            while await reader.readuntil(b"\r\n") != b"\r\n":   # trailers, if any, end with an empty line
+                pass
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+        return status, headers, body
+
+
+class cstore_uploader:
+    '''
+    Send instances with C-STORE over one association, kept open between instances, in a background thread.
+    Same interface as stow_uploader: submit(filename), close(), report()
+    '''
+    def __init__(self, host, port, ae_title="STORESCP", calling_ae_title="WSI2DICOM", max_pending=16, retries=3,
+                 retry_delay=1.0, delete=False):
+        '''
+        :param host: host of the storage SCP
+        :param port: port of the storage SCP
+        :param ae_title: AE title of the storage SCP
+        :param calling_ae_title: AE title of this application
+        :param max_pending: maximum number of instances submitted and not uploaded yet, submit() blocks beyond
+        :param retries: number of times a failed C-STORE is sent again, on a new association
+        :param retry_delay: seconds before the first retry, doubled at each retry
+        :param delete: remove each instance file once it is stored
+        '''
+        if pynetdicom is None:
+            raise Exception("C-STORE requires pynetdicom, install it with: pip install pynetdicom")
+        self.host = host
+        self.port = port
+        self.ae_title = ae_title
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.delete = delete
+        self.ae = pynetdicom.AE(ae_title=calling_ae_title)
+        self.ae.requested_contexts = pynetdicom.StoragePresentationContexts
+        self.assoc = None
+        self.results = []
+        self.queue = []
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, filename):
+        if self.closed:
+            raise Exception("Uploader is closed")
+        self.pending.acquire()
+        with self.condition:
+            self.queue.append(filename)
+            self.condition.notify()
+
+    def close(self):
+        if self.closed:
+            return
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    report = stow_uploader.report
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                filename = self.queue.pop(0)
+            try:
+                self._store(filename)
+            finally:
+                self.pending.release()
+        if self.assoc is not None:
+            self.assoc.release()
+
+    def _store(self, filename):
+        result = {"filename": filename, "status": "failed", "attempts": 0, "seconds": 0.0, "bytes": 0, "error": None}
+        self.results.append(result)
+        for attempt in range(self.retries + 1):
+            result["attempts"] += 1
+            start = time.perf_counter()
+            if self.assoc is None or not self.assoc.is_established:
+                self.assoc = self.ae.associate(self.host, self.port, ae_title=self.ae_title)
+            if self.assoc.is_established:
+                status = self.assoc.send_c_store(filename)
+                result["seconds"] += time.perf_counter() - start
+                if status and status.Status == 0x0000:
+                    result["status"] = "uploaded"
+                    result["bytes"] = os.path.getsize(filename)
+                    result["error"] = None
+                    break
+                result["error"] = "C-STORE status 0x%04X" % status.Status if status else "no C-STORE response"
+            else:
+                result["seconds"] += time.perf_counter() - start
+                result["error"] = "association with %s:%d rejected or aborted" % (self.host, self.port)
+            if attempt == self.retries:
+                print("Failed to upload %s: %s" % (filename, result["error"]))
+                return
+            time.sleep(self.retry_delay * 2 ** attempt)
+        if self.delete:
+            os.remove(filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload converted Dicom instances with STOW-RS or C-STORE")
+    parser.add_argument("url", help="DICOMweb service root (http://host:port/dicom-web), or dicom://AE_TITLE@host:port for C-STORE")
+    parser.add_argument("inputs", nargs="+", help="Dicom files or directories of converted slides")
+    parser.add_argument("--connections", type=int, default=4, help="concurrent STOW-RS requests")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--header", action="append", default=[], metavar="NAME:VALUE", help="additional HTTP header, repeatable")
+    parser.add_argument("--report", default=None, help="save the upload report into this json file")
+    args = parser.parse_args(argv)
+    uploader = make_uploader(args.url, max_connections=args.connections, retries=args.retries,
+                             headers=dict(h.split(":", 1) for h in args.header))
+    with uploader:
+        for path in args.inputs:
+            filenames = sorted(os.path.join(path, fn) for fn in os.listdir(path) if fn.endswith(".dcm")) if os.path.isdir(path) else [path]
+            for filename in filenames:
+                uploader.submit(filename)
+    report = uploader.report()
+    print("%d instances uploaded, %d failed, %.1f MB" % (report["instances"] - report["failed"], report["failed"], report["bytes"] / 1e6))
+    if args.report is not None:
+        with open(args.report, "w") as fp:
+            json.dump(report, fp, indent=2)
+    return 1 if report["failed"] else 0
+
+
+# stow_uploader for http(s):// urls, cstore_uploader for dicom://AE_TITLE@host:port
+def make_uploader(url, max_connections=4, retries=3, headers=None):
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme == "dicom":
+        return cstore_uploader(parsed.hostname, parsed.port or 104, ae_title=parsed.username or "STORESCP", retries=retries)
+    return stow_uploader(url, max_connections=max_connections, retries=retries, headers=headers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import inspect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import openslide
+import pydicom
+from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+from WSI_DICOM_Batch import add_parameter_arguments, parameters_from_args
+from WSI_DICOM_Shard import PLAN_FILENAME, load_plan
+from WSI_DICOM_Reader import ITEM_TAG, SEQUENCE_DELIMITER_TAG
+from checkpoint import CHECKPOINT_FILENAME, conversion_checkpoint, recorded_parameters
+from frame_codecs import get_codec
+from region_reader import region_reader
+'''
+Verify a converted slide against its frame plan and its source slide, with a pool of worker processes.
+Each instance is checked by a worker:
+    structure: NumberOfFrames, matrix and frame sizes, transfer syntax, the Basic (or Extended) Offset Table against
+               the items of the encapsulated pixel data, and the position of every frame against the frame plan
+               (PerFrameFunctionalGroupsSequence, or the frame order and concatenation offset for TILED_FULL)
+    fidelity:  sampled frames are decoded and compared to the same frames read from the source slide, they should be
+               identical for lossless codecs, and above PSNR and SSIM thresholds for lossy ones
+Sampling is uniform over all the frames of the slide, with a rate and an optional maximum number of frames, so huge
+slides are verified in a bounded time. The frame plan is that of the parameters recorded in the checkpoint of the
+conversion, or of the shard plan if the slide was converted with WSI_DICOM_Shard.py.
+Usage:
+    python WSI_DICOM_Verify.py /path/to/slide.svs /path/to/converted/slide --sample-rate 0.01 --max-samples 2000 --report verify.json
+without a checkpoint, with the same conversion options as the conversion (i.e. --max-frame, --tissue-detection, --param TILED_FULL=True)
+'''
+
+PSNR_THRESHOLD = 30.0   # dB, lossy frames below are reported
+SSIM_THRESHOLD = 0.9
+SSIM_WINDOW = 7   # pixels, side of the SSIM window
+MAX_REPORTED_FRAMES = 20   # frames failing the fidelity check listed in the report, per instance
+
+
+# mean of each k x k window of the last two axes, for the windows inside the image
+def box_mean(img, k):
+    cumulated = np.cumsum(img, axis=-2)
+    img = cumulated[..., k - 1:, :].copy()
+    img[..., 1:, :] -= cumulated[..., :-k, :]
+    cumulated = np.cumsum(img, axis=-1)
+    img = cumulated[..., k - 1:].copy()
+    img[..., 1:] -= cumulated[..., :-k]
+    return img / (k * k)
+
+
+def psnr(img1, img2):
+    mse = np.mean((img1.astype(np.float64) - img2.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ssim(img1, img2, k=SSIM_WINDOW):
+    '''
+    structural similarity of the luma of two RGB uint8 images, mean over the k x k windows
+    (uniform window and sample covariance, as the skimage default)
+    '''
+    luma = np.array([0.299, 0.587, 0.114])
+    x, y = img1 @ luma, img2 @ luma
+    C1, C2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    cov_norm = k * k / (k * k - 1.0)
+    # the five window means in one pass
+    mx, my, mxx, myy, mxy = box_mean(np.stack([x, y, x * x, y * y, x * y]), k)
+    vx = cov_norm * (mxx - mx * mx)
+    vy = cov_norm * (myy - my * my)
+    vxy = cov_norm * (mxy - mx * my)
+    return float(np.mean((2 * mx * my + C1) * (2 * vxy + C2) / ((mx * mx + my * my + C1) * (vx + vy + C2))))
+
+
+class instance_check:
+    def __init__(self, instance_idx, filename, frame_items_info, level_dimensions, downsample, codec,
+                 concatenation_offset=None, grid_columns=None, samples=(), check_fidelity=True,
+                 psnr_threshold=PSNR_THRESHOLD, ssim_threshold=SSIM_THRESHOLD):
+        '''
+        what to verify in one instance, sent to a worker
+        :param instance_idx: index of the instance in the frame plan
+        :param filename: file name of the instance
+        :param frame_items_info: frame_info of the instance, from the frame plan
+        :param level_dimensions: (width, height) of its image level
+        :param downsample: downsample of its image level
+        :param codec: name of the codec of the conversion, see frame_codecs.py
+        :param concatenation_offset: for TILED_FULL, number of frames of the level in the previous instances, else None
+        :param grid_columns: for TILED_FULL, number of frames across the level
+        :param samples: indices of the frames to decode and compare to the source
+        :param check_fidelity: whether frames are read from the same level of the source, not built by GENERATE_PYRAMID
+        :param psnr_threshold: minimum PSNR of lossy frames, in dB
+        :param ssim_threshold: minimum SSIM of lossy frames
+        '''
+        self.instance_idx = instance_idx
+        self.filename = filename
+        self.frame_items_info = frame_items_info
+        self.level_dimensions = level_dimensions
+        self.downsample = downsample
+        self.codec = codec
+        self.concatenation_offset = concatenation_offset
+        self.grid_columns = grid_columns
+        self.samples = samples
+        self.check_fidelity = check_fidelity
+        self.psnr_threshold = psnr_threshold
+        self.ssim_threshold = ssim_threshold
+
+
+# item positions and lengths of an encapsulated pixel data, starting with the Basic Offset Table item
+def encapsulated_items(mm, pos):
+    items = []
+    while True:
+        if pos + 8 > len(mm):
+            raise Exception("pixel data ends without a sequence delimiter")
+        tag, length = struct.unpack_from("<II", mm, pos)
+        if tag == SEQUENCE_DELIMITER_TAG:
+            return items, pos + 8
+        if tag != ITEM_TAG:
+            raise Exception("item expected at byte %d" % pos)
+        items.append((pos, length))
+        pos += 8 + length
+
+
+def check_structure(check, ds, mm, pixel_data_pos):
+    '''
+    check the header, offset tables and frame positions of an instance
+    :return: problems found [str, ...], and the byte range (offset, length) of each frame, None if they can't be trusted
+    '''
+    problems = []
+    info = check.frame_items_info
+    NumberOfFrames = len(info.locations)
+    codec = get_codec(check.codec)
+    expected = [("NumberOfFrames", NumberOfFrames), ("TotalPixelMatrixColumns", check.level_dimensions[0]),
+                ("TotalPixelMatrixRows", check.level_dimensions[1]), ("Columns", info.patch_size[0]),
+                ("Rows", info.patch_size[1]), ("SamplesPerPixel", 3)]
+    for keyword, value in expected:
+        if ds.get(keyword) is None or int(ds.get(keyword)) != int(value):
+            problems.append("%s is %s, %s expected" % (keyword, ds.get(keyword), value))
+    if ds.file_meta.TransferSyntaxUID != codec.TransferSyntaxUID:
+        problems.append("transfer syntax is %s, %s expected" % (ds.file_meta.TransferSyntaxUID, codec.TransferSyntaxUID))
+    if problems:
+        return problems, None
+
+    # frame positions
+    locations = np.asarray(info.locations, dtype=np.float64).reshape(-1, 2)
+    DimensionIndexValues = np.asarray(info.DimensionIndexValues, dtype=np.int64).reshape(-1, 2)
+    if check.concatenation_offset is None:
+        if "PerFrameFunctionalGroupsSequence" not in ds or len(ds.PerFrameFunctionalGroupsSequence) != NumberOfFrames:
+            problems.append("PerFrameFunctionalGroupsSequence should have one item per frame")
+        else:
+            positions = np.array([[item.PlanePositionSlideSequence[0].ColumnPositionInTotalImagePixelMatrix,
+                                   item.PlanePositionSlideSequence[0].RowPositionInTotalImagePixelMatrix]
+                                  for item in ds.PerFrameFunctionalGroupsSequence], dtype=np.int64)
+            indices = np.array([item.FrameContentSequence[0].DimensionIndexValues
+                                for item in ds.PerFrameFunctionalGroupsSequence], dtype=np.int64).reshape(-1, 2)
+            expected_positions = (locations / check.downsample).astype(np.int32) + 1
+            wrong = np.flatnonzero(np.any(positions != expected_positions, axis=1) | np.any(indices != DimensionIndexValues, axis=1))
+            if len(wrong):
+                problems.append("%d frames at the wrong position, first: frame %d" % (len(wrong), wrong[0] + 1))
+    else:
+        # TILED_FULL: positions are implied by the frame order, continuing the previous instances of the level
+        if int(ds.get("ConcatenationFrameOffsetNumber", 0)) != check.concatenation_offset:
+            problems.append("ConcatenationFrameOffsetNumber is %s, %d expected" % (ds.get("ConcatenationFrameOffsetNumber"), check.concatenation_offset))
+        frame_idx = check.concatenation_offset + np.arange(NumberOfFrames)
+        implied = np.stack([frame_idx % check.grid_columns + 1, frame_idx // check.grid_columns + 1], axis=1)
+        wrong = np.flatnonzero(np.any(implied != DimensionIndexValues, axis=1))
+        if len(wrong):
+            problems.append("%d frames out of the TILED_FULL order, first: frame %d" % (len(wrong), wrong[0] + 1))
+
+    # pixel data and offset tables
+    if struct.unpack_from("<HH", mm, pixel_data_pos) != (0x7FE0, 0x0010):
+        return problems + ["Pixel Data expected at byte %d" % pixel_data_pos], None
+    implicit_VR = ds.file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian
+    value_length = struct.unpack_from("<I", mm, pixel_data_pos + (4 if implicit_VR else 8))[0]
+    value_pos = pixel_data_pos + (8 if implicit_VR else 12)
+    if not codec.encapsulated:
+        frame_length = info.patch_size[0] * info.patch_size[1] * 3
+        if value_length != NumberOfFrames * frame_length + (NumberOfFrames * frame_length) % 2:
+            return problems + ["Pixel Data is %d bytes, %d frames of %d bytes expected" % (value_length, NumberOfFrames, frame_length)], None
+        if value_pos + value_length != len(mm):
+            problems.append("%d bytes after Pixel Data" % (len(mm) - value_pos - value_length))
+        return problems, [(value_pos + idx * frame_length, frame_length) for idx in range(NumberOfFrames)]
+    if value_length != 0xFFFFFFFF:
+        return problems + ["Pixel Data should be encapsulated"], None
+    try:
+        items, end = encapsulated_items(mm, value_pos)
+    except Exception as e:
+        return problems + [str(e)], None
+    if end != len(mm):
+        problems.append("%d bytes after the pixel data" % (len(mm) - end))
+    (bot_pos, bot_length), fragments = items[0], items[1:]
+    if len(fragments) != NumberOfFrames:
+        return problems + ["%d fragments for %d frames" % (len(fragments), NumberOfFrames)], None
+    first_item_pos = bot_pos + 8 + bot_length
+    item_offsets = np.array([pos - first_item_pos for pos, length in fragments], dtype=np.int64)
+    if "ExtendedOffsetTable" in ds:
+        offsets = np.frombuffer(ds.ExtendedOffsetTable, dtype="<u8").astype(np.int64)
+        lengths = np.frombuffer(ds.get("ExtendedOffsetTableLengths", b""), dtype="<u8").astype(np.int64)
+        if bot_length != 0:
+            problems.append("Basic Offset Table should be empty with an Extended Offset Table")
+        if len(lengths) != NumberOfFrames or np.any(lengths != [length for pos, length in fragments]):
+            problems.append("ExtendedOffsetTableLengths don't match the frame lengths")
+        table = "Extended Offset Table"
+    else:
+        offsets = np.frombuffer(mm, dtype="<u4", count=bot_length // 4, offset=bot_pos + 8).astype(np.int64)
+        table = "Basic Offset Table"
+    if len(offsets) != NumberOfFrames:
+        problems.append("%s has %d offsets for %d frames" % (table, len(offsets), NumberOfFrames))
+    elif np.any(offsets != item_offsets):
+        problems.append("%s doesn't match the frame items, first at frame %d" % (table, np.flatnonzero(offsets != item_offsets)[0] + 1))
+    return problems, [(pos + 8, length) for pos, length in fragments]
+
+
+# (width, height) of the part of a frame inside the total pixel matrix of its level
+def frame_extent(location, downsample, patch_size, level_dimensions):
+    column, row = int(location[0] / downsample), int(location[1] / downsample)
+    return (max(0, min(patch_size[0], level_dimensions[0] - column)),
+            max(0, min(patch_size[1], level_dimensions[1] - row)))
+
+
+# reader of the source slide of a worker process, created by _init_worker
+_worker_reader = None
+
+
+def _init_worker(wsi_fn, read_cache_size):
+    global _worker_reader
+    _worker_reader = region_reader(openslide.open_slide(wsi_fn), wsi_fn, read_cache_size)
+
+
+def verify_instance(check, reader=None):
+    '''
+    verify one instance
+    :param check: instance_check
+    :param reader: region_reader of the source slide, the one of the worker process if None
+    :return: report of the instance, a json-able dict
+    '''
+    reader = reader if reader is not None else _worker_reader
+    report = {"instance": check.instance_idx, "filename": os.path.basename(check.filename),
+              "img_level": int(check.frame_items_info.img_level), "frames": len(check.frame_items_info.locations),
+              "problems": [], "sampled": 0, "identical": 0, "failed_frames": [], "min_psnr": None, "mean_psnr": None,
+              "min_ssim": None, "mean_ssim": None}
+    if not os.path.exists(check.filename):
+        report["problems"].append("missing")
+        return report
+    with open(check.filename, "rb") as fp:
+        try:
+            ds = pydicom.dcmread(fp, stop_before_pixels=True)
+            pixel_data_pos = fp.tell()
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception as e:
+            report["problems"].append("unreadable: %s" % e)
+            return report
+    try:
+        report["problems"], frames = check_structure(check, ds, mm, pixel_data_pos)
+        if frames is None or not len(check.samples) or not check.check_fidelity:
+            return report
+        codec = get_codec(check.codec)
+        info = check.frame_items_info
+        sources = reader.read(info.img_level, info.patch_size, [info.locations[idx] for idx in check.samples])
+        psnrs, ssims = [], []
+        for frame_idx, source in zip(check.samples, sources):
+            offset, length = frames[frame_idx]
+            try:
+                decoded = codec.decode(mm[offset:offset + length], info.patch_size)
+            except Exception as e:
+                report["problems"].append("frame %d can't be decoded: %s" % (frame_idx + 1, e))
+                continue
+            if decoded.shape != source.shape:
+                report["problems"].append("frame %d is %s, %s expected" % (frame_idx + 1, decoded.shape, source.shape))
+                continue
+            # only the part of the frame inside the total pixel matrix, the padding past it isn't part of the image
+            # (native tiles of JPEG_PASSTHROUGH are padded by the scanner, frames read from the slide with black)
+            width, height = frame_extent(info.locations[frame_idx], check.downsample, info.patch_size, check.level_dimensions)
+            decoded, source = decoded[:height, :width], source[:height, :width]
+            if np.array_equal(decoded, source):
+                report["identical"] += 1
+                psnrs.append(float("inf"))
+                ssims.append(1.0)
+                continue
+            psnrs.append(psnr(decoded, source))
+            # no SSIM window fits in a strip along the right or bottom edge
+            frame_ssim = ssim(decoded, source) if min(width, height) >= SSIM_WINDOW else None
+            if frame_ssim is not None:
+                ssims.append(frame_ssim)
+            if not codec.lossy or psnrs[-1] < check.psnr_threshold or (frame_ssim is not None and frame_ssim < check.ssim_threshold):
+                if len(report["failed_frames"]) < MAX_REPORTED_FRAMES:
+                    report["failed_frames"].append({"frame": int(frame_idx) + 1, "psnr": round(psnrs[-1], 2),
+                                                    "ssim": round(frame_ssim, 4) if frame_ssim is not None else None})
+                report.setdefault("failed", 0)
+                report["failed"] += 1
+        report["sampled"] = len(psnrs)
+        if psnrs:
+            finite = [v for v in psnrs if v != float("inf")]
+            report["min_psnr"] = round(min(psnrs), 2) if finite else None   # None: all identical
+            report["mean_psnr"] = round(float(np.mean(finite)), 2) if finite else None
+            report["min_ssim"] = round(min(ssims), 4) if ssims else None
+            report["mean_ssim"] = round(float(np.mean(ssims)), 4) if ssims else None
+        if report.get("failed"):
+            report["problems"].append("%d of %d sampled frames %s" % (
+                report["failed"], len(psnrs), "differ from the source" if not codec.lossy else
+                "below %.1f dB PSNR or %.3f SSIM" % (check.psnr_threshold, check.ssim_threshold)))
+        return report
+    finally:
+        mm.close()
+
+
+def sample_frames(frame_counts, sample_rate, max_samples=None, seed=0):
+    '''
+    frames to decode, uniformly over all the frames of the slide
+    :param frame_counts: number of frames of each instance
+    :param sample_rate: fraction of the frames to sample [0, 1]
+    :param max_samples: maximum number of frames, whatever the rate, if not None
+    :param seed: seed of the sampling, same seed, same frames
+    :return: [frame indices, ...] sorted array of the sampled frames of each instance
+    '''
+    total = int(sum(frame_counts))
+    count = min(total, int(np.ceil(total * sample_rate)))
+    if max_samples is not None:
+        count = min(count, max_samples)
+    chosen = np.sort(np.random.default_rng(seed).choice(total, count, replace=False)) if count else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(frame_counts)))
+    bounds = np.searchsorted(chosen, starts)
+    return [chosen[bounds[idx]:bounds[idx + 1]] - starts[idx] for idx in range(len(frame_counts))]
+
+
+# parameters of the conversion into dicom_dir, recorded in its checkpoint (see checkpoint.py)
+def checkpoint_parameters(dicom_dir):
+    recorded = recorded_parameters(dicom_dir)
+    if recorded is None:
+        raise Exception("No parameters recorded in %s, give the parameters of the conversion" % dicom_dir)
+    arguments = inspect.signature(parameters).parameters
+    return parameters(**{key: value for key, value in recorded.items() if key in arguments})
+
+
+def verify_slide(wsi_fn, dicom_dir, p=None, sample_rate=0.01, max_samples=None, workers=None, seed=0, report_fn=None,
+                 psnr_threshold=PSNR_THRESHOLD, ssim_threshold=SSIM_THRESHOLD):
+    '''
+    verify a converted slide
+    :param wsi_fn: file name of the source slide
+    :param dicom_dir: output directory of the conversion
+    :param p: parameters of the conversion (see class parameters), to plan the frames. If None, the shard plan of
+    dicom_dir (see WSI_DICOM_Shard.py) if there is one, else the parameters recorded in the conversion checkpoint
+    :param sample_rate: fraction of the frames decoded and compared to the source, 0 to only check the structure
+    :param max_samples: maximum number of frames decoded, to bound the time on huge slides
+    :param workers: number of worker processes, defaults to the number of CPUs, 1 to verify in this process
+    :param seed: seed of the frame sampling
+    :param report_fn: save the report into this json file
+    :param psnr_threshold: minimum PSNR of the sampled frames of lossy codecs, in dB
+    :param ssim_threshold: minimum SSIM of the sampled frames of lossy codecs
+    :return: report, a json-able dict with "status" 'passed' or 'failed', and the report of each instance
+    '''
+    start = time.time()
+    frame_plan = None
+    if p is None:
+        if os.path.exists(os.path.join(dicom_dir, PLAN_FILENAME)):
+            p, frame_plan = load_plan(dicom_dir)[1:]
+            print("Frame plan from %s" % os.path.join(dicom_dir, PLAN_FILENAME))
+        else:
+            p = checkpoint_parameters(dicom_dir)
+            print("Parameters from %s" % os.path.join(dicom_dir, CHECKPOINT_FILENAME))
+    converter = WSIDICOM_Converter(wsi_fn, dicom_dir, p, frame_plan=frame_plan)
+    converter.wsi_obj.close()
+    frame_plan = converter.frame_items_info_list
+    problems = []
+    checkpoint = conversion_checkpoint(dicom_dir, p)
+    if os.path.exists(checkpoint.filename) and not checkpoint.instances:
+        problems.append("the checkpoint of %s was written with other parameters" % dicom_dir)
+    planned_files = set(os.path.basename(converter.instance_filename(idx)) for idx in range(len(frame_plan)))
+    unexpected = sorted(fn for fn in os.listdir(dicom_dir) if fn.endswith(".dcm") and fn not in planned_files)
+    if unexpected:
+        problems.append("instances not in the frame plan: %s" % ", ".join(unexpected))
+
+    samples = sample_frames([len(info.locations) for info in frame_plan], sample_rate, max_samples, seed)
+    level_frames = {}   # image level -> frames of the previous instances of the level, for TILED_FULL
+    checks = []
+    for instance_idx, info in enumerate(frame_plan):
+        concatenation_offset = grid_columns = None
+        if p.TILED_FULL:
+            concatenation_offset = level_frames.get(info.img_level, 0)
+            grid_columns = -(-converter.level_dimensions[info.img_level][0] // info.patch_size[0])
+        level_frames[info.img_level] = level_frames.get(info.img_level, 0) + len(info.locations)
+        checks.append(instance_check(instance_idx, converter.instance_filename(instance_idx), info,
+                                     converter.level_dimensions[info.img_level], converter.level_downsamples[info.img_level],
+                                     converter.codec, concatenation_offset, grid_columns, samples[instance_idx],
+                                     not p.GENERATE_PYRAMID or info.img_level == 0, psnr_threshold, ssim_threshold))
+
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        reader = region_reader(openslide.open_slide(wsi_fn), wsi_fn, p.read_cache_size)
+        instances = [verify_instance(check, reader) for check in checks]
+        reader.wsi_obj.close()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(wsi_fn, p.read_cache_size)) as pool:
+            instances = list(pool.map(verify_instance, checks))
+    seconds = time.time() - start
+    codec = get_codec(converter.codec)
+    sampled = sum(r["sampled"] for r in instances)
+    psnrs = [r["min_psnr"] for r in instances if r["min_psnr"] is not None]
+    ssims = [r["min_ssim"] for r in instances if r["min_ssim"] is not None]
+    report = {"slide": wsi_fn, "output": dicom_dir, "codec": converter.codec, "lossy": codec.lossy,
+              "status": "failed" if problems or any(r["problems"] for r in instances) else "passed",
+              "problems": problems, "frames": sum(r["frames"] for r in instances), "sample_rate": sample_rate,
+              "sampled": sampled, "identical": sum(r["identical"] for r in instances),
+              "min_psnr": min(psnrs) if psnrs else None, "min_ssim": min(ssims) if ssims else None,
+              "seconds": round(seconds, 3), "instances": instances}
+    for problem in problems:
+        print("Problem: %s" % problem)
+    for r in instances:
+        for problem in r["problems"]:
+            print("Instance %d: %s" % (r["instance"], problem))
+    print("%s: %d instances, %d frames, %d sampled (%d identical), min PSNR %s, min SSIM %s, %.1f s" % (
+        report["status"], len(instances), report["frames"], sampled, report["identical"], report["min_psnr"],
+        report["min_ssim"], seconds))
+    if report_fn is not None:
+        with open(report_fn, "w") as fp:
+            json.dump(report, fp, indent=2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify a slide converted into DICOM against its frame plan and its source")
+    parser.add_argument("slide", help="file name of the source slide")
+    parser.add_argument("output", help="output directory of the conversion")
+    parser.add_argument("--sample-rate", type=float, default=0.01, help="fraction of the frames decoded and compared to the source (default: 0.01)")
+    parser.add_argument("--max-samples", type=int, default=None, help="maximum number of frames decoded")
+    parser.add_argument("--min-psnr", type=float, default=PSNR_THRESHOLD, help="minimum PSNR of lossy frames, in dB (default: %(default)s)")
+    parser.add_argument("--min-ssim", type=float, default=SSIM_THRESHOLD, help="minimum SSIM of lossy frames (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the frame sampling")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--report", default=None, help="save the report into this json file")
+    add_parameter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # a sharded conversion has its parameters and frame plan in its shard plan, the others their parameters in their checkpoint
+    recorded = os.path.exists(os.path.join(args.output, PLAN_FILENAME)) or recorded_parameters(args.output) is not None
+    p = None if recorded else parameters_from_args(args)
+    report = verify_slide(args.slide, args.output, p, args.sample_rate, args.max_samples, args.workers, args.seed, args.report,
+                          args.min_psnr, args.min_ssim)
+    return 0 if report["status"] == "passed" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
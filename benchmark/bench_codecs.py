@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from frame_codecs import CODECS
+'''
+Encode speed, size and quality of each codec of frame_codecs.py, on synthetic H&E-like tiles.
+Usage: python benchmark/bench_codecs.py [tile count] [Quality]
+'''
+
+HEMATOXYLIN = np.array([60, 40, 140], dtype=np.float32)
+EOSIN = np.array([230, 120, 180], dtype=np.float32)
+GLASS = np.array([242, 240, 245], dtype=np.float32)
+
+
+# smooth random field in [0, 1], features about size / cells pixels wide
+def smooth_noise(rng, size, cells):
+    coarse = Image.fromarray((rng.random((cells, cells)) * 255).astype(np.uint8))
+    return np.asarray(coarse.resize(size, Image.BICUBIC), dtype=np.float32) / 255
+
+
+def synthetic_tile(rng, patch_size=(512, 512)):
+    w, h = patch_size
+    tissue = np.clip((smooth_noise(rng, (w, h), 4) - 0.35) * 4, 0, 1)   # tissue and empty glass
+    stroma = smooth_noise(rng, (w, h), 32)
+    nuclei = np.clip((smooth_noise(rng, (w, h), 96) - 0.7) * 5, 0, 1)   # small dark blobs
+    color = EOSIN * (0.6 + 0.4 * stroma[..., None])
+    color = color * (1 - nuclei[..., None]) + HEMATOXYLIN * nuclei[..., None]
+    color = GLASS * (1 - tissue[..., None]) + color * tissue[..., None]
+    color += rng.normal(0, 3, color.shape)   # sensor noise
+    return np.clip(color, 0, 255).astype(np.uint8)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+if __name__ == "__main__":
+    tile_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    Quality = int(sys.argv[2]) if len(sys.argv) > 2 else 75
+    rng = np.random.default_rng(0)
+    tiles = [synthetic_tile(rng) for _ in range(tile_cnt)]
+    images = [Image.fromarray(tile) for tile in tiles]
+    raw_size = sum(tile.nbytes for tile in tiles)
+    print("%d tiles of 512x512, %.1f MB raw, Quality=%d" % (tile_cnt, raw_size / 2 ** 20, Quality))
+    print("%-18s %-24s %10s %10s %8s %8s %8s" % ("codec", "transfer syntax", "enc MB/s", "dec MB/s", "size MB", "ratio", "PSNR dB"))
+    for name, codec in CODECS.items():
+        if not codec.available():
+            print("%-18s not available: %s" % (name, codec.requires()))
+            continue
+        start = time.perf_counter()
+        frames = [codec.encode(img, Quality) for img in images]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [codec.decode(frame, (512, 512)) for frame in frames]
+        decode_time = time.perf_counter() - start
+        size = sum(len(frame) for frame in frames)
+        quality = np.mean([min(psnr(tile, dec), 99.0) for tile, dec in zip(tiles, decoded)])
+        print("%-18s %-24s %10.1f %10.1f %8.2f %8.1f %8.1f" % (
+            name, codec.TransferSyntaxUID, raw_size / 2 ** 20 / encode_time, raw_size / 2 ** 20 / decode_time,
+            size / 2 ** 20, raw_size / size, quality))
@@ -0,0 +1,265 @@
+import os
+import sys
+import ast
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+from PIL import Image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+'''
+Benchmark of the converter on synthetic pyramidal TIFF slides, generated offline with tifffile (and imagecodecs
+for JPEG tiles). Each stage runs in its own process, so the peak RSS reported is the one of that stage:
+    plan:            generate_instance_info_list
+    frame_sequence:  add_Frame_Sequence_data (pydicom datasets) of every instance
+    frame_template:  encode_Frame_Sequence_data (frame_sequence.py) of every instance
+    pixel_data:      add_PixelData of every instance (read and encode, in memory)
+    convert:         the full convert(), into a temporary directory
+Results are printed and saved as JSON. With --baseline, results are compared with a saved run and the exit code
+is 1 if a stage got slower (or used more memory) than the tolerance allows.
+Usage:
+    python benchmark/bench_convert.py --width 20000 --height 15000 --tissue-fraction 0.4 --output result.json
+    python benchmark/bench_convert.py --slide /data/CMU-1.svs --stages convert --param workers=4
+    python benchmark/bench_convert.py --width 20000 --height 15000 --tissue-fraction 0.4 --baseline result.json
+'''
+
+STAGES = ("plan", "frame_sequence", "frame_template", "pixel_data", "convert")
+HEMATOXYLIN = np.array([60, 40, 140], dtype=np.float32)
+EOSIN = np.array([230, 120, 180], dtype=np.float32)
+GLASS = np.array([242, 240, 245], dtype=np.float32)
+
+
+# smooth random field in [0, 1] of the given (width, height), with about cells x cells features
+def smooth_noise(rng, size, cells):
+    coarse = Image.fromarray((rng.random((cells, cells)) * 255).astype(np.uint8))
+    return np.asarray(coarse.resize(size, Image.BICUBIC), dtype=np.float32) / 255
+
+
+# tissue-like texture blended with glass, tissue is where mask is 1
+def synthetic_tile(rng, mask, tile_size):
+    stroma = smooth_noise(rng, (tile_size, tile_size), 16)
+    nuclei = np.clip((smooth_noise(rng, (tile_size, tile_size), tile_size // 6) - 0.7) * 5, 0, 1)
+    color = EOSIN * (0.6 + 0.4 * stroma[..., None])
+    color = color * (1 - nuclei[..., None]) + HEMATOXYLIN * nuclei[..., None]
+    color = GLASS * (1 - mask[..., None]) + color * mask[..., None]
+    color += rng.normal(0, 3, color.shape)
+    return np.clip(color, 0, 255).astype(np.uint8)
+
+
+def tissue_mask(rng, width, height, tissue_fraction, scale=16):
+    '''
+    low resolution tissue mask, one pixel for scale x scale slide pixels
+    :return: float mask in [0, 1], with tissue_fraction of its pixels above 0.5
+    '''
+    w, h = -(-width // scale), -(-height // scale)
+    field = smooth_noise(rng, (w, h), 6)
+    if tissue_fraction <= 0:
+        return np.zeros((h, w), dtype=np.float32)
+    threshold = np.quantile(field, 1 - min(tissue_fraction, 1.0))
+    return np.clip((field - threshold) * 20 + 0.5, 0, 1)
+
+
+def make_synthetic_slide(fn, width, height, tissue_fraction=0.5, tile_size=256, levels=3, downsample=4, seed=0, quality=90):
+    '''
+    write a tiled pyramidal TIFF with JPEG tiles, which OpenSlide reads as a generic tiled TIFF
+    :param fn: file name of the slide
+    :param width, height: size of level 0
+    :param tissue_fraction: fraction of the slide covered by tissue, the rest is empty glass
+    :param tile_size: width and height of TIFF tiles
+    :param levels: number of pyramid levels
+    :param downsample: downsample between levels
+    '''
+    import tifffile
+    rng = np.random.default_rng(seed)
+    mask = tissue_mask(rng, width, height, tissue_fraction)
+    mask_h, mask_w = mask.shape
+    options = dict(tile=(tile_size, tile_size), photometric="rgb", compression="jpeg", compressionargs={"level": quality})
+
+    def tiles(w, h):
+        for y in range(0, h, tile_size):
+            for x in range(0, w, tile_size):
+                # mask area under this tile, as a fraction of the level size
+                box = (x / w * mask_w, y / h * mask_h, (x + tile_size) / w * mask_w, (y + tile_size) / h * mask_h)
+                tile_mask = Image.fromarray(mask).transform((tile_size, tile_size), Image.EXTENT, box, Image.BILINEAR)
+                yield synthetic_tile(rng, np.asarray(tile_mask), tile_size)
+
+    with tifffile.TiffWriter(fn, bigtiff=width * height * 3 > 2 ** 31) as tif:
+        for lv in range(levels):
+            w, h = -(-width // downsample ** lv), -(-height // downsample ** lv)
+            if lv > 0 and max(w, h) < tile_size:
+                break
+            tif.write(tiles(w, h), shape=(h, w, 3), dtype=np.uint8, subfiletype=1 if lv > 0 else 0, **options)
+
+
+# synthetic slide for the benchmark configuration, generated once and kept in fixture_dir
+def get_fixture(args):
+    config = dict(width=args.width, height=args.height, tissue_fraction=args.tissue_fraction, tile_size=args.tile_size,
+                  levels=args.levels, seed=args.seed)
+    name = "slide_%s.tiff" % hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    fn = os.path.join(args.fixture_dir, name)
+    if not os.path.exists(fn):
+        os.makedirs(args.fixture_dir, exist_ok=True)
+        print("Generating %s %s" % (fn, config))
+        make_synthetic_slide(fn + ".partial", **config)
+        os.replace(fn + ".partial", fn)
+    return fn, config
+
+
+def peak_rss_MB():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20)
+
+
+# run one stage, in the current process
+def run_stage(stage, slide_fn, kwargs):
+    from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+    out_dir = tempfile.mkdtemp(prefix="bench_convert_")
+    try:
+        p = parameters(**kwargs)
+        converter = WSIDICOM_Converter(slide_fn, out_dir, p)
+        tiles = sum(len(info.locations) for info in converter.frame_items_info_list)
+        output_bytes = 0
+        start = time.perf_counter()
+        if stage == "plan":
+            converter.generate_instance_info_list()
+        elif stage == "frame_sequence":
+            for info in converter.frame_items_info_list:
+                converter.add_Frame_Sequence_data(info)
+        elif stage == "frame_template":
+            for info in converter.frame_items_info_list:
+                output_bytes += len(converter.encode_Frame_Sequence_data(info))
+        elif stage == "pixel_data":
+            converter.start_pool()
+            try:
+                for info in converter.frame_items_info_list:
+                    data = converter.add_PixelData(info)
+                    output_bytes += sum(len(frame) for frame in data) if isinstance(data, list) else len(data)
+            finally:
+                converter.stop_pool()
+        elif stage == "convert":
+            converter.convert()
+            output_bytes = sum(os.path.getsize(os.path.join(out_dir, fn)) for fn in os.listdir(out_dir) if fn.endswith(".dcm"))
+        else:
+            raise Exception("Unknown stage %s, should be one of: %s" % (stage, ", ".join(STAGES)))
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    rss, rss_workers = peak_rss_MB()
+    pixel_MB = tiles * p.patch_size[0] * p.patch_size[1] * 3 / 2 ** 20
+    return {
+        "seconds": round(seconds, 4),
+        "tiles": tiles,
+        "tiles_per_s": round(tiles / seconds, 2) if seconds > 0 else None,
+        "MB_per_s": round(pixel_MB / seconds, 2) if seconds > 0 else None,   # decoded pixels processed per second
+        "output_MB": round(output_bytes / 2 ** 20, 3),
+        "peak_rss_MB": round(rss, 1),
+        "peak_rss_workers_MB": round(rss_workers, 1),
+    }
+
+
+# run one stage in a new process, repeat times, keep the fastest run
+def measure_stage(stage, slide_fn, kwargs, repeat):
+    best = None
+    for _ in range(repeat):
+        cmd = [sys.executable, os.path.abspath(__file__), "--run-stage", json.dumps([stage, slide_fn, repr(kwargs)])]
+        output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def compare(results, baseline, tolerance):
+    '''
+    compare stage results with a baseline run
+    :return: list of regressions, as text
+    '''
+    regressions = []
+    print("%-16s %12s %12s %8s %12s %12s" % ("stage", "tiles/s", "baseline", "change", "RSS MB", "baseline"))
+    for stage, result in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        speed = result["tiles_per_s"] / base["tiles_per_s"] - 1 if base["tiles_per_s"] else 0.0
+        print("%-16s %12.1f %12.1f %+7.1f%% %12.1f %12.1f" % (stage, result["tiles_per_s"], base["tiles_per_s"],
+                                                           speed * 100, result["peak_rss_MB"], base["peak_rss_MB"]))
+        if speed < -tolerance:
+            regressions.append("%s: %.1f tiles/s, baseline %.1f" % (stage, result["tiles_per_s"], base["tiles_per_s"]))
+        if result["peak_rss_MB"] > base["peak_rss_MB"] * (1 + tolerance):
+            regressions.append("%s: peak RSS %.1f MB, baseline %.1f MB" % (stage, result["peak_rss_MB"], base["peak_rss_MB"]))
+    if results["slide"] != baseline.get("slide") or results["parameters"] != baseline.get("parameters"):
+        print("Warning: the baseline was run on a different slide or with different parameters")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark WSIDICOM_Converter on a synthetic slide")
+    parser.add_argument("--width", type=int, default=16384)
+    parser.add_argument("--height", type=int, default=12288)
+    parser.add_argument("--tissue-fraction", type=float, default=0.5)
+    parser.add_argument("--tile-size", type=int, default=256, help="tile size of the synthetic TIFF")
+    parser.add_argument("--levels", type=int, default=3, help="pyramid levels of the synthetic TIFF, 4x downsample each")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixture-dir", default=os.path.join(tempfile.gettempdir(), "wsi_dicom_bench"),
+                        help="where synthetic slides are generated and kept for the next runs")
+    parser.add_argument("--slide", default=None, help="benchmark this slide instead of a synthetic one")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="argument of class parameters, i.e. --param workers=4")
+    parser.add_argument("--repeat", type=int, default=1, help="run each stage this many times, keep the fastest")
+    parser.add_argument("--output", default=None, help="save the results into this json file")
+    parser.add_argument("--baseline", default=None, help="compare with the results saved in this json file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown / memory increase against the baseline")
+    parser.add_argument("--run-stage", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_stage is not None:
+        stage, slide_fn, kwargs = json.loads(args.run_stage)
+        print(json.dumps(run_stage(stage, slide_fn, ast.literal_eval(kwargs))))   # repr of the --param values
+        return 0
+
+    kwargs = {}
+    for param in args.param:
+        key, _, value = param.partition("=")
+        try:
+            kwargs[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            kwargs[key.strip()] = value.strip()
+    if args.slide is not None:
+        slide_fn, slide_config = os.path.abspath(args.slide), dict(slide=os.path.abspath(args.slide))
+    else:
+        slide_fn, slide_config = get_fixture(args)
+    results = {
+        "slide": slide_config,
+        "parameters": repr(kwargs),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "stages": {},
+    }
+    for stage in args.stages.split(","):
+        results["stages"][stage] = measure_stage(stage, slide_fn, kwargs, args.repeat)
+        r = results["stages"][stage]
+        print("%-16s %9.3f s %10.1f tiles/s %9.1f MB/s %9.1f MB RSS (workers %.1f MB)"
+              % (stage, r["seconds"], r["tiles_per_s"] or 0, r["MB_per_s"] or 0, r["peak_rss_MB"], r["peak_rss_workers_MB"]))
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
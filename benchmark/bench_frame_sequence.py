@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from WSI_DICOM_Converter import WSIDICOM_Converter, frame_info
+from frame_sequence import encode_frame_sequence
+'''
+Cost of building and serializing PerFrameFunctionalGroupsSequence for 100k frames:
+pydicom datasets (add_Frame_Sequence_data) vs the precompiled template (frame_sequence.py).
+Usage: python benchmark/bench_frame_sequence.py [frame count]
+'''
+
+
+def make_frame_info(frame_cnt, patch_size=(512, 512)):
+    rows = 300
+    locations = [[(idx // rows) * patch_size[0], (idx % rows) * patch_size[1]] for idx in range(frame_cnt)]
+    DimensionIndexValues = [[idx // rows + 1, idx % rows + 1] for idx in range(frame_cnt)]
+    return frame_info(0, locations, DimensionIndexValues, patch_size)
+
+
+def bench_dataset(frame_items_info):
+    converter = SimpleNamespace(level_downsamples=[1.0])
+    ds = Dataset()
+    ds.PerFrameFunctionalGroupsSequence = WSIDICOM_Converter.add_Frame_Sequence_data(converter, frame_items_info)
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = False
+    write_dataset(fp, ds)
+    return len(fp.getvalue())
+
+
+def bench_template(frame_items_info):
+    return len(encode_frame_sequence(frame_items_info.locations, frame_items_info.DimensionIndexValues, 1.0, (20, 40), 0.00025, False))
+
+
+if __name__ == "__main__":
+    frame_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frame_items_info = make_frame_info(frame_cnt)
+    for name, bench in (("dataset", bench_dataset), ("template", bench_template)):
+        start = time.perf_counter()
+        size = bench(frame_items_info)
+        elapsed = time.perf_counter() - start
+        # memory is measured in a second run, tracemalloc slows down the first one too much
+        tracemalloc.start()
+        bench(frame_items_info)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-8s %8.3f s per 100k frames, %7.1f MB peak, %6.1f MB encoded"
+              % (name, elapsed * 100000 / frame_cnt, peak * 100000 / frame_cnt / 2 ** 20, size / 2 ** 20))
@@ -0,0 +1,178 @@
+import os
+import re
+import ast
+import json
+import hashlib
+import numpy as np
+'''
+Checkpoint of a conversion, so an interrupted conversion can be resumed.
+The checkpoint is a JSON-lines file in the output directory. The first line records the parameters of the conversion
+(each resumed conversion adds a line with its own), then one line is appended each time an instance is completely
+written (instances are written to a temporary file and renamed, so a finished instance is never partial). An instance is skipped on resume only if it was written with the
+same parameters, the same frame plan, and the file is still there with the recorded size.
+'''
+
+CHECKPOINT_FILENAME = "conversion_checkpoint.jsonl"
+# parameters which don't change the output
+RUNTIME_PARAMETERS = ("workers", "worker_type", "frames_per_task", "read_cache_size", "memory_limit", "resume", "metrics_jsonl",
+                      "metrics_prometheus", "metrics_interval", "SPATIAL_INDEX")
+# parameters which only change which patches are saved, covered by the frame plan hash of each instance, so an
+# incremental conversion (see roi.py) keeps the instances of the previous ones
+PLAN_PARAMETERS = ("image_levels", "regions", "incremental")
+
+
+# parameters of a conversion as a json-able dict, values json can't hold (i.e. ranges) are saved as their repr
+def parameters_record(parameters):
+    record = {}
+    for key, value in sorted(vars(parameters).items()):
+        if key in RUNTIME_PARAMETERS or key in PLAN_PARAMETERS:
+            continue
+        if isinstance(value, tuple):
+            value = list(value)
+        if not isinstance(value, (bool, int, float, str, list, type(None))):
+            value = repr(value)
+        record[key] = value
+    return record
+
+
+# every parameter of a conversion but the runtime ones, {key: {"value": json value} or {"repr": repr of the value}}, so
+# they can be read back by recorded_parameters, i.e. to verify the conversion (see WSI_DICOM_Verify.py)
+def parameters_values(parameters):
+    values = {}
+    for key, value in sorted(vars(parameters).items()):
+        if key in RUNTIME_PARAMETERS:
+            continue
+        if isinstance(value, (bool, int, float, str, type(None))):
+            values[key] = {"value": value}
+        else:
+            values[key] = {"repr": repr(value)}
+    return values
+
+
+# value of a parameter from its repr: literals (tuples, lists, dicts...) and ranges
+def parse_value(text):
+    match = re.fullmatch(r"range\((-?\d+), (-?\d+)(?:, (-?\d+))?\)", text)
+    if match:
+        return range(*(int(v) for v in match.groups() if v is not None))
+    return ast.literal_eval(text)
+
+
+# parameters_values of the last conversion recorded in a checkpoint file, None if there are none
+def last_parameters_values(fn):
+    values = None
+    if os.path.exists(fn):
+        with open(fn) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "parameters_values" in record:
+                    values = record["parameters_values"]   # i.e. resumed with other image levels
+    return values
+
+
+def recorded_parameters(save_to_dir, filename=CHECKPOINT_FILENAME):
+    '''
+    parameters of the last conversion into a directory, as recorded in its checkpoint
+    :return: {attribute of class parameters: value}, None if there is no checkpoint or it doesn't record them
+    '''
+    fn = os.path.join(save_to_dir, filename)
+    values = last_parameters_values(fn)
+    if values is None:
+        return None
+    result = {}
+    for key, value in values.items():
+        if "repr" not in value:
+            result[key] = value["value"]
+            continue
+        try:
+            result[key] = parse_value(value["repr"])
+        except (ValueError, SyntaxError):
+            raise Exception("Parameter %s=%s recorded in %s can't be read back" % (key, value["repr"], fn))
+    return result
+
+
+def record_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+
+# hash of the frames planned for an instance: image level, patch size, level dimensions and every frame position
+def frame_plan_hash(frame_items_info, level_dimensions):
+    h = hashlib.sha1()
+    h.update(json.dumps([int(frame_items_info.img_level), list(frame_items_info.patch_size), list(level_dimensions)]).encode())
+    h.update(np.ascontiguousarray(frame_items_info.locations, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(frame_items_info.DimensionIndexValues, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class conversion_checkpoint:
+    def __init__(self, save_to_dir, parameters, filename=CHECKPOINT_FILENAME):
+        '''
+        :param save_to_dir: output directory of the conversion, the checkpoint is saved there
+        :param parameters: parameters of the conversion, see class parameters
+        :param filename: file name of the checkpoint in save_to_dir, i.e. one per shard, see WSI_DICOM_Shard.py
+        '''
+        self.filename = os.path.join(save_to_dir, filename)
+        self.parameters = parameters_record(parameters)
+        self.parameters_hash = record_hash(self.parameters)
+        self.parameters_values = parameters_values(parameters)   # not part of the hash, see recorded_parameters
+        self.instances = {}   # instance index -> record of the completed instance, from the checkpoint file
+        self.load()
+
+    # read the records of completed instances, written with the current parameters
+    def load(self):
+        self.instances = {}
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue   # a line cut by an interruption
+                if "instance" in record and record.get("parameters_hash") == self.parameters_hash:
+                    self.instances[record["instance"]] = record
+
+    def start(self, resume, remove_partial=True):
+        '''
+        start a conversion, before any instance is written
+        :param resume: keep the records of a previous conversion with the same parameters; if False, or if the
+        parameters changed, the checkpoint starts over
+        :param remove_partial: remove the partial instances of the output directory, left by an interrupted conversion.
+        False when other processes may be writing instances into the same directory
+        '''
+        save_to_dir = os.path.dirname(self.filename)
+        os.makedirs(save_to_dir, exist_ok=True)
+        for fn in os.listdir(save_to_dir) if remove_partial else []:
+            if fn.endswith(".partial"):
+                os.remove(os.path.join(save_to_dir, fn))   # left by an interrupted conversion
+        if resume and self.instances:
+            # the plan parameters (i.e. image levels) may have changed
+            if last_parameters_values(self.filename) != self.parameters_values:
+                with open(self.filename, "a") as fp:
+                    fp.write(json.dumps({"parameters_values": self.parameters_values}) + "\n")
+            return
+        with open(self.filename, "w") as fp:
+            fp.write(json.dumps({"parameters": self.parameters, "parameters_hash": self.parameters_hash,
+                                 "parameters_values": self.parameters_values}) + "\n")
+        self.instances = {}
+
+    # whether an instance was completed by a previous conversion and can be skipped
+    def is_done(self, instance_idx, plan_hash, filename):
+        record = self.instances.get(instance_idx)
+        if record is None or record["plan_hash"] != plan_hash or record["filename"] != os.path.basename(filename):
+            return False
+        return os.path.exists(filename) and os.path.getsize(filename) == record["size"]
+
+    # record a completed instance. One line per write, appended, so workers of a batch can share the file.
+    # Byte ranges of the frames are kept for the spatial index, see spatial_index.py
+    def done(self, instance_idx, plan_hash, filename, NumberOfFrames, frame_offsets=None, frame_lengths=None):
+        record = {"instance": instance_idx, "filename": os.path.basename(filename), "frames": NumberOfFrames,
+                  "size": os.path.getsize(filename), "plan_hash": plan_hash, "parameters_hash": self.parameters_hash}
+        if frame_offsets is not None:
+            record["frame_offsets"] = [int(v) for v in frame_offsets]
+            record["frame_lengths"] = [int(v) for v in frame_lengths]
+        self.instances[instance_idx] = record
+        with open(self.filename, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
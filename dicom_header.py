@@ -0,0 +1,122 @@
+import os
+import copy
+import json
+from pydicom.charset import convert_encodings
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element, write_file_meta_info
+from pydicom.sequence import Sequence
+from pydicom.tag import Tag
+try:
+    import yaml   # optional, only needed for YAML header templates
+except ImportError:
+    yaml = None
+'''
+Header of the Dicom instances: the elements that are the same for all the instances of a slide come from a template
+(header_template.json by default), and are encoded once per slide. Each instance only encodes its own elements
+(UIDs, InstanceNumber, NumberOfFrames, TotalPixelMatrix size, functional groups...), which are merged in tag order
+with the encoded template elements, so instances don't share any mutable dataset.
+Templates map element keywords to values: lists of objects for sequences, hex strings for AT elements
+(i.e. "0048021E"), strings for binary elements.
+'''
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "header_template.json")
+BINARY_VRS = ("OB", "OD", "OF", "OL", "OV", "OW", "UN")
+
+
+def read_template(filename):
+    with open(filename) as fp:
+        if os.path.splitext(filename)[1].lower() in (".yaml", ".yml"):
+            if yaml is None:
+                raise Exception("YAML header templates require pyyaml, install it with: pip install pyyaml")
+            return yaml.safe_load(fp) or {}
+        return json.load(fp)
+
+
+def load_template(template=None):
+    '''
+    elements of the default template, updated with those of template
+    :param template: file name of a JSON or YAML template, or a dict, with the elements to add or replace.
+    An element set to None is removed from the default template
+    :return: dict, element keyword -> value
+    '''
+    elements = read_template(DEFAULT_TEMPLATE)
+    if template is not None:
+        elements.update(read_template(template) if isinstance(template, str) else template)
+    return {keyword: value for keyword, value in elements.items() if value is not None}
+
+
+def dataset_from_template(elements):
+    '''
+    :param elements: dict, element keyword -> value, see load_template
+    :return: pydicom Dataset
+    '''
+    ds = Dataset()
+    for keyword, value in elements.items():
+        if tag_for_keyword(keyword) is None:
+            raise Exception("Unknown element keyword in header template: %s" % keyword)
+        VR = dictionary_VR(keyword)
+        if VR == "SQ":
+            value = Sequence([dataset_from_template(item) for item in value])
+        elif VR == "AT":
+            value = Tag(int(value, 16))
+        elif VR in BINARY_VRS and isinstance(value, str):
+            value = value.encode("latin-1")
+        setattr(ds, keyword, value)
+    return ds
+
+
+class header_encoder:
+    def __init__(self, ds, is_implicit_VR, is_little_endian, preamble=b"\0" * 128):
+        '''
+        :param ds: dataset with the elements shared by all the instances, encoded once here
+        :param is_implicit_VR: whether the transfer syntax is implicit VR
+        :param is_little_endian: whether the transfer syntax is little endian
+        :param preamble: 128 bytes preamble of the files
+        '''
+        self.is_implicit_VR = is_implicit_VR
+        self.is_little_endian = is_little_endian
+        self.preamble = preamble
+        self.encodings = convert_encodings(ds.get("SpecificCharacterSet", "ISO_IR 6"))
+        self.SOPClassUID = ds.get("SOPClassUID")
+        self.elements = self.encode_elements(ds)
+
+    # encode the top level elements of a dataset, tag -> bytes
+    def encode_elements(self, ds):
+        fp = DicomBytesIO()
+        fp.is_little_endian = self.is_little_endian
+        fp.is_implicit_VR = self.is_implicit_VR
+        elements = {}
+        for tag in sorted(ds.keys()):
+            start = fp.tell()
+            write_data_element(fp, ds.get_item(tag), self.encodings)
+            elements[tag] = fp.getvalue()[start:]
+        return elements
+
+    def encode(self, file_meta, ds, encoded_elements=None):
+        '''
+        encode the header of an instance: preamble, file meta information and every element before PixelData
+        :param file_meta: file meta information, MediaStorageSOPClassUID and MediaStorageSOPInstanceUID are set from
+        SOPClassUID and SOPInstanceUID in a copy, as pydicom does when saving a dataset
+        :param ds: elements of this instance, replacing the template elements with the same tags
+        :param encoded_elements: elements of this instance already encoded, tag -> bytes,
+        i.e. PerFrameFunctionalGroupsSequence (see frame_sequence.py)
+        :return: bytes
+        '''
+        file_meta = copy.deepcopy(file_meta)
+        SOPClassUID = ds.get("SOPClassUID", self.SOPClassUID)
+        if SOPClassUID is not None:
+            file_meta.MediaStorageSOPClassUID = SOPClassUID
+        if "SOPInstanceUID" in ds:
+            file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        fp = DicomBytesIO()
+        fp.write(self.preamble + b"DICM")
+        write_file_meta_info(fp, file_meta, enforce_standard=True)
+        elements = dict(self.elements)
+        elements.update(self.encode_elements(ds))
+        if encoded_elements:
+            elements.update(encoded_elements)
+        for tag in sorted(elements):
+            fp.write(elements[tag])
+        return fp.getvalue()
@@ -0,0 +1,126 @@
+from io import BytesIO
+import numpy as np
+from PIL import Image, features
+try:
+    import imagecodecs   # optional, only needed for JPEG-LS and HTJ2K
+except ImportError:
+    imagecodecs = None
+'''
+Codecs for Dicom frames. Each codec knows its transfer syntax, the PhotometricInterpretation of the frames it
+produces and whether it is lossy, so the converter can set the matching tags.
+Frames are encoded from RGB PIL images, and decoded back into (rows, columns, 3) uint8 arrays.
+'''
+
+
+class frame_codec:
+    def __init__(self, name, TransferSyntaxUID, PhotometricInterpretation, encode, decode, encapsulated=True,
+                 LossyImageCompressionMethod=None, requires=None):
+        '''
+        :param name: name of the codec, as used in parameters(codec=...)
+        :param TransferSyntaxUID: transfer syntax of the instances
+        :param PhotometricInterpretation: color space of the encoded frames
+        :param encode: function(img, Quality) -> bytes, img is an RGB PIL image
+        :param decode: function(data, patch_size) -> (rows, columns, 3) uint8 array
+        :param encapsulated: whether frames are compressed and encapsulated, or native pixel data
+        :param LossyImageCompressionMethod: Dicom code of the compression method, None for lossless codecs
+        :param requires: function returning the reason the codec can't be used here, None if it can
+        '''
+        self.name = name
+        self.TransferSyntaxUID = TransferSyntaxUID
+        self.PhotometricInterpretation = PhotometricInterpretation
+        self.encode = encode
+        self.decode = decode
+        self.encapsulated = encapsulated
+        self.LossyImageCompressionMethod = LossyImageCompressionMethod
+        self.lossy = LossyImageCompressionMethod is not None
+        self.requires = requires
+
+    def available(self):
+        return self.requires is None or self.requires() is None
+
+    # raise an exception if the codec can't be used
+    def check(self):
+        if not self.available():
+            raise Exception("Codec %s is not available: %s" % (self.name, self.requires()))
+
+
+def _requires_openjpeg():
+    return None if features.check("jpg_2000") else "Pillow is built without OpenJPEG"
+
+
+def _requires_imagecodecs():
+    return None if imagecodecs is not None else "requires imagecodecs, install it with: pip install imagecodecs"
+
+
+def _encode_jpeg(img, Quality):
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=Quality, icc_profile=img.info.get('icc_profile'), progressive=False)
+    return buffer.getvalue()
+
+
+def _encode_jpeg2000_lossless(img, Quality):
+    buffer = BytesIO()
+    img.save(buffer, "JPEG2000", no_jp2=True, irreversible=False, mct=1)   # J2K code stream, reversible color transform
+    return buffer.getvalue()
+
+
+# Quality [0-100] is mapped to a target PSNR of 30 + Quality / 5 dB, i.e. 45 dB for the default 75
+def _encode_jpeg2000(img, Quality):
+    buffer = BytesIO()
+    img.save(buffer, "JPEG2000", no_jp2=True, irreversible=True, mct=1, quality_mode="dB", quality_layers=[30 + Quality / 5])
+    return buffer.getvalue()
+
+
+# imagecodecs sizes the output for compressible images: incompressible frames (i.e. noise) code to slightly more than
+# their raw size and don't fit, they are encoded again into a buffer of the worst case size
+def _encode_jpegls_lossless(img, Quality):
+    pixels = np.asarray(img)
+    try:
+        return imagecodecs.jpegls_encode(pixels)
+    except imagecodecs.JpeglsError:
+        return imagecodecs.jpegls_encode(pixels, out=pixels.nbytes * 2 + 4096)
+
+
+def _encode_htj2k_lossless(img, Quality):
+    return imagecodecs.htj2k_encode(np.asarray(img))   # reversible, with the color transform
+
+
+def _encode_native(img, Quality):
+    return img.tobytes()
+
+
+def _decode_pil(data, patch_size):
+    return np.asarray(Image.open(BytesIO(data)).convert("RGB"))
+
+
+def _decode_jpegls(data, patch_size):
+    return imagecodecs.jpegls_decode(data)
+
+
+def _decode_htj2k(data, patch_size):
+    return imagecodecs.htj2k_decode(data)
+
+
+def _decode_native(data, patch_size):
+    return np.frombuffer(data, dtype=np.uint8).reshape(patch_size[1], patch_size[0], 3)
+
+
+CODECS = {codec.name: codec for codec in (
+    frame_codec("jpeg_baseline", "1.2.840.10008.1.2.4.50", "YBR_FULL_422", _encode_jpeg, _decode_pil,
+                LossyImageCompressionMethod="ISO_10918_1"),
+    frame_codec("jpeg2000_lossless", "1.2.840.10008.1.2.4.90", "YBR_RCT", _encode_jpeg2000_lossless, _decode_pil,
+                requires=_requires_openjpeg),
+    frame_codec("jpeg2000", "1.2.840.10008.1.2.4.91", "YBR_ICT", _encode_jpeg2000, _decode_pil,
+                LossyImageCompressionMethod="ISO_15444_1", requires=_requires_openjpeg),
+    frame_codec("jpegls_lossless", "1.2.840.10008.1.2.4.80", "RGB", _encode_jpegls_lossless, _decode_jpegls,
+                requires=_requires_imagecodecs),
+    frame_codec("htj2k_lossless", "1.2.840.10008.1.2.4.201", "YBR_RCT", _encode_htj2k_lossless, _decode_htj2k,
+                requires=_requires_imagecodecs),
+    frame_codec("uncompressed", "1.2.840.10008.1.2", "RGB", _encode_native, _decode_native, encapsulated=False),
+)}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise Exception("Unknown codec %s, should be one of: %s" % (name, ", ".join(CODECS)))
+    return CODECS[name]
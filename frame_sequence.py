@@ -0,0 +1,105 @@
+import struct
+import numpy as np
+'''
+Encode PerFrameFunctionalGroupsSequence directly into bytes.
+Every frame item has the same layout, so the items are laid out as a NumPy structured array: the element and
+item headers are constant fields of the template, only the values (dimension index, plane position) are filled
+per frame, with vectorized arithmetic. Decimal strings are padded to 16 characters to keep items the same size.
+'''
+
+PerFrameFunctionalGroupsSequence_TAG = 0x52009230
+LONG_VRS = (b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"UC", b"UN", b"UR", b"UT")
+
+
+# header of a data element (or item, with VR=None) with defined length, little endian
+def element_header(tag, VR, length, implicit_VR):
+    group, element = tag >> 16, tag & 0xFFFF
+    if implicit_VR or VR is None:
+        return struct.pack("<HHI", group, element, length)
+    if VR in LONG_VRS:
+        return struct.pack("<HH2sHI", group, element, VR, 0, length)
+    return struct.pack("<HH2sH", group, element, VR, length)
+
+
+def item_header(length):
+    return element_header(0xFFFEE000, None, length, True)
+
+
+# the per frame item as a list of fields: bytes for constant parts, (name, dtype) for the values of each frame
+def frame_item_template(implicit_VR):
+    def element(tag, VR, value_length):
+        return element_header(tag, VR, value_length, implicit_VR)
+
+    FrameContent = element(0x00209157, b"UL", 8)   # DimensionIndexValues
+    FrameContent_length = len(FrameContent) + 8
+    PlanePosition = [
+        element(0x0040072A, b"DS", 16),   # XOffsetInSlideCoordinateSystem
+        element(0x0040073A, b"DS", 16),   # YOffsetInSlideCoordinateSystem
+        element(0x0040074A, b"DS", 2) + b"0 ",   # ZOffsetInSlideCoordinateSystem
+        element(0x0048021E, b"SL", 4),   # ColumnPositionInTotalImagePixelMatrix
+        element(0x0048021F, b"SL", 4),   # RowPositionInTotalImagePixelMatrix
+    ]
+    PlanePosition_length = sum(len(h) for h in PlanePosition) + 16 + 16 + 4 + 4
+    FrameContentSequence_length = 8 + FrameContent_length
+    PlanePositionSlideSequence_length = 8 + PlanePosition_length
+    item_length = len(element(0x00209111, b"SQ", 0)) + FrameContentSequence_length \
+        + len(element(0x0048021A, b"SQ", 0)) + PlanePositionSlideSequence_length
+    return [
+        item_header(item_length)
+        + element(0x00209111, b"SQ", FrameContentSequence_length)   # FrameContentSequence
+        + item_header(FrameContent_length) + FrameContent,
+        ("DimensionIndexValues", "<u4", (2,)),
+        element(0x0048021A, b"SQ", PlanePositionSlideSequence_length)   # PlanePositionSlideSequence
+        + item_header(PlanePosition_length) + PlanePosition[0],
+        ("XOffsetInSlideCoordinateSystem", "S16"),
+        PlanePosition[1],
+        ("YOffsetInSlideCoordinateSystem", "S16"),
+        PlanePosition[2] + PlanePosition[3],
+        ("ColumnPositionInTotalImagePixelMatrix", "<i4"),
+        PlanePosition[4],
+        ("RowPositionInTotalImagePixelMatrix", "<i4"),
+    ]
+
+
+# format decimal strings (DS) of exactly 16 characters: sign (space for positive), 6 integer digits, '.', 8 decimals
+def format_DS(values):
+    scaled = np.round(np.abs(values) * 1e8).astype(np.int64)
+    if (scaled >= 10 ** 14).any():
+        strs = np.char.mod("%.9g", values)
+        return np.char.ljust(np.char.encode(strs, "ascii"), 16)
+    chars = np.empty((len(values), 16), dtype=np.uint8)
+    chars[:, 0] = np.where(values < 0, ord("-"), ord(" "))
+    digits = (scaled[:, None] // 10 ** np.arange(13, -1, -1, dtype=np.int64)) % 10 + ord("0")
+    chars[:, 1:7] = digits[:, :6]
+    chars[:, 7] = ord(".")
+    chars[:, 8:] = digits[:, 6:]
+    return chars.view("S16").ravel()
+
+
+def encode_frame_sequence(locations, DimensionIndexValues, downsample, origin, pixel_spacing, implicit_VR):
+    '''
+    encode the PerFrameFunctionalGroupsSequence data element of an instance
+    :param locations: (n, 2) patch locations on level 0, [[x1, y1], [x2, y2]...]
+    :param DimensionIndexValues: (n, 2) patch indexing, [[1,1], [1, 2], [1, 3] ...]
+    :param downsample: downsample rate of the image level
+    :param origin: (x, y) of the image origin in the slide coordinate system, in mm
+    :param pixel_spacing: level 0 pixel size in mm
+    :param implicit_VR: encode with implicit or explicit VR (little endian)
+    :return: bytes of the whole data element
+    '''
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+    template = frame_item_template(implicit_VR)
+    fields = []
+    for idx, field in enumerate(template):
+        fields.append(("_%d" % idx, "S%d" % len(field)) if isinstance(field, bytes) else field)
+    items = np.empty(len(locations), dtype=np.dtype(fields))
+    for idx, field in enumerate(template):
+        if isinstance(field, bytes):
+            items["_%d" % idx] = field
+    items["DimensionIndexValues"] = np.asarray(DimensionIndexValues).reshape(-1, 2)
+    items["XOffsetInSlideCoordinateSystem"] = format_DS(origin[0] + locations[:, 0] * pixel_spacing)
+    items["YOffsetInSlideCoordinateSystem"] = format_DS(origin[1] + locations[:, 1] * pixel_spacing)
+    items["ColumnPositionInTotalImagePixelMatrix"] = (locations[:, 0] / downsample).astype(np.int32) + 1
+    items["RowPositionInTotalImagePixelMatrix"] = (locations[:, 1] / downsample).astype(np.int32) + 1
+    value = items.tobytes()
+    return element_header(PerFrameFunctionalGroupsSequence_TAG, b"SQ", len(value), implicit_VR) + value
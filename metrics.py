@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import threading
+'''
+Instrumentation of a conversion: time spent in each stage, frames and bytes written, frames/s, ETA and the number of
+tasks waiting in the worker queue. Observers are called with (event, snapshot), snapshot being a json-able dict.
+Events: 'start', 'instance_start', 'instance_done', 'progress' (at most every interval seconds) and 'done'.
+Stages timed in the workers (read_region, tile_decode, assemble, encode, passthrough) are summed over all the workers.
+'''
+
+
+# add seconds to a stage of a {stage: [seconds, count]} dict
+def add_time(times, stage, seconds, count=1):
+    entry = times.get(stage)
+    if entry is None:
+        times[stage] = [seconds, count]
+    else:
+        entry[0] += seconds
+        entry[1] += count
+
+
+class stage_timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class conversion_metrics:
+    def __init__(self, slide, interval=1.0):
+        '''
+        :param slide: file name of the slide, added to every snapshot
+        :param interval: minimum seconds between two 'progress' events
+        '''
+        self.slide = slide
+        self.interval = interval
+        self.observers = []
+        self.times = {}   # stage -> [seconds, count]
+        self.queue_depth = {}   # queue name -> tasks in flight, or frames waiting for the writer
+        self.schedule = None   # workers, frames per task and queue depths chosen for the conversion, see scheduler.py
+        # stages are timed and events emitted from the main thread and the writer thread (see scheduler.py):
+        # lock guards times, queue_depth and the counters, emit_lock the observers
+        self.lock = threading.Lock()
+        self.emit_lock = threading.Lock()
+        self.frames_total = 0
+        self.frames_done = 0
+        self.bytes_written = 0
+        self.instance = None
+        self.instances = 0
+        self.start_time = time.time()
+        self.last_progress = 0.0
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def timer(self, stage):
+        return stage_timer(self, stage)
+
+    def add_time(self, stage, seconds, count=1):
+        with self.lock:
+            add_time(self.times, stage, seconds, count)
+
+    # merge the stage times returned by a worker task
+    def add_times(self, times):
+        if times:
+            with self.lock:
+                for stage, (seconds, count) in times.items():
+                    add_time(self.times, stage, seconds, count)
+
+    def set_queue_depth(self, name, depth):
+        with self.lock:
+            self.queue_depth[name] = depth
+
+    def start(self, frames_total, instances):
+        self.frames_total = frames_total
+        self.instances = instances
+        self.start_time = time.time()
+        self.emit("start")
+
+    def instance_start(self, instance_idx):
+        self.instance = instance_idx
+        self.emit("instance_start")
+
+    def instance_done(self, instance_idx, frames, skipped=False):
+        self.instance = instance_idx
+        if skipped:
+            self.frames_total -= frames   # completed by a previous conversion, not part of this one's speed
+        self.emit("instance_done")
+
+    def frames_written(self, frames, bytes_written):
+        with self.lock:
+            self.frames_done += frames
+            self.bytes_written += bytes_written
+        if time.time() - self.last_progress >= self.interval:
+            self.emit("progress")
+
+    def done(self):
+        self.emit("done")
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        elapsed = time.time() - self.start_time
+        frames_per_s = self.frames_done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.frames_total - self.frames_done, 0)
+        return {
+            "slide": self.slide,
+            "time": round(time.time(), 3),
+            "elapsed_s": round(elapsed, 3),
+            "instance": self.instance,
+            "instances": self.instances,
+            "frames_done": self.frames_done,
+            "frames_total": self.frames_total,
+            "frames_per_s": round(frames_per_s, 2),
+            "bytes_written": self.bytes_written,
+            "eta_s": round(remaining / frames_per_s, 1) if frames_per_s > 0 else None,
+            "stages": {stage: {"seconds": round(seconds, 6), "count": count} for stage, (seconds, count) in self.times.items()},
+            "queue_depth": dict(self.queue_depth),
+            "schedule": self.schedule,
+        }
+
+    def emit(self, event):
+        with self.emit_lock:
+            if event == "progress" or event == "done":
+                self.last_progress = time.time()
+            if self.observers:
+                snapshot = self.snapshot()
+                for observer in self.observers:
+                    observer(event, snapshot)
+
+
+class jsonl_observer:
+    '''
+    Append one json line per event to a file
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, event, snapshot):
+        with open(self.filename, "a") as fp:
+            fp.write(json.dumps(dict(snapshot, event=event)) + "\n")
+
+
+class prometheus_observer:
+    '''
+    Write the latest metrics in Prometheus text format, i.e. for the textfile collector of node_exporter.
+    The file is replaced atomically on each event.
+    '''
+    def __init__(self, filename, prefix="wsi_dicom"):
+        self.filename = filename
+        self.prefix = prefix
+
+    def __call__(self, event, snapshot):
+        slide = snapshot["slide"].replace("\\", "\\\\").replace('"', '\\"')
+        lines = []
+
+        def metric(name, kind, value, **labels):
+            if value is None:
+                return
+            label_str = ",".join(['slide="%s"' % slide] + ['%s="%s"' % item for item in labels.items()])
+            if not lines or not lines[-1].startswith("%s_%s{" % (self.prefix, name)):
+                lines.append("# TYPE %s_%s %s" % (self.prefix, name, kind))
+            lines.append("%s_%s{%s} %s" % (self.prefix, name, label_str, value))
+
+        metric("frames_written_total", "counter", snapshot["frames_done"])
+        metric("frames_planned", "gauge", snapshot["frames_total"])
+        metric("bytes_written_total", "counter", snapshot["bytes_written"])
+        metric("frames_per_second", "gauge", snapshot["frames_per_s"])
+        metric("eta_seconds", "gauge", snapshot["eta_s"])
+        metric("elapsed_seconds", "gauge", snapshot["elapsed_s"])
+        for stage, entry in sorted(snapshot["stages"].items()):
+            metric("stage_seconds_total", "counter", entry["seconds"], stage=stage)
+        for stage, entry in sorted(snapshot["stages"].items()):
+            metric("stage_calls_total", "counter", entry["count"], stage=stage)
+        for queue, depth in sorted(snapshot["queue_depth"].items()):
+            metric("queue_depth", "gauge", depth, queue=queue)
+        schedule = snapshot.get("schedule") or {}
+        for decision in ("workers", "frames_per_task", "read_cache_size", "tasks_in_flight", "write_queue_frames", "memory_limit"):
+            metric("schedule", "gauge", schedule.get(decision), decision=decision)
+        if schedule.get("estimate"):
+            metric("estimated_peak_memory_bytes", "gauge", schedule["estimate"]["total"])
+        with open(self.filename + ".tmp", "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(self.filename + ".tmp", self.filename)
@@ -0,0 +1,80 @@
+import numpy as np
+'''
+Build lower resolution levels of a 2x pyramid from the tiles of the level above, in a single streaming pass.
+Each tile of level k-1 is downsampled once and placed into one quadrant of a level k tile, a level k tile is
+emitted as soon as all its quadrants arrived. Only about one column (or row) of tiles per level is kept in memory.
+'''
+
+
+# dimensions of a 2x pyramid, from level 0 down to the first level fitting in thumbnail_size
+def pyramid_dimensions(dimensions, thumbnail_size):
+    level_dimensions = [tuple(dimensions)]
+    while level_dimensions[-1][0] > thumbnail_size or level_dimensions[-1][1] > thumbnail_size:
+        w, h = level_dimensions[-1]
+        level_dimensions.append((-(-w // 2), -(-h // 2)))
+    return level_dimensions
+
+
+# 2x box filter downsampling of a tile, (h, w, c) uint8 -> (h/2, w/2, c) uint8, h and w are even
+def downsample_2x(tile):
+    h, w = tile.shape[:2]
+    blocks = tile.reshape(h // 2, 2, w // 2, 2, -1).astype(np.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) >> 2).astype(np.uint8)
+
+
+class pyramid_builder:
+    def __init__(self, grid_sizes, patch_size, background=255, level_dimensions=None):
+        '''
+        :param grid_sizes: [(columns, rows), ...] of the patch grid of each level, starting from the base level
+        :param patch_size: (width, height) of patches
+        :param background: fill value for tile areas without any source tile
+        :param level_dimensions: [(width, height), ...] of each level, starting from the base level. Tiles on the right
+            and bottom edges are cropped to them and padded with their edge pixels before downsampling, so the padding
+            of the edge tiles doesn't bleed into the lower levels. If None, tiles are downsampled as they are
+        '''
+        self.grid_sizes = grid_sizes
+        self.patch_size = patch_size
+        self.background = background
+        self.level_dimensions = level_dimensions
+        if patch_size[0] % 2 or patch_size[1] % 2:
+            raise Exception("Patch width and height should be even numbers to build a 2x pyramid")
+        self.pending = [dict() for _ in grid_sizes]  # (column, row) -> [tile, number of quadrants received], per level
+
+    # number of level k-1 tiles making up tile (column, row) of level k
+    def _quadrant_count(self, level, column, row):
+        columns, rows = self.grid_sizes[level - 1]
+        return (2 if 2 * column + 1 < columns else 1) * (2 if 2 * row + 1 < rows else 1)
+
+    # tile with the area past the level dimensions replaced by its edge pixels
+    def _pad_edges(self, level, column, row, tile):
+        if self.level_dimensions is None:
+            return tile
+        w = min(self.patch_size[0], self.level_dimensions[level][0] - column * self.patch_size[0])
+        h = min(self.patch_size[1], self.level_dimensions[level][1] - row * self.patch_size[1])
+        if (w, h) == tuple(self.patch_size):
+            return tile
+        return np.pad(tile[:h, :w], ((0, self.patch_size[1] - h), (0, self.patch_size[0] - w), (0, 0)), mode="edge")
+
+    def push(self, column, row, tile, level=0):
+        '''
+        add a tile of the given level (0: base level)
+        :return: [(level, column, row, tile), ...] tiles of lower levels completed by this tile
+        '''
+        completed = []
+        if level + 1 >= len(self.grid_sizes):
+            return completed
+        c, r = column // 2, row // 2
+        pending = self.pending[level + 1]
+        if (c, r) not in pending:
+            acc = np.full((self.patch_size[1], self.patch_size[0], tile.shape[2]), self.background, dtype=np.uint8)
+            pending[(c, r)] = [acc, 0]
+        acc = pending[(c, r)]
+        x0 = (column % 2) * self.patch_size[0] // 2
+        y0 = (row % 2) * self.patch_size[1] // 2
+        acc[0][y0:y0 + self.patch_size[1] // 2, x0:x0 + self.patch_size[0] // 2] = downsample_2x(self._pad_edges(level, column, row, tile))
+        acc[1] += 1
+        if acc[1] == self._quadrant_count(level + 1, c, r):
+            del pending[(c, r)]
+            completed.append((level + 1, c, r, acc[0]))
+            completed.extend(self.push(c, r, acc[0], level + 1))
+        return completed
@@ -0,0 +1,277 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from metrics import add_time
+try:
+    import tifffile   # optional, only needed to decode native tiles without OpenSlide
+except ImportError:
+    tifffile = None
+'''
+Batched reading of frames, between the converter and OpenSlide.
+The frames of a task that are next to each other (i.e. down a column of the frame plan) are read as one band: the
+native tiles of the slide covering the band are decoded once into one RGB buffer, and frames are views of that buffer.
+Native tiles of tiled TIFF levels (i.e. Aperio SVS, generic tiled TIFF) are read and decoded with tifffile, without
+going through OpenSlide's compositing, when a sample tile of the level decodes to the same pixels as OpenSlide;
+other levels are read from OpenSlide, with as few read_region calls as possible and channels sliced out of RGBA.
+When frames don't line up with the native tiles (i.e. 512 pixels frames on 240 pixels tiles), the native tiles across
+the edges of a band are also needed by the next bands (the next column, or the next frames down the column): they are
+kept decoded in a bounded LRU cache, so each native tile is decoded about once.
+Bands are pixel exact only at integer level coordinates, frames of levels with a fractional downsample (i.e. 4.0011
+in many SVS files) are read one by one from OpenSlide, which interpolates them.
+'''
+
+MAX_BAND_PIXELS = 16 * 2 ** 20   # largest band read at once
+
+
+class tile_cache:
+    def __init__(self, capacity):
+        '''
+        LRU cache of decoded native tiles, safe to share between threads
+        :param capacity: maximum bytes of the cached tiles
+        '''
+        self.capacity = capacity
+        self.tiles = OrderedDict()   # (img_level, column, row) -> (rows, columns, 3) uint8 array
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        if tile.nbytes > self.capacity:
+            return
+        with self.lock:
+            previous = self.tiles.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self.tiles[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.capacity:
+                self.nbytes -= self.tiles.popitem(last=False)[1].nbytes
+
+
+class tiff_tile_decoder:
+    '''
+    Decode the native tiles of the tiled TIFF pages matching the image levels of a slide.
+    '''
+    def __init__(self, wsi_fn, wsi_obj):
+        if tifffile is None:
+            raise Exception("Decoding native tiles requires tifffile, install it with: pip install tifffile")
+        self.tif = tifffile.TiffFile(wsi_fn)
+        self.lock = threading.Lock()  # file handle can be shared by worker threads
+        self.levels = {}   # image level -> tiled page of the same size
+        pages = [page for series in self.tif.series for level in series.levels for page in level.pages]
+        for img_lv, (w, h) in enumerate(wsi_obj.level_dimensions):
+            for page in pages:
+                if (page.imagewidth, page.imagelength) == (w, h) and page.is_tiled and page.samplesperpixel >= 3 \
+                        and page.bitspersample == 8 and page.planarconfig == 1 and page.photometric in (2, 6):
+                    self.levels[img_lv] = page
+                    break
+
+    def tile_size(self, img_level):
+        page = self.levels.get(img_level)
+        return None if page is None else (page.tilewidth, page.tilelength)
+
+    # RGB array of a native tile, pixels outside the level are black as in OpenSlide; None if the tile isn't saved
+    def decode(self, img_level, column, row):
+        page = self.levels[img_level]
+        tiles_across = -(-page.imagewidth // page.tilewidth)
+        if column >= tiles_across or row * page.tilelength >= page.imagelength:
+            return np.zeros((page.tilelength, page.tilewidth, 3), dtype=np.uint8)
+        idx = row * tiles_across + column
+        if page.databytecounts[idx] == 0:
+            return None
+        with self.lock:
+            self.tif.filehandle.seek(page.dataoffsets[idx])
+            data = self.tif.filehandle.read(page.databytecounts[idx])
+        tile = page.decode(data, idx, jpegtables=page.jpegtables)[0]
+        tile = np.array(tile.reshape(page.tilelength, page.tilewidth, -1)[:, :, :3])
+        tile[page.imagelength - row * page.tilelength:] = 0
+        tile[:, page.imagewidth - column * page.tilewidth:] = 0
+        return tile
+
+    def close(self):
+        self.tif.close()
+
+
+class region_reader:
+    def __init__(self, wsi_obj, wsi_fn=None, cache_size=256 * 2 ** 20):
+        '''
+        :param wsi_obj: openslide object
+        :param wsi_fn: file name of the slide, to decode its native tiles with tifffile. If None, only read from OpenSlide
+        :param cache_size: maximum bytes of decoded native tiles kept between bands, 0 to keep none
+        '''
+        self.wsi_obj = wsi_obj
+        self.cache = tile_cache(cache_size)
+        self.tile_sizes = []   # native tile (width, height) of each level, None if the slide doesn't tell
+        for img_lv in range(wsi_obj.level_count):
+            try:
+                self.tile_sizes.append((int(wsi_obj.properties["openslide.level[%d].tile-width" % img_lv]),
+                                        int(wsi_obj.properties["openslide.level[%d].tile-height" % img_lv])))
+            except (KeyError, ValueError):
+                self.tile_sizes.append(None)
+        self.decoder = None
+        self.decoded_levels = set()   # levels whose native tiles are decoded with tifffile
+        if wsi_fn is not None and tifffile is not None:
+            try:
+                self.decoder = tiff_tile_decoder(wsi_fn, wsi_obj)
+            except Exception:
+                self.decoder = None   # not a TIFF file
+        if self.decoder is not None:
+            for img_lv in self.decoder.levels:
+                if self.check_decoder(img_lv):
+                    self.tile_sizes[img_lv] = self.decoder.tile_size(img_lv)
+                    self.decoded_levels.add(img_lv)
+
+    # whether the most detailed tile of a level decodes to the same pixels as OpenSlide reads
+    def check_decoder(self, img_level):
+        ds = self.wsi_obj.level_downsamples[img_level]
+        if ds != int(ds):
+            return False
+        page = self.decoder.levels[img_level]
+        idx = int(np.argmax(page.databytecounts))
+        row, column = divmod(idx, -(-page.imagewidth // page.tilewidth))
+        try:
+            tile = self.decoder.decode(img_level, column, row)
+        except Exception:
+            return False
+        expected = self.read_region(img_level, (column * page.tilewidth, row * page.tilelength),
+                                    (page.tilewidth, page.tilelength))
+        return tile is not None and np.array_equal(tile, expected)
+
+    # RGB array of a region, location and size in pixels of img_level
+    def read_region(self, img_level, location, size, times=None):
+        start = time.perf_counter()
+        ds = self.wsi_obj.level_downsamples[img_level]
+        img = self.wsi_obj.read_region((int(round(location[0] * ds)), int(round(location[1] * ds))), img_level, size)
+        if times is not None:
+            add_time(times, "read_region", time.perf_counter() - start)
+        return np.asarray(img)[:, :, :3]
+
+    def read(self, img_level, patch_size, locations, times=None):
+        '''
+        read frames
+        :param img_level: image level of the frames
+        :param patch_size: (width, height) of the frames
+        :param locations: frame locations on level 0
+        :param times: stage times are added to this {stage: [seconds, count]} dict, if not None
+        :return: list of (rows, columns, 3) uint8 arrays, in the order of locations, possibly views of a shared band
+        '''
+        ds = self.wsi_obj.level_downsamples[img_level]
+        if ds != int(ds):
+            # frames at fractional level coordinates, only OpenSlide can interpolate them
+            frames = []
+            for f_loc in locations:
+                start = time.perf_counter()
+                img = self.wsi_obj.read_region((int(f_loc[0]), int(f_loc[1])), img_level, patch_size)
+                frames.append(np.asarray(img)[:, :, :3])
+                if times is not None:
+                    add_time(times, "read_region", time.perf_counter() - start)
+            return frames
+        w, h = patch_size
+        frames = []
+        band = []
+        for f_loc in locations:
+            x, y = int(f_loc[0]) // int(ds), int(f_loc[1]) // int(ds)
+            if band:
+                # extend the band while its frames exactly cover a rectangle
+                rect = (min(rect[0], x), min(rect[1], y), max(rect[2], x + w), max(rect[3], y + h))
+                area = (rect[2] - rect[0]) * (rect[3] - rect[1])
+                if area == (len(band) + 1) * w * h and area <= MAX_BAND_PIXELS:
+                    band.append((x, y))
+                    continue
+                frames += self.read_band(img_level, patch_size, band, times)
+            band = [(x, y)]
+            rect = (x, y, x + w, y + h)
+        if band:
+            frames += self.read_band(img_level, patch_size, band, times)
+        return frames
+
+    # frames of a band, band being frame locations of img_level covering a rectangle
+    def read_band(self, img_level, patch_size, band, times=None):
+        w, h = patch_size
+        x0, y0 = min(p[0] for p in band), min(p[1] for p in band)
+        x1, y1 = max(p[0] for p in band) + w, max(p[1] for p in band) + h
+        tile_size = self.tile_sizes[img_level]
+        if img_level not in self.decoded_levels and (
+                tile_size is None or tile_size[0] * tile_size[1] > MAX_BAND_PIXELS or
+                (x0 % tile_size[0] == 0 and y0 % tile_size[1] == 0 and w % tile_size[0] == 0 and h % tile_size[1] == 0)):
+            # native tiles unknown or too large, or all inside the band: nothing to share with other bands
+            pixels = self.read_region(img_level, (x0, y0), (x1 - x0, y1 - y0), times)
+        else:
+            pixels = self.read_tiles(img_level, (x0, y0, x1, y1), tile_size, times)
+        return [pixels[y - y0:y - y0 + h, x - x0:x - x0 + w] for x, y in band]
+
+    # RGB array of a rectangle of img_level from its native tiles, decoding or reading the tiles that aren't cached
+    def read_tiles(self, img_level, rect, tile_size, times=None):
+        x0, y0, x1, y1 = rect
+        tw, th = tile_size
+        tx0, ty0, tx1, ty1 = x0 // tw, y0 // th, -(-x1 // tw), -(-y1 // th)
+        pixels = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+
+        def paste(region, rx, ry):
+            # copy the part of region (located at rx, ry on img_level) inside rect
+            left, top = max(rx, x0), max(ry, y0)
+            right, bottom = min(rx + region.shape[1], x1), min(ry + region.shape[0], y1)
+            pixels[top - y0:bottom - y0, left - x0:right - x0] = region[top - ry:bottom - ry, left - rx:right - rx]
+
+        # tiles across the edges of the rectangle are needed by the next bands
+        def shared(tx, ty):
+            return tx * tw < x0 or (tx + 1) * tw > x1 or ty * th < y0 or (ty + 1) * th > y1
+
+        missing = np.zeros((tx1 - tx0, ty1 - ty0), dtype=bool)
+        start = time.perf_counter()
+        for tx in range(tx0, tx1):
+            for ty in range(ty0, ty1):
+                tile = self.cache.get((img_level, tx, ty)) if shared(tx, ty) else None
+                if tile is None and img_level in self.decoded_levels:
+                    tile = self.decoder.decode(img_level, tx, ty)
+                    if tile is not None and shared(tx, ty):
+                        self.cache.put((img_level, tx, ty), tile)
+                if tile is None:
+                    missing[tx - tx0, ty - ty0] = True
+                else:
+                    paste(tile, tx * tw, ty * th)
+        if times is not None:
+            add_time(times, "tile_decode" if img_level in self.decoded_levels else "assemble", time.perf_counter() - start)
+        # read the other tiles from OpenSlide by rectangles: runs of missing rows, shared by consecutive tile columns
+        tx = tx0
+        while tx < tx1:
+            column = missing[tx - tx0]
+            end = tx + 1
+            while end < tx1 and np.array_equal(missing[end - tx0], column):
+                end += 1
+            for run_start, run_end in runs(column):
+                region = self.read_region(img_level, (tx * tw, (ty0 + run_start) * th),
+                                          ((end - tx) * tw, (run_end - run_start) * th), times)
+                start = time.perf_counter()
+                paste(region, tx * tw, (ty0 + run_start) * th)
+                for ctx in range(tx, end):
+                    for cty in range(ty0 + run_start, ty0 + run_end):
+                        if shared(ctx, cty):
+                            ox, oy = (ctx - tx) * tw, (cty - ty0 - run_start) * th
+                            self.cache.put((img_level, ctx, cty), region[oy:oy + th, ox:ox + tw].copy())
+                if times is not None:
+                    add_time(times, "assemble", time.perf_counter() - start)
+            tx = end
+        return pixels
+
+    def close(self):
+        if self.decoder is not None:
+            self.decoder.close()
+
+
+# [(start, end), ...] of the runs of True in a boolean array
+def runs(mask):
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return list(zip(edges[::2], edges[1::2]))
@@ -0,0 +1,69 @@
+import numpy as np
+from PIL import Image, ImageDraw
+from tissue_detection import tissue_grid
+'''
+Regions of interest, so only the patches intersecting them are converted. Regions are given in level 0 pixels, as:
+    a box (x0, y0, x1, y1)
+    a polygon [(x, y), (x, y), ...] of at least 3 points
+    a mask, 2D boolean array covering the whole slide at any resolution (i.e. drawn on a thumbnail)
+parameters(regions=...) takes either a list of regions, used for every image level, or a dict
+{image level: list of regions}, the levels not in the dict being converted entirely.
+'''
+
+SUPERSAMPLING = 4   # polygons are rasterized at 1/4 patch accuracy
+
+
+# regions of an image level, None if the whole level is converted
+def level_regions(regions, img_level):
+    if regions is None:
+        return None
+    if isinstance(regions, dict):
+        return regions.get(img_level)
+    return regions
+
+
+def region_grid(regions, dimensions, step, grid_size):
+    '''
+    whether each patch of a grid intersects any of the regions
+    :param regions: list of regions, see above
+    :param dimensions: (width, height) of the WSI at level 0
+    :param step: (x, y) step between patches, in level 0 pixels
+    :param grid_size: (columns, rows) of the patch grid
+    :return: boolean array of shape (columns, rows)
+    '''
+    grid = np.zeros(grid_size, dtype=bool)
+    for region in regions:
+        if isinstance(region, np.ndarray) and region.dtype == bool:
+            if region.ndim != 2:
+                raise Exception("Region masks should be 2D boolean arrays")
+            grid |= tissue_grid(region, dimensions, step, grid_size)
+            continue
+        points = np.asarray(region, dtype=np.float64)
+        if points.shape == (4,):
+            x0, y0, x1, y1 = points
+            if x1 <= x0 or y1 <= y0:
+                raise Exception("Region box should be (x0, y0, x1, y1) with x0 < x1 and y0 < y1, got %s" % (region,))
+            # clamped to the grid, a box partly or fully outside the slide keeps only the patches it covers
+            c0, r0 = min(max(int(x0 // step[0]), 0), grid_size[0]), min(max(int(y0 // step[1]), 0), grid_size[1])
+            c1, r1 = min(max(int(np.ceil(x1 / step[0])), 0), grid_size[0]), min(max(int(np.ceil(y1 / step[1])), 0), grid_size[1])
+            if c1 > c0 and r1 > r0:
+                grid[c0:c1, r0:r1] = True
+        elif points.ndim == 2 and points.shape[1] == 2 and len(points) >= 3:
+            grid |= polygon_grid(points, step, grid_size)
+        else:
+            raise Exception("Unknown region %r, should be a box, a polygon or a boolean mask" % (region,))
+    return grid
+
+
+def polygon_grid(points, step, grid_size):
+    # rasterized on a finer grid, then a patch is kept if any of its sub-cells is covered
+    scale = np.array([SUPERSAMPLING / step[0], SUPERSAMPLING / step[1]])
+    fine = Image.new("1", (grid_size[0] * SUPERSAMPLING, grid_size[1] * SUPERSAMPLING), 0)
+    ImageDraw.Draw(fine).polygon([tuple(p) for p in points * scale], fill=1, outline=1)
+    fine = np.asarray(fine).T.reshape(grid_size[0], SUPERSAMPLING, grid_size[1], SUPERSAMPLING)
+    grid = fine.any(axis=(1, 3))
+    # vertices, i.e. of polygons smaller than a sub-cell
+    cells = np.floor(points / step).astype(np.int64)
+    inside = (cells[:, 0] >= 0) & (cells[:, 0] < grid_size[0]) & (cells[:, 1] >= 0) & (cells[:, 1] < grid_size[1])
+    grid[cells[inside, 0], cells[inside, 1]] = True
+    return grid
@@ -0,0 +1,219 @@
+import os
+import re
+import queue
+import threading
+'''
+Memory budget of a conversion, and the bounded queues between its stages.
+The stages are: reading and encoding frames (in the workers, by tasks of frames_per_task frames read as one band,
+decoded pixels never leave the worker), the functional groups and header of each instance (main thread), and writing
+(a writer thread). Encoded frames wait for the main thread in the tasks in flight, then for the writer in the write
+queue: both are bounded, so no stage can run ahead of the writer.
+With a memory limit, the worker count, frames per task, read cache, tasks in flight and write queue are sized from an
+estimate of the memory each of them takes, shrinking first what costs the least throughput: the read cache, then the
+tasks in flight (down to one per worker plus one), then the frames per task down to MIN_FRAMES_PER_TASK, then the
+worker count, and below MIN_FRAMES_PER_TASK frames per task last.
+The decisions and the estimate are kept in a dict (converter.schedule), printed, and added to the metrics snapshots.
+'''
+
+MAIN_BASE_BYTES = 100 * 2 ** 20   # main process with its OpenSlide handle and the frame plan of a large slide
+WORKER_BASE_BYTES = 64 * 2 ** 20   # worker process before any task, Python, NumPy, OpenSlide and pydicom loaded
+MIN_FRAMES_PER_TASK = 4   # fewer frames per task are tried only if no worker count fits with these
+# size of an encoded frame relative to the decoded one, conservative
+ENCODED_RATIO = {"lossy": 0.25, "lossless": 0.7, "native": 1.0}
+SIZE_UNITS = {"": 1, "K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9, "T": 10 ** 12,
+              "KI": 2 ** 10, "MI": 2 ** 20, "GI": 2 ** 30, "TI": 2 ** 40}
+
+
+def parse_size(size):
+    '''
+    bytes of a memory size
+    :param size: bytes, or a string as in Kubernetes resource limits: '2GB' or '2G' (10^9), '2GiB' or '2Gi' (2^30)
+    '''
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?I?)B?\s*", str(size).upper())
+    if match is None or match.group(2) not in SIZE_UNITS:
+        raise Exception("Can't read memory size %s, i.e. '2GB' or '2GiB'" % size)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(size):
+    return "%.0f MB" % (size / 2 ** 20)
+
+
+class pipeline_memory:
+    def __init__(self, patch_size, codec, worker_type, pyramid_grid_sizes=None):
+        '''
+        estimate of the memory a conversion takes
+        :param patch_size: (width, height) of the frames
+        :param codec: frame_codec of the conversion, see frame_codecs.py
+        :param worker_type: 'process' or 'thread'
+        :param pyramid_grid_sizes: [(columns, rows), ...] of each level built by GENERATE_PYRAMID, None otherwise
+        '''
+        self.frame_bytes = patch_size[0] * patch_size[1] * 3
+        kind = "native" if not codec.encapsulated else "lossy" if codec.lossy else "lossless"
+        self.encoded_bytes = int(self.frame_bytes * ENCODED_RATIO[kind])
+        self.worker_type = worker_type
+        self.pyramid_grid_sizes = pyramid_grid_sizes
+
+    def estimate(self, workers, frames_per_task, tasks_in_flight, read_cache_size, write_queue_frames):
+        '''
+        :return: {part: bytes} estimate of the peak memory of each part of the conversion, with the 'total'
+        '''
+        processes = self.worker_type == "process" and workers > 1
+        # results of tasks are encoded frames, or decoded tiles when level 0 is read for the pyramid
+        result_bytes = self.frame_bytes if self.pyramid_grid_sizes else self.encoded_bytes
+        parts = {"main": MAIN_BASE_BYTES,
+                 "worker_processes": workers * WORKER_BASE_BYTES if processes else 0,
+                 # band of decoded frames, a frame being converted and encoded, and the encoded frames of each running task
+                 "tasks": workers * ((frames_per_task + 2) * self.frame_bytes + frames_per_task * self.encoded_bytes),
+                 "read_cache": read_cache_size * (workers if processes else 1),
+                 # results waiting for the main thread, also pickled once between processes
+                 "in_flight": tasks_in_flight * frames_per_task * result_bytes * (2 if processes else 1),
+                 "write_queue": write_queue_frames * self.encoded_bytes}
+        if self.pyramid_grid_sizes:
+            # tiles of each level waiting to be encoded, and the tiles being built: about one column per level
+            levels = len(self.pyramid_grid_sizes)
+            parts["pyramid"] = (levels * tasks_in_flight * frames_per_task * (2 if processes else 1) +
+                                sum(rows for columns, rows in self.pyramid_grid_sizes[1:])) * self.frame_bytes
+        parts["total"] = sum(parts.values())
+        return parts
+
+
+def schedule_pipeline(memory, workers, frames_per_task, read_cache_size, memory_limit=None):
+    '''
+    size the stages of a conversion
+    :param memory: pipeline_memory of the conversion
+    :param workers: requested number of workers, None for the number of CPUs
+    :param frames_per_task: requested frames per task
+    :param read_cache_size: requested bytes of the read cache of each worker
+    :param memory_limit: memory budget of the whole conversion (see parse_size), None for no limit
+    :return: schedule, {"workers", "frames_per_task", "read_cache_size", "tasks_in_flight", "write_queue_frames",
+    "memory_limit", "estimate": {part: bytes}, "adjustments": [str, ...]}
+    '''
+    requested_workers = workers if workers is not None else (os.cpu_count() or 1)
+    schedule = {"memory_limit": None, "workers": requested_workers, "frames_per_task": frames_per_task,
+                "read_cache_size": read_cache_size, "tasks_in_flight": max(requested_workers * 2, 1),
+                "write_queue_frames": frames_per_task * max(requested_workers, 1), "adjustments": []}
+    if memory_limit is None:
+        schedule["estimate"] = memory.estimate(requested_workers, frames_per_task, schedule["tasks_in_flight"],
+                                               read_cache_size, schedule["write_queue_frames"])
+        return schedule
+    limit = parse_size(memory_limit)
+    schedule["memory_limit"] = limit
+    frames_options = [frames_per_task]
+    while frames_options[-1] > 1:
+        frames_options.append(frames_options[-1] // 2)
+    # tasks of a few frames keep the band reads and the per task overhead low: fewer workers first, then smaller tasks
+    minimum_frames = min(frames_per_task, MIN_FRAMES_PER_TASK)
+    candidates = [(w, f) for w in range(requested_workers, 0, -1) for f in frames_options if f >= minimum_frames]
+    candidates += [(w, f) for w in range(requested_workers, 0, -1) for f in frames_options if f < minimum_frames]
+    for w, f in candidates:
+        for depth in range(max(w * 2, 1), w if w > 1 else 0, -1):
+            estimate = memory.estimate(w, f, depth, 0, f)
+            if estimate["total"] > limit:
+                continue
+            # what is left goes to the read cache, then to the write queue
+            caches = w if memory.worker_type == "process" and w > 1 else 1
+            cache = min(read_cache_size, (limit - estimate["total"]) // caches)
+            spare = limit - memory.estimate(w, f, depth, cache, f)["total"]
+            write_queue = f + min(f * (max(w, 1) - 1), spare // max(memory.encoded_bytes, 1))
+            schedule.update(workers=w, frames_per_task=f, read_cache_size=int(cache), tasks_in_flight=depth,
+                            write_queue_frames=int(write_queue),
+                            estimate=memory.estimate(w, f, depth, cache, write_queue))
+            for key, value in (("workers", requested_workers), ("frames_per_task", frames_per_task),
+                               ("read_cache_size", read_cache_size), ("tasks_in_flight", max(requested_workers * 2, 1))):
+                if schedule[key] != value:
+                    schedule["adjustments"].append("%s reduced from %d to %d" % (key, value, schedule[key]))
+            return schedule
+    minimum = memory.estimate(1, 1, 1, 0, 1)["total"]
+    raise Exception("memory_limit of %s is too small, the conversion needs at least %s" % (format_size(limit), format_size(minimum)))
+
+
+class pipeline_stage:
+    '''
+    Run calls in order on a thread, behind a bounded queue: put() blocks while the queue is full, so the stage
+    feeding it can't run ahead. With depth 0, calls are made right away by the caller.
+    When a call fails, the calls queued after it are dropped and on_error is called with the error right away, on the
+    thread (i.e. to abort the instances being written), then the error is raised by the next put() or join().
+    '''
+    def __init__(self, name, depth, metrics=None, on_error=None):
+        self.name = name
+        self.metrics = metrics
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=depth) if depth > 0 else None
+        self.error = None
+        self.failed = False   # a call failed, the next ones are dropped
+        self.dropped = 0
+        self.cancelled = False
+        self.thread = None
+
+    def put(self, fn, *args):
+        self._raise()
+        if self.queue is None:
+            try:
+                fn(*args)
+            except BaseException as e:
+                self._fail(e)
+                self._raise()
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+        self.queue.put((fn, args))
+        if self.metrics is not None:
+            self.metrics.set_queue_depth(self.name, self.queue.qsize())
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args = item
+            if self.failed or self.cancelled:
+                self.dropped += 1
+            else:
+                try:
+                    fn(*args)
+                except BaseException as e:
+                    self._fail(e)
+            self.queue.task_done()
+
+    def _fail(self, error):
+        self.failed = True
+        if self.on_error is not None:
+            try:
+                self.on_error(error)
+            except BaseException as cleanup_error:
+                print("%s: cleanup after %r failed: %r" % (self.name, error, cleanup_error))
+        self.error = error
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            if self.dropped:
+                print("%s: %d calls queued after the error were dropped" % (self.name, self.dropped))
+            raise error
+
+    # wait for the queued calls to be done
+    def join(self):
+        if self.queue is not None:
+            self.queue.join()
+        self._raise()
+
+    # drop the queued calls and wait for the running one, i.e. before aborting what they write to
+    def cancel(self):
+        self.cancelled = True
+        if self.queue is not None:
+            self.queue.join()
+        self.cancelled = False
+        self.failed = False
+        self.error = None
+        self.dropped = 0
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,135 @@
+import os
+import json
+import mmap
+import struct
+import numpy as np
+'''
+Spatial index of a converted slide, saved next to the instances so viewers and tile servers can open a slide without
+parsing PerFrameFunctionalGroupsSequence of every instance.
+For each image level, a (rows, columns) grid of tile records: instance index, frame number, byte offset and length of
+the encoded frame in the instance file, and flags. Tiles without a frame (i.e. empty glass skipped in TILED_SPARSE)
+have instance -1 and the BLANK flag.
+File layout, little endian:
+    8 bytes magic, uint32 length of the json header, json header, zero padding to a multiple of 64 bytes,
+    then the record grid of each level, at the offset given in the header.
+The header holds the transfer syntax, the instance file names and sizes, and for each level its dimensions, tile size,
+grid size, downsample and the offset of its records. Loading the index is a single mmap and a few array views,
+whatever the number of frames.
+'''
+
+SPATIAL_INDEX_FILENAME = "spatial_index.bin"
+MAGIC = b"WSIDXv01"
+ALIGNMENT = 64
+BLANK = 1   # flag of grid positions without a frame
+TILE_RECORD = np.dtype([("instance", "<i4"),   # index of the instance file in the header, -1 if no frame
+                        ("frame", "<i4"),   # Dicom frame number in the instance, 1-based, 0 if no frame
+                        ("offset", "<u8"),   # byte offset of the encoded frame in the instance file
+                        ("length", "<u4"),   # byte length of the encoded frame
+                        ("flags", "<u4")])
+
+
+def empty_grid(grid_size):
+    '''
+    :param grid_size: (columns, rows) of the level
+    :return: (rows, columns) array of TILE_RECORD, all blank
+    '''
+    grid = np.zeros((grid_size[1], grid_size[0]), dtype=TILE_RECORD)
+    grid["instance"] = -1
+    grid["flags"] = BLANK
+    return grid
+
+
+def write_spatial_index(filename, TransferSyntaxUID, instances, levels):
+    '''
+    save a spatial index, atomically
+    :param filename: file name of the index
+    :param TransferSyntaxUID: transfer syntax of the instances
+    :param instances: [(instance file name relative to the index, file size), ...] in the order of record["instance"]
+    :param levels: [dict(img_level=, dimensions=, tile_size=, downsample=, grid=), ...] largest level first,
+    grid being a (rows, columns) array of TILE_RECORD, see empty_grid
+    '''
+    header = {"TransferSyntaxUID": str(TransferSyntaxUID),
+              "instances": [{"filename": fn, "size": int(size)} for fn, size in instances],
+              "levels": []}
+    # offsets of the level records depend on the header length, which depends on the offsets: reserve enough digits
+    offset = 0
+    for level in levels:
+        header["levels"].append({"img_level": int(level["img_level"]), "dimensions": [int(v) for v in level["dimensions"]],
+                                 "tile_size": [int(v) for v in level["tile_size"]],
+                                 "grid_size": [int(level["grid"].shape[1]), int(level["grid"].shape[0])],
+                                 "downsample": float(level["downsample"]), "offset": offset})
+        offset += -(-level["grid"].nbytes // ALIGNMENT) * ALIGNMENT
+    data_start = -(-(len(MAGIC) + 4 + len(json.dumps(header)) + 20 * len(levels)) // ALIGNMENT) * ALIGNMENT
+    for level_header in header["levels"]:
+        level_header["offset"] += data_start
+    header_bytes = json.dumps(header).encode()
+    with open(filename + ".tmp", "wb") as fp:
+        fp.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        for level, level_header in zip(levels, header["levels"]):
+            fp.write(b"\0" * (level_header["offset"] - fp.tell()))
+            fp.write(np.ascontiguousarray(level["grid"], dtype=TILE_RECORD).tobytes())
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(filename + ".tmp", filename)
+
+
+class spatial_index:
+    def __init__(self, filename):
+        '''
+        open a spatial index, the level grids are read-only views into the memory-mapped file
+        :param filename: file name of the index
+        '''
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.mm.close()
+            raise Exception("%s is not a spatial index" % filename)
+        header_length = struct.unpack_from("<I", self.mm, len(MAGIC))[0]
+        header = json.loads(self.mm[len(MAGIC) + 4:len(MAGIC) + 4 + header_length])
+        self.TransferSyntaxUID = header["TransferSyntaxUID"]
+        self.instances = header["instances"]   # [{"filename": , "size": }, ...]
+        self.levels = header["levels"]   # [{"img_level": , "dimensions": , "tile_size": , "grid_size": , "downsample": }, ...]
+        self.grids = [np.ndarray((level["grid_size"][1], level["grid_size"][0]), dtype=TILE_RECORD, buffer=self.mm,
+                                 offset=level["offset"]) for level in self.levels]
+
+    # whether the instance files are still those the index was built from
+    def is_current(self):
+        directory = os.path.dirname(self.filename)
+        for instance in self.instances:
+            fn = os.path.join(directory, instance["filename"])
+            if not os.path.exists(fn) or os.path.getsize(fn) != instance["size"]:
+                return False
+        return True
+
+    def instance_frames(self):
+        '''
+        grid positions of the frames of each instance, in frame order
+        :return: [(img_level, DimensionIndexValues), ...] in the order of the instances, DimensionIndexValues being a
+        (n, 2) uint32 array of 1-based (column, row), as in the frame plan of the converter
+        '''
+        frames = [None] * len(self.instances)
+        for level, grid in zip(self.levels, self.grids):
+            rows, columns = np.nonzero(grid["instance"] >= 0)
+            records = grid[rows, columns]
+            order = np.lexsort((records["frame"], records["instance"]))
+            rows, columns, instances = rows[order], columns[order], records["instance"][order]
+            starts = np.flatnonzero(np.diff(instances, prepend=-1))
+            for start, end in zip(starts, np.append(starts[1:], len(instances))):
+                DimensionIndexValues = np.stack([columns[start:end] + 1, rows[start:end] + 1], axis=1).astype(np.uint32)
+                frames[int(instances[start])] = (level["img_level"], DimensionIndexValues)
+        return frames
+
+    # record of the tile at a grid position of a level
+    def tile(self, level, column, row):
+        return self.grids[level][row, column]
+
+    def close(self):
+        self.grids = []
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,49 @@
+import os
+import sys
+import io
+import contextlib
+import numpy as np
+import pytest
+import tifffile
+'''
+Fixtures of the tests: a small pyramidal tiled TIFF (read by OpenSlide as a generic TIFF) with tissue in an ellipse
+on light gray glass, and a helper running a quiet conversion.
+Run the tests from the repository root with: python -m pytest test
+'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SLIDE_SIZE = (1280, 1024)   # (width, height) of level 0
+TILE_SIZE = 256
+GLASS = 240
+
+
+def make_slide(filename, size=SLIDE_SIZE, seed=0):
+    rng = np.random.default_rng(seed)
+    img = np.full((size[1], size[0], 3), GLASS, np.uint8)
+    yy, xx = np.mgrid[0:size[1], 0:size[0]]
+    tissue = ((xx - size[0] * 0.45) / (size[0] * 0.3)) ** 2 + ((yy - size[1] * 0.5) / (size[1] * 0.3)) ** 2 < 1
+    img[tissue] = rng.integers([150, 60, 120], [220, 120, 190], (tissue.sum(), 3)).astype(np.uint8)
+    options = dict(tile=(TILE_SIZE, TILE_SIZE), photometric="rgb", compression="jpeg", compressionargs={"level": 90})
+    with tifffile.TiffWriter(filename) as tw:
+        tw.write(img, **options)
+        tw.write(np.ascontiguousarray(img[::4, ::4]), subfiletype=1, **options)
+    return filename
+
+
+@pytest.fixture(scope="session")
+def slide_fn(tmp_path_factory):
+    return make_slide(str(tmp_path_factory.mktemp("slide") / "slide.tiff"))
+
+
+@pytest.fixture
+def convert():
+    from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+
+    # convert a slide without printing the progress, return the converter
+    def convert(wsi_fn, save_to_dir, **kwargs):
+        converter = WSIDICOM_Converter(wsi_fn, str(save_to_dir), parameters(**kwargs))
+        with contextlib.redirect_stdout(io.StringIO()):
+            converter.convert()
+        return converter
+    return convert
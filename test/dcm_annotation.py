@@ -3,6 +3,7 @@ from pydicom.sequence import Sequence
 from pydicom.tag import Tag
 import pydicom.uid
 import os
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from PIL import Image
@@ -133,14 +134,8 @@ def create_default_tags(filename, IS_IMPLICIT_VR, IS_LITTLE_ENDIAN):
 
 
 def split_x_y(points):
-    x = []
-    y = []
-    for idx, a in enumerate(points):
-        if idx % 2 == 0:
-            x.append(a)
-        else:
-            y.append(a)
-    return x, y
+    points = np.asarray(points)
+    return points[0::2], points[1::2]
 
 
 fig, ax = plt.subplots(1)
@@ -167,8 +162,8 @@ def draw_points(points, color):
 def draw_polyline(points, color, CLOSE):
     x, y = split_x_y(points)
     if CLOSE:
-        x.append(x[0])
-        y.append(y[0])
+        x = np.append(x, x[0])
+        y = np.append(y, y[0])
     plt.plot(x, y, color=color, linestyle='-')
 
 
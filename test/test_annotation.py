@@ -0,0 +1,75 @@
+import glob
+import os
+import numpy as np
+import pydicom
+import pytest
+from WSI_DICOM_Annotation import bulk_annotations, read_annotations, render_annotations, split_labels, \
+    BULK_ANNOTATIONS_SOP_CLASS_UID
+
+
+@pytest.fixture
+def slide_dir(slide_fn, convert, tmp_path):
+    convert(slide_fn, tmp_path / "slide", patch_size=(256, 256))
+    return str(tmp_path / "slide")
+
+
+def test_split_labels():
+    assert [(value, indices.tolist()) for value, indices in split_labels(np.array([3, 1, 3, 2]), 4)] == \
+           [(1, [1]), (2, [3]), (3, [0, 2])]
+    assert [(value, indices.tolist()) for value, indices in split_labels(["b", "a", "b"], 3)] == \
+           [("a", [1]), ("b", [0, 2])]
+    assert [(value, indices.tolist()) for value, indices in split_labels("tumor", 2)] == [("tumor", [0, 1])]
+    with pytest.raises(Exception, match="labels"):
+        split_labels([1, 2], 3)
+
+
+def test_annotations_round_trip(slide_dir, tmp_path):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 1000, (100, 2)).astype(np.float32)
+    classes = rng.integers(0, 3, 100)
+    polygons = [np.array([(10, 10), (50, 10), (30, 40)]), np.array([(100, 100), (200, 100), (200, 200), (100, 200)])]
+    annotations = bulk_annotations(slide_dir, ContentLabel="CELLS", algorithm=("detector", "1.0"))
+    annotations.add_points(points, labels=classes)
+    annotations.add_boxes([(0, 0, 10, 20)], labels="region")
+    annotations.add_polylines(polygons, labels=["small", "large"], closed=True)
+    annotations_fn = str(tmp_path / "cells.dcm")
+    annotations.save(annotations_fn)
+
+    ds = pydicom.dcmread(annotations_fn, stop_before_pixels=True)
+    assert ds.SOPClassUID == BULK_ANNOTATIONS_SOP_CLASS_UID
+    assert ds.StudyInstanceUID == annotations.references["StudyInstanceUID"]
+    assert len(ds.ReferencedImageSequence) == len(annotations.references["instances"])
+    groups = read_annotations(annotations_fn)
+    assert [(group.label, group.graphic_type) for group in groups] == [
+        ("0", "POINT"), ("1", "POINT"), ("2", "POINT"), ("region", "RECTANGLE"), ("large", "POLYGON"), ("small", "POLYGON")]
+    for label, group in enumerate(groups[:3]):
+        assert np.array_equal(group.coordinates, points[classes == label])
+        assert group.algorithm == ("detector", "1.0")
+    assert np.array_equal(groups[3].annotation(0), [(0, 0), (10, 0), (10, 20), (0, 20)])
+    assert np.array_equal(groups[4].annotation(0), polygons[1]) and np.array_equal(groups[5].annotation(0), polygons[0])
+
+
+def test_polylines_of_one_label(slide_dir, tmp_path):
+    coordinates = np.array([(0, 0), (5, 5), (10, 0), (20, 20), (30, 30)], dtype=np.float64) + 0.25
+    annotations = bulk_annotations(slide_dir, double_precision=True)
+    annotations.add_polylines(coordinates, offsets=[0, 3])
+    annotations.save(str(tmp_path / "lines.dcm"))
+    group, = read_annotations(str(tmp_path / "lines.dcm"))
+    assert group.coordinates.dtype == np.float64 and group.algorithm is None
+    assert len(group) == 2
+    assert np.array_equal(group.annotation(0), coordinates[:3]) and np.array_equal(group.annotation(1), coordinates[3:])
+
+
+def test_read_annotations_of_a_slide_instance(slide_dir):
+    with pytest.raises(Exception, match="not a Microscopy Bulk Simple Annotations"):
+        read_annotations(glob.glob(os.path.join(slide_dir, "*.dcm"))[0])
+
+
+def test_render_annotations(slide_dir):
+    annotations = bulk_annotations(slide_dir)
+    box, = annotations.add_boxes([(4, 4, 16, 12)])
+    point, = annotations.add_points([(30, 30)])
+    canvas = render_annotations([box, point], (40, 40), downsample=1.0, colors=[(255, 0, 0), (0, 0, 255)], point_radius=0)
+    assert tuple(canvas[4, 10]) == (255, 0, 0) and tuple(canvas[12, 16]) == (255, 0, 0)
+    assert tuple(canvas[8, 10]) == (255, 255, 255)   # inside the box
+    assert tuple(canvas[30, 30]) == (0, 0, 255)
@@ -0,0 +1,79 @@
+import filecmp
+import json
+import os
+import shutil
+import WSI_DICOM_Batch
+from WSI_DICOM_Batch import batch_convert, find_slides, slide_parameters, _batch_convert
+from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+
+generate_instance_info_list = WSIDICOM_Converter.generate_instance_info_list
+
+
+def test_find_slides(slide_fn, tmp_path):
+    os.makedirs(str(tmp_path / "slides" / "b"))
+    shutil.copy(slide_fn, str(tmp_path / "slides" / "b" / "two.tiff"))
+    shutil.copy(slide_fn, str(tmp_path / "slides" / "one.svs"))
+    (tmp_path / "slides" / "notes.txt").write_text("not a slide")
+    assert find_slides(str(tmp_path / "slides")) == [(str(tmp_path / "slides" / "one.svs"), "one"),
+                                                     (str(tmp_path / "slides" / "b" / "two.tiff"), "two")]
+    manifest = tmp_path / "slides" / "manifest.txt"
+    manifest.write_text("# slides\none.svs\n\nb/two.tiff, second\n")
+    assert find_slides(str(manifest)) == [(str(tmp_path / "slides" / "one.svs"), "one"),
+                                          (str(tmp_path / "slides" / "b" / "two.tiff"), "second")]
+
+
+def test_batch_convert_is_the_same_as_single_conversions(slide_fn, convert, tmp_path):
+    p = parameters(patch_size=(256, 256), max_frame=8)
+    missing = str(tmp_path / "missing.tiff")
+    report_fn = str(tmp_path / "report.json")
+    reports = batch_convert([(slide_fn, "slide"), (slide_fn, "slide"), missing], str(tmp_path / "out"), p, workers=2,
+                            report_fn=report_fn)
+    assert [r["status"] for r in reports] == ["done", "done", "failed"]
+    assert [os.path.basename(r["output"]) for r in reports[:2]] == ["slide", "slide_2"]   # output directories aren't shared
+    assert json.load(open(report_fn)) == reports
+    # each slide is converted as on its own, with the UIDs derived from its path
+    single = convert(slide_fn, tmp_path / "single", patch_size=(256, 256), max_frame=8,
+                     UID_seed=slide_parameters(p, slide_fn).UID_seed)
+    names = sorted(fn for fn in os.listdir(str(tmp_path / "single")) if fn.endswith(".dcm"))
+    assert len(names) == len(single.frame_items_info_list) > 1
+    assert reports[0]["frames"] == sum(len(info.locations) for info in single.frame_items_info_list)
+    match, mismatch, errors = filecmp.cmpfiles(str(tmp_path / "single"), reports[0]["output"], names + ["spatial_index.bin"], shallow=False)
+    assert not mismatch and not errors
+
+
+# file counting the frame plans made, in any process
+_plans_fn = None
+
+
+def counted_generate_instance_info_list(converter):
+    with open(_plans_fn, "a") as fp:
+        fp.write("%s\n" % converter.wsi_fn)
+    return generate_instance_info_list(converter)
+
+
+def test_slides_are_planned_once(slide_fn, tmp_path, monkeypatch):
+    global _plans_fn
+    _plans_fn = str(tmp_path / "plans.txt")
+    monkeypatch.setattr(WSIDICOM_Converter, "generate_instance_info_list", counted_generate_instance_info_list)
+    p = parameters(patch_size=(256, 256), max_frame=4, TISSUE_DETECTION=True)
+    reports = batch_convert([(slide_fn, "slide")], str(tmp_path / "out"), p, workers=2)
+    assert reports[0]["status"] == "done" and reports[0]["frames"] > 0
+    # planned by the coordinator, the workers only convert the instances
+    assert open(_plans_fn).read().splitlines() == [slide_fn]
+
+
+# the worker process converting the slide named crash dies
+def crashing_batch_convert(wsi_fn, save_to_dir, p, instance_indices, frame_plan=None):
+    if os.path.basename(save_to_dir) == "crash":
+        os._exit(1)
+    return _batch_convert(wsi_fn, save_to_dir, p, instance_indices, frame_plan)
+
+
+def test_a_dead_worker_fails_its_slide_only(slide_fn, tmp_path, monkeypatch):
+    monkeypatch.setattr(WSI_DICOM_Batch, "_batch_convert", crashing_batch_convert)
+    p = parameters(patch_size=(256, 256), max_frame=8)
+    reports = batch_convert([(slide_fn, "crash"), (slide_fn, "slide")], str(tmp_path / "out"), p, workers=1)
+    assert [r["status"] for r in reports] == ["failed", "done"]
+    assert reports[0]["error"].startswith("BrokenProcessPool")
+    # converted by the new pool
+    assert reports[1]["frames"] == 22 and os.path.exists(os.path.join(reports[1]["output"], "spatial_index.bin"))
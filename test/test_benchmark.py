@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark")
+
+
+# run a benchmark script, return its output
+def run(script, *args):
+    cmd = [sys.executable, os.path.join(BENCHMARK_DIR, script)] + [str(arg) for arg in args]
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def test_bench_convert(slide_fn, tmp_path):
+    output = str(tmp_path / "result.json")
+    run("bench_convert.py", "--slide", slide_fn, "--param", "patch_size=(256, 256)", "--param", "max_frame=8",
+        "--output", output)
+    results = json.load(open(output))
+    assert list(results["stages"]) == ["plan", "frame_sequence", "frame_template", "pixel_data", "convert"]
+    assert all(r["tiles"] == 22 and r["seconds"] > 0 for r in results["stages"].values())
+    assert results["stages"]["convert"]["output_MB"] > 0
+    # compared with itself, no stage is slower than a 100x tolerance
+    run("bench_convert.py", "--slide", slide_fn, "--param", "patch_size=(256, 256)", "--param", "max_frame=8",
+        "--stages", "plan", "--baseline", output, "--tolerance", "100")
+
+
+def test_bench_codecs():
+    output = run("bench_codecs.py", 1, 75)
+    assert "jpeg_baseline" in output and "uncompressed" in output
+
+
+def test_bench_frame_sequence():
+    output = run("bench_frame_sequence.py", 100)
+    assert output.startswith("dataset") and "template" in output
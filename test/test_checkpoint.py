@@ -0,0 +1,64 @@
+import filecmp
+import io
+import contextlib
+import os
+import pytest
+import WSI_DICOM_Converter
+from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+from checkpoint import conversion_checkpoint, CHECKPOINT_FILENAME
+
+
+def test_checkpoint_records(tmp_path):
+    instance_fn = tmp_path / "instance_0.dcm"
+    instance_fn.write_bytes(b"x" * 10)
+    checkpoint = conversion_checkpoint(str(tmp_path), parameters())
+    checkpoint.start(resume=False)
+    checkpoint.done(0, "plan", str(instance_fn), 3)
+    with open(checkpoint.filename, "a") as fp:
+        fp.write('{"instance": 1, "filen')   # cut by an interruption
+    # runtime parameters don't change the output, the records are kept
+    resumed = conversion_checkpoint(str(tmp_path), parameters(workers=4, resume=True))
+    assert list(resumed.instances) == [0]
+    assert resumed.is_done(0, "plan", str(instance_fn))
+    assert not resumed.is_done(0, "other plan", str(instance_fn))
+    instance_fn.write_bytes(b"x" * 11)
+    assert not resumed.is_done(0, "plan", str(instance_fn))
+    # other parameters, other output
+    changed = conversion_checkpoint(str(tmp_path), parameters(Quality=90))
+    assert not changed.instances
+    changed.start(resume=True)
+    assert conversion_checkpoint(str(tmp_path), parameters()).instances == {}
+
+
+def test_resume_an_interrupted_conversion(slide_fn, convert, tmp_path, monkeypatch):
+    kwargs = dict(patch_size=(256, 256), max_frame=8)
+    convert(slide_fn, tmp_path / "full", **kwargs)
+    names = sorted(fn for fn in os.listdir(str(tmp_path / "full")) if fn.endswith(".dcm"))
+    assert len(names) == 4
+
+    # interrupted while writing the third instance
+    write_frame = WSI_DICOM_Converter.instance_writer.write_frame
+    frames = []
+
+    def failing_write_frame(writer, frame):
+        frames.append(frame)
+        if len(frames) == 20:
+            raise KeyboardInterrupt()
+        return write_frame(writer, frame)
+    monkeypatch.setattr(WSI_DICOM_Converter.instance_writer, "write_frame", failing_write_frame)
+    with pytest.raises(KeyboardInterrupt):
+        convert(slide_fn, tmp_path / "resumed", **kwargs)
+    monkeypatch.setattr(WSI_DICOM_Converter.instance_writer, "write_frame", write_frame)
+    written = sorted(fn for fn in os.listdir(str(tmp_path / "resumed")) if not fn.endswith(".jsonl"))
+    assert written == names[:2]   # no partial instance left behind
+    mtimes = {fn: os.stat(str(tmp_path / "resumed" / fn)).st_mtime_ns for fn in written}
+
+    converter = WSIDICOM_Converter(slide_fn, str(tmp_path / "resumed"), parameters(resume=True, **kwargs))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        converter.convert()
+    assert output.getvalue().count("already converted, skipped") == 2
+    assert {fn: os.stat(str(tmp_path / "resumed" / fn)).st_mtime_ns for fn in written} == mtimes
+    match, mismatch, errors = filecmp.cmpfiles(str(tmp_path / "full"), str(tmp_path / "resumed"),
+                                               names + ["spatial_index.bin", CHECKPOINT_FILENAME], shallow=False)
+    assert not mismatch and not errors
@@ -0,0 +1,58 @@
+import glob
+import json
+import os
+import pydicom
+import pytest
+from pydicom.dataset import FileMetaDataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.uid import ExplicitVRLittleEndian
+from dicom_header import load_template, dataset_from_template, header_encoder, DEFAULT_TEMPLATE
+
+
+def test_load_template(tmp_path):
+    default = load_template()
+    assert default["Modality"] == "SM"
+    template_fn = tmp_path / "site.json"
+    template_fn.write_text(json.dumps({"Manufacturer": "Lab", "ImageComments": None}))
+    elements = load_template(str(template_fn))
+    assert elements["Manufacturer"] == "Lab"
+    assert "ImageComments" not in elements
+    assert load_template({"Manufacturer": "Lab", "ImageComments": None}) == elements
+    with open(DEFAULT_TEMPLATE) as fp:
+        assert json.load(fp)["Manufacturer"] == default["Manufacturer"]   # the default template is not changed
+
+
+def test_dataset_from_template():
+    ds = dataset_from_template(load_template())
+    assert ds.DimensionIndexSequence[0].DimensionIndexPointer == 0x0048021E
+    assert ds.DimensionIndexSequence[0].FunctionalGroupPointer == 0x0048021A
+    with pytest.raises(Exception, match="Unknown element keyword"):
+        dataset_from_template({"NotAKeyword": "x"})
+
+
+def test_header_encoder():
+    ds = dataset_from_template(load_template())
+    encoder = header_encoder(ds, is_implicit_VR=False, is_little_endian=True)
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    instance = pydicom.Dataset()
+    instance.SOPInstanceUID = "1.2.3.4"
+    instance.Manufacturer = "Lab"
+    header = encoder.encode(file_meta, instance)
+    assert header[:132] == b"\0" * 128 + b"DICM"
+    decoded = pydicom.dcmread(DicomBytesIO(header))
+    assert decoded.file_meta.MediaStorageSOPInstanceUID == "1.2.3.4"
+    assert decoded.file_meta.MediaStorageSOPClassUID == ds.SOPClassUID
+    assert decoded.Manufacturer == "Lab"   # the elements of the instance replace those of the template
+    assert decoded.Modality == "SM"
+    assert "MediaStorageSOPInstanceUID" not in file_meta   # file_meta is not changed
+
+
+def test_instances_have_the_template_elements(slide_fn, convert, tmp_path):
+    convert(slide_fn, tmp_path, patch_size=(256, 256), image_levels=range(1, 2),
+            header_template={"Manufacturer": "Lab", "PatientID": "P1", "ImageComments": None})
+    ds = pydicom.dcmread(glob.glob(os.path.join(str(tmp_path), "*.dcm"))[0], stop_before_pixels=True)
+    assert ds.Manufacturer == "Lab"
+    assert ds.PatientID == "P1"
+    assert "ImageComments" not in ds
+    assert ds.Modality == "SM"
@@ -0,0 +1,70 @@
+import glob
+import os
+import numpy as np
+import pydicom
+import pytest
+from PIL import Image
+from frame_codecs import CODECS, get_codec
+from WSI_DICOM_Verify import psnr
+
+
+def tissue_like(seed=0, size=(128, 96)):
+    rng = np.random.default_rng(seed)
+    smooth = np.kron(rng.integers(60, 220, (size[1] // 32, size[0] // 32, 3)), np.ones((32, 32, 1)))
+    return np.clip(smooth + rng.normal(0, 4, smooth.shape), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_round_trip(name):
+    codec = get_codec(name)
+    if not codec.available():
+        pytest.skip(codec.requires())
+    pixels = tissue_like()
+    decoded = codec.decode(codec.encode(Image.fromarray(pixels), 75), (pixels.shape[1], pixels.shape[0]))
+    assert decoded.shape == pixels.shape and decoded.dtype == np.uint8
+    if codec.lossy:
+        assert psnr(decoded, pixels) > 30
+    else:
+        assert np.array_equal(decoded, pixels)
+
+
+@pytest.mark.parametrize("name", [name for name, codec in sorted(CODECS.items()) if not codec.lossy])
+def test_incompressible_frames_are_encoded(name):
+    codec = get_codec(name)
+    if not codec.available():
+        pytest.skip(codec.requires())
+    noise = np.random.default_rng(1).integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    assert np.array_equal(codec.decode(codec.encode(Image.fromarray(noise), 75), (256, 256)), noise)
+
+
+def test_unknown_codec():
+    with pytest.raises(Exception, match="Unknown codec"):
+        get_codec("webp")
+
+
+def test_instances_have_the_transfer_syntax_of_the_codec(slide_fn, convert, tmp_path):
+    codec = get_codec("jpeg2000_lossless")
+    if not codec.available():
+        pytest.skip(codec.requires())
+    convert(slide_fn, tmp_path, patch_size=(256, 256), image_levels=range(1, 2), codec=codec.name)
+    ds = pydicom.dcmread(glob.glob(os.path.join(str(tmp_path), "*.dcm"))[0], stop_before_pixels=True)
+    assert ds.file_meta.TransferSyntaxUID == codec.TransferSyntaxUID
+    assert ds.PhotometricInterpretation == codec.PhotometricInterpretation
+    assert ds.LossyImageCompression == "00"
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(JPEG_PASSTHROUGH=True), dict(codec="jpeg2000", offset_table="EOT")])
+def test_lossy_instances_have_their_compression_ratio(slide_fn, convert, tmp_path, kwargs):
+    codec = get_codec(kwargs.get("codec", "jpeg_baseline"))
+    if not codec.available():
+        pytest.skip(codec.requires())
+    converter = convert(slide_fn, tmp_path, patch_size=(256, 256), max_frame=8, **kwargs)
+    ratios = []
+    for instance_idx in range(len(converter.frame_items_info_list)):
+        ds = pydicom.dcmread(converter.instance_filename(instance_idx))
+        assert ds.LossyImageCompression == "01" and ds.LossyImageCompressionMethod == codec.LossyImageCompressionMethod
+        record = converter.checkpoint.instances[instance_idx]
+        decoded = int(ds.NumberOfFrames) * int(ds.Rows) * int(ds.Columns) * 3
+        assert float(ds.LossyImageCompressionRatio) == pytest.approx(decoded / sum(record["frame_lengths"]), rel=1e-5)
+        ratios.append(float(ds.LossyImageCompressionRatio))
+    assert len(set(ratios)) > 1   # per instance
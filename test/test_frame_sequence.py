@@ -0,0 +1,45 @@
+import glob
+import os
+from io import BytesIO
+import numpy as np
+import pydicom
+from pydicom.filereader import read_dataset
+from frame_sequence import encode_frame_sequence, format_DS
+
+
+def test_format_DS():
+    assert list(format_DS(np.array([1.5, -0.25, 123456.123456789]))) == [b" 000001.50000000", b"-000000.25000000", b" 123456.12345679"]
+    assert format_DS(np.array([1e9]))[0].strip() == b"1e+09"
+
+
+def test_encoded_sequence_is_read_by_pydicom():
+    locations = np.array([[0, 0], [512, 0], [0, 1024]])
+    DimensionIndexValues = [[1, 1], [2, 1], [1, 3]]
+    for implicit_VR in (True, False):
+        data = encode_frame_sequence(locations, DimensionIndexValues, 2.0, (1.0, 2.0), 0.00025, implicit_VR)
+        ds = read_dataset(BytesIO(data), implicit_VR, True)
+        items = ds.PerFrameFunctionalGroupsSequence
+        assert len(items) == 3
+        assert [list(item.FrameContentSequence[0].DimensionIndexValues) for item in items] == DimensionIndexValues
+        positions = [item.PlanePositionSlideSequence[0] for item in items]
+        assert [(p.ColumnPositionInTotalImagePixelMatrix, p.RowPositionInTotalImagePixelMatrix) for p in positions] == [(1, 1), (257, 1), (1, 513)]
+        assert np.allclose([float(p.XOffsetInSlideCoordinateSystem) for p in positions], [1.0, 1.128, 1.0])
+        assert np.allclose([float(p.YOffsetInSlideCoordinateSystem) for p in positions], [2.0, 2.0, 2.256])
+
+
+def test_fast_frame_sequence_matches_pydicom(slide_fn, convert, tmp_path):
+    for fast in (True, False):
+        convert(slide_fn, tmp_path / str(fast), patch_size=(256, 256), FAST_FRAME_SEQUENCE=fast)
+
+    def sequences(directory):
+        return [pydicom.dcmread(fn, stop_before_pixels=True).PerFrameFunctionalGroupsSequence
+                for fn in sorted(glob.glob(os.path.join(str(directory), "*.dcm")))]
+    for fast_items, items in zip(sequences(tmp_path / "True"), sequences(tmp_path / "False")):
+        assert len(fast_items) == len(items)
+        for fast_item, item in zip(fast_items, items):
+            assert fast_item.FrameContentSequence[0].DimensionIndexValues == item.FrameContentSequence[0].DimensionIndexValues
+            fast_position, position = fast_item.PlanePositionSlideSequence[0], item.PlanePositionSlideSequence[0]
+            for keyword in ("ColumnPositionInTotalImagePixelMatrix", "RowPositionInTotalImagePixelMatrix"):
+                assert fast_position[keyword].value == position[keyword].value
+            for keyword in ("XOffsetInSlideCoordinateSystem", "YOffsetInSlideCoordinateSystem"):
+                assert abs(float(fast_position[keyword].value) - float(position[keyword].value)) < 1e-6
@@ -0,0 +1,130 @@
+import os
+import struct
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import get_frame, parse_basic_offsets
+from PIL import Image
+from frame_codecs import get_codec
+from WSI_DICOM_Converter import instance_writer
+
+SIZE = (64, 48)   # (columns, rows) of the frames
+
+
+def frames(count):
+    rng = np.random.default_rng(0)
+    return [np.kron(rng.integers(0, 256, (SIZE[1] // 16, SIZE[0] // 16, 3)), np.ones((16, 16, 1))).astype(np.uint8)
+            for _ in range(count)]
+
+
+def instance(codec, count):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.77.1.6"
+    file_meta.MediaStorageSOPInstanceUID = "1.2.3.4"
+    file_meta.TransferSyntaxUID = codec.TransferSyntaxUID
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.NumberOfFrames = count
+    ds.Rows, ds.Columns = SIZE[1], SIZE[0]
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = codec.PhotometricInterpretation
+    ds.PlanarConfiguration = 0
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 8, 8, 7, 0
+    return ds
+
+
+# (offset, length) of each frame item after the Basic Offset Table, relative to the first one
+def item_positions(PixelData):
+    pos = 8 + struct.unpack_from("<I", PixelData, 4)[0]
+    first, items = pos, []
+    while pos < len(PixelData):
+        tag, length = struct.unpack_from("<II", PixelData, pos)
+        if tag != 0xE000FFFE:
+            break
+        items.append((pos - first, length))
+        pos += 8 + length
+    return items
+
+
+@pytest.mark.parametrize("offset_table", ["BOT", "EOT"])
+def test_offset_tables_point_to_the_frames(tmp_path, offset_table):
+    codec = get_codec("jpeg2000_lossless")
+    if not codec.available():
+        pytest.skip(codec.requires())
+    images = frames(5)
+    encoded = [codec.encode(Image.fromarray(img), 75) for img in images]
+    encoded[2] += b"\0" if len(encoded[2]) % 2 == 0 else b""   # an odd length frame, padded in its item
+    filename = str(tmp_path / "instance.dcm")
+    closed = []
+    writer = instance_writer(filename, instance(codec, len(images)), len(images), True, offset_table=offset_table,
+                             on_close=closed.append)
+    for frame in encoded:
+        writer.write_frame(frame)
+    assert not os.path.exists(filename)
+    writer.close()
+    assert closed == [writer] and not os.path.exists(filename + ".partial")
+
+    ds = pydicom.dcmread(filename)
+    items = item_positions(ds.PixelData)
+    assert [length for offset, length in items] == [len(frame) + len(frame) % 2 for frame in encoded]
+    if offset_table == "BOT":
+        assert parse_basic_offsets(ds.PixelData) == [offset for offset, length in items]
+        assert "ExtendedOffsetTable" not in ds
+        extended_offsets = None
+    else:
+        assert parse_basic_offsets(ds.PixelData) == []
+        offsets = list(struct.unpack("<%dQ" % len(images), ds.ExtendedOffsetTable))
+        lengths = list(struct.unpack("<%dQ" % len(images), ds.ExtendedOffsetTableLengths))
+        assert offsets == [offset for offset, length in items]
+        assert lengths == [length for offset, length in items]
+        extended_offsets = (offsets, lengths)
+    # frame byte ranges recorded for the spatial index
+    with open(filename, "rb") as fp:
+        data = fp.read()
+    for idx, frame in enumerate(encoded):
+        assert data[writer.frame_offsets[idx]:writer.frame_offsets[idx] + writer.frame_lengths[idx]] == frame
+        decoded = codec.decode(get_frame(ds.PixelData, idx, number_of_frames=len(images), extended_offsets=extended_offsets), SIZE)
+        assert np.array_equal(decoded, images[idx])
+
+
+def test_native_frames(tmp_path):
+    codec = get_codec("uncompressed")
+    images = frames(3)
+    filename = str(tmp_path / "instance.dcm")
+    ds = instance(codec, len(images))
+    writer = instance_writer(filename, ds, len(images), False, frame_length=images[0].nbytes)
+    with pytest.raises(Exception, match="Frame length"):
+        writer.write_frame(b"\0")
+    for img in images:
+        writer.write_frame(img.tobytes())
+    writer.close()
+    assert np.array_equal(pydicom.dcmread(filename).pixel_array, np.stack(images))
+
+
+def test_an_interrupted_instance_is_never_under_its_final_name(tmp_path):
+    codec = get_codec("jpeg_baseline")
+    encoded = [codec.encode(Image.fromarray(img), 75) for img in frames(4)]
+    filename = str(tmp_path / "instance.dcm")
+    writer = instance_writer(filename, instance(codec, 4), 4, True, on_close=lambda w: pytest.fail("closed"))
+    writer.write_frame(encoded[0])
+    writer.write_frame(encoded[1])
+    # the conversion fails here: only the .partial file is there, until it is aborted
+    assert os.listdir(str(tmp_path)) == ["instance.dcm.partial"]
+    writer.abort()
+    assert os.listdir(str(tmp_path)) == []
+    # closed with frames missing
+    writer = instance_writer(filename, instance(codec, 4), 4, True)
+    writer.write_frame(encoded[0])
+    with pytest.raises(Exception, match="1 frames written, 4 expected"):
+        writer.close()
+    assert os.listdir(str(tmp_path)) == []
+    # more frames than planned
+    writer = instance_writer(filename, instance(codec, 1), 1, True)
+    writer.write_frame(encoded[0])
+    with pytest.raises(Exception, match="More frames"):
+        writer.write_frame(encoded[1])
+    writer.abort()
+    assert os.listdir(str(tmp_path)) == []
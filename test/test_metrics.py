@@ -0,0 +1,52 @@
+import json
+import threading
+from metrics import conversion_metrics, add_time
+
+
+def test_add_time():
+    times = {}
+    add_time(times, "encode", 0.5)
+    add_time(times, "encode", 0.25, count=2)
+    assert times == {"encode": [0.75, 3]}
+
+
+def test_updates_from_several_threads_are_not_lost():
+    metrics = conversion_metrics("slide.svs", interval=0)
+    snapshots = []
+    metrics.add_observer(lambda event, snapshot: snapshots.append(event))
+
+    def work(thread_idx):
+        for idx in range(2000):
+            with metrics.timer("stage_%d" % (idx % 7)):
+                pass
+            metrics.set_queue_depth("queue_%d_%d" % (thread_idx, idx % 5), idx)
+            metrics.frames_written(1, 10)
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        metrics.snapshot()
+    for thread in threads:
+        thread.join()
+    snapshot = metrics.snapshot()
+    assert snapshot["frames_done"] == 8000 and snapshot["bytes_written"] == 80000
+    assert sum(entry["count"] for entry in snapshot["stages"].values()) == 8000
+    assert len(snapshot["queue_depth"]) == 20
+    assert len(snapshots) == 8000
+
+
+def test_conversion_metrics_files(slide_fn, convert, tmp_path):
+    jsonl_fn, prometheus_fn = str(tmp_path / "metrics.jsonl"), str(tmp_path / "metrics.prom")
+    converter = convert(slide_fn, tmp_path / "out", patch_size=(256, 256), max_frame=8, workers=2,
+                        metrics_jsonl=jsonl_fn, metrics_prometheus=prometheus_fn)
+    events = [json.loads(line) for line in open(jsonl_fn)]
+    assert events[0]["event"] == "start" and events[-1]["event"] == "done"
+    assert [e["instance"] for e in events if e["event"] == "instance_done"] == list(range(len(converter.frame_items_info_list)))
+    frames = sum(len(info.locations) for info in converter.frame_items_info_list)
+    assert events[-1]["frames_done"] == events[-1]["frames_total"] == frames
+    assert {"encode", "write", "functional_groups"} <= set(events[-1]["stages"])
+    assert events[-1]["schedule"]["workers"] == 2
+    prometheus = open(prometheus_fn).read().splitlines()
+    assert "# TYPE wsi_dicom_frames_written_total counter" in prometheus
+    assert any(line.startswith('wsi_dicom_frames_written_total{slide="%s"} %d' % (slide_fn, frames)) for line in prometheus)
+    assert any(line.startswith("wsi_dicom_stage_seconds_total{") and 'stage="encode"' in line for line in prometheus)
@@ -0,0 +1,18 @@
+import filecmp
+import os
+import pytest
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(JPEG_COMPRESS=False), dict(codec="jpeg2000_lossless")])
+def test_parallel_output_is_the_same_as_serial(slide_fn, convert, tmp_path, kwargs):
+    kwargs = dict(patch_size=(256, 256), max_frame=8, frames_per_task=3, **kwargs)
+    serial = convert(slide_fn, tmp_path / "serial", workers=0, **kwargs)
+    assert serial.pool is None and serial.workers == 0
+    convert(slide_fn, tmp_path / "process", workers=2, worker_type="process", **kwargs)
+    convert(slide_fn, tmp_path / "thread", workers=3, worker_type="thread", **kwargs)
+    names = sorted(os.listdir(str(tmp_path / "serial")))
+    assert len([fn for fn in names if fn.endswith(".dcm")]) == len(serial.frame_items_info_list) > 1
+    for mode in ("process", "thread"):
+        assert sorted(os.listdir(str(tmp_path / mode))) == names
+        match, mismatch, errors = filecmp.cmpfiles(str(tmp_path / "serial"), str(tmp_path / mode), names, shallow=False)
+        assert not mismatch and not errors, mode
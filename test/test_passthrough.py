@@ -0,0 +1,100 @@
+import contextlib
+import glob
+import io
+import os
+import numpy as np
+import openslide
+import pydicom
+import pytest
+import tifffile
+from PIL import Image
+from pydicom.encaps import generate_frames
+import WSI_DICOM_Converter
+from WSI_DICOM_Converter import jpeg_tile_source, ADOBE_RGB_SEGMENT, RGB_JPEG
+from WSI_DICOM_Verify import verify_slide, psnr
+
+KWARGS = dict(JPEG_PASSTHROUGH=True, patch_size=(256, 256), max_frame=8)
+
+
+# [(dataset, [frame, ...]), ...] of the instances of a conversion
+def instances(dicom_dir):
+    result = []
+    for fn in sorted(glob.glob(os.path.join(str(dicom_dir), "*.dcm"))):
+        ds = pydicom.dcmread(fn)
+        frames = generate_frames(ds.PixelData, number_of_frames=int(ds.NumberOfFrames))
+        # odd length frames are padded with one byte after EOI in their item
+        result.append((ds, [frame[:-1] if frame.endswith(b"\xff\xd9\x00") else frame for frame in frames]))
+    return result
+
+
+def source_tiles(wsi_fn, converter):
+    tile_source = jpeg_tile_source(wsi_fn, openslide.open_slide(wsi_fn))
+    return [[tile_source.get_tile(location, info.img_level, info.patch_size) for location in info.locations]
+            for info in converter.frame_items_info_list]
+
+
+# 768x512 slide of 32 pixel color blocks, in tiled JPEG of YCbCr or RGB components
+def blocks_slide(wsi_fn, photometric):
+    img = np.kron(np.random.default_rng(0).integers(60, 220, (16, 24, 3)), np.ones((32, 32, 1))).astype(np.uint8)
+    if photometric == "ycbcr":
+        tifffile.imwrite(wsi_fn, img, tile=(256, 256), photometric="ycbcr", compression="jpeg", subsampling=(2, 1))
+    else:
+        tifffile.imwrite(wsi_fn, img, tile=(256, 256), photometric="rgb", compression="jpeg",
+                         compressionargs={"outcolorspace": "RGB", "level": 95})
+    assert tifffile.TiffFile(wsi_fn).pages[0].photometric == (6 if photometric == "ycbcr" else 2)
+    return wsi_fn
+
+
+def verify(wsi_fn, dicom_dir, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return verify_slide(wsi_fn, str(dicom_dir), p=WSI_DICOM_Converter.parameters(**KWARGS, **kwargs), sample_rate=1, workers=1)
+
+
+@pytest.mark.skipif(not RGB_JPEG, reason="Pillow can't save RGB JPEG, RGB levels aren't passed through")
+def test_rgb_tiles_are_copied_into_the_frames(convert, tmp_path):
+    wsi_fn = blocks_slide(str(tmp_path / "rgb.tiff"), "rgb")
+    converter = convert(wsi_fn, tmp_path / "dcm", **KWARGS)
+    for (ds, frames), instance_tiles in zip(instances(tmp_path / "dcm"), source_tiles(wsi_fn, converter)):
+        assert ds.PhotometricInterpretation == "RGB"
+        assert frames == instance_tiles
+        assert all(frame.count(ADOBE_RGB_SEGMENT[:11]) == 1 for frame in frames)
+    assert verify(wsi_fn, tmp_path / "dcm")["status"] == "passed"
+
+
+def test_ycbcr_tiles_are_copied_into_the_frames(tmp_path, convert):
+    wsi_fn = blocks_slide(str(tmp_path / "ycbcr.tiff"), "ycbcr")
+    converter = convert(wsi_fn, tmp_path / "dcm", **KWARGS)
+    for (ds, frames), instance_tiles in zip(instances(tmp_path / "dcm"), source_tiles(wsi_fn, converter)):
+        assert ds.PhotometricInterpretation == "YBR_FULL_422"
+        assert frames == instance_tiles
+    assert verify(wsi_fn, tmp_path / "dcm")["status"] == "passed"
+
+
+@pytest.mark.skipif(not RGB_JPEG, reason="Pillow can't save RGB JPEG, RGB levels aren't passed through")
+def test_frames_not_passed_through_are_encoded_as_rgb(convert, tmp_path, monkeypatch):
+    wsi_fn = blocks_slide(str(tmp_path / "rgb.tiff"), "rgb")
+    get_tile = jpeg_tile_source.get_tile
+
+    # every other tile is missing, as tiles with a byte count of 0 or not baseline
+    def some_tiles(tile_source, location, img_level, patch_size):
+        if (location[0] + location[1]) // int(patch_size[0] * tile_source.wsi_obj.level_downsamples[img_level]) % 2:
+            return None
+        return get_tile(tile_source, location, img_level, patch_size)
+    monkeypatch.setattr(jpeg_tile_source, "get_tile", some_tiles)
+    converter = convert(wsi_fn, tmp_path / "dcm", Quality=95, **KWARGS)
+    wsi_obj = openslide.open_slide(wsi_fn)
+    copied = encoded = 0
+    for (ds, frames), info, instance_tiles in zip(instances(tmp_path / "dcm"), converter.frame_items_info_list,
+                                                  source_tiles(wsi_fn, converter)):
+        assert ds.PhotometricInterpretation == "RGB"
+        for frame, tile, location in zip(frames, instance_tiles, info.locations):
+            # RGB components, as declared by PhotometricInterpretation, whether copied or encoded
+            assert frame.startswith(b"\xff\xd8" + ADOBE_RGB_SEGMENT)
+            if frame == tile:
+                copied += 1
+                continue
+            encoded += 1
+            source = np.asarray(wsi_obj.read_region(tuple(int(v) for v in location), info.img_level, info.patch_size))[:, :, :3]
+            assert psnr(np.asarray(Image.open(io.BytesIO(frame)).convert("RGB")), source) > 35
+    assert copied and encoded
+    assert verify(wsi_fn, tmp_path / "dcm", Quality=95)["status"] == "passed"
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from WSI_DICOM_Converter import WSIDICOM_Converter, parameters, plan_grid
+
+
+@pytest.mark.parametrize("row_major", [False, True])
+def test_plan_grid(row_major):
+    DimensionIndexValues, locations = plan_grid((5, 3), (512, 256), row_major)
+    assert len(DimensionIndexValues) == len(locations) == 15
+    assert sorted(map(tuple, DimensionIndexValues.tolist())) == [(c, r) for c in range(1, 6) for r in range(1, 4)]
+    assert np.array_equal(locations, (DimensionIndexValues.astype(np.int64) - 1) * [512, 256])
+    # TILED_FULL frames go along the rows first, the others along the columns
+    assert DimensionIndexValues[:3].tolist() == ([[1, 1], [2, 1], [3, 1]] if row_major else [[1, 1], [1, 2], [1, 3]])
+
+
+# 1280x1024 slide with levels of 5x4 and 2x1 patches of 256
+@pytest.mark.parametrize("max_frame", [1, 3, 7, 20, 100])
+@pytest.mark.parametrize("TILED_FULL", [False, True])
+def test_instances_cover_each_level_exactly_once(slide_fn, tmp_path, max_frame, TILED_FULL):
+    converter = WSIDICOM_Converter(slide_fn, str(tmp_path), parameters(patch_size=(256, 256), max_frame=max_frame, TILED_FULL=TILED_FULL))
+    frame_items_info_list = converter.generate_instance_info_list()
+    for img_lv, grid_size in enumerate([(5, 4), (2, 1)]):
+        level_instances = [info for info in frame_items_info_list if info.img_level == img_lv]
+        patches = grid_size[0] * grid_size[1]
+        # every instance is full, but the last one of the level
+        assert [len(info.locations) for info in level_instances] == [max_frame] * (patches // max_frame) + ([patches % max_frame] if patches % max_frame else [])
+        DimensionIndexValues = np.concatenate([info.DimensionIndexValues for info in level_instances])
+        locations = np.concatenate([info.locations for info in level_instances])
+        assert sorted(map(tuple, DimensionIndexValues.tolist())) == [(c, r) for c in range(1, grid_size[0] + 1) for r in range(1, grid_size[1] + 1)]
+        step = int(256 * converter.level_downsamples[img_lv])
+        assert np.array_equal(locations, (DimensionIndexValues.astype(np.int64) - 1) * step)
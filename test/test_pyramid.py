@@ -0,0 +1,95 @@
+import numpy as np
+import openslide
+import pydicom
+import pytest
+from region_reader import region_reader
+from pyramid import pyramid_dimensions, downsample_2x, pyramid_builder
+
+
+def test_pyramid_dimensions():
+    assert pyramid_dimensions((1000, 600), 256) == [(1000, 600), (500, 300), (250, 150)]
+    assert pyramid_dimensions((1001, 3), 256) == [(1001, 3), (501, 2), (251, 1)]
+
+
+def test_downsample_2x_rounds_the_mean():
+    tile = np.array([[[0], [1]], [[1], [1]]], dtype=np.uint8)
+    assert downsample_2x(tile)[0, 0, 0] == 1
+    assert downsample_2x(np.full((4, 6, 3), 255, np.uint8)).shape == (2, 3, 3)
+
+
+def test_builder_streams_every_level():
+    rng = np.random.default_rng(0)
+    patch = (8, 8)
+    image = rng.integers(0, 256, (40, 48, 3), dtype=np.uint8)   # 6 x 5 patches
+    grid_sizes = [(6, 5), (3, 3), (2, 2), (1, 1)]
+    builder = pyramid_builder(grid_sizes, patch)
+    levels = {}
+    for r in range(5):
+        for c in range(6):
+            tile = image[r * 8:(r + 1) * 8, c * 8:(c + 1) * 8]
+            for level, column, row, level_tile in builder.push(c, r, tile):
+                assert (column, row) not in levels.setdefault(level, {})
+                levels[level][(column, row)] = level_tile
+    assert [len(levels[lv]) for lv in (1, 2, 3)] == [9, 4, 1]
+    assert all(not pending for pending in builder.pending)
+    # level 1 is the 2x downsampled image, padded with the background on the last row of tiles
+    level1 = np.full((24, 24, 3), 255, np.uint8)
+    for (column, row), tile in levels[1].items():
+        level1[row * 8:(row + 1) * 8, column * 8:(column + 1) * 8] = tile
+    assert np.array_equal(level1[:20], downsample_2x(image))
+    assert np.all(level1[20:] == 255)
+
+
+def test_generate_pyramid_conversion(slide_fn, convert, tmp_path):
+    converter = convert(slide_fn, tmp_path, patch_size=(256, 256), GENERATE_PYRAMID=True)
+    assert converter.level_dimensions == pyramid_dimensions((1280, 1024), 256)
+    assert sorted({info.img_level for info in converter.frame_items_info_list}) == list(range(len(converter.level_dimensions)))
+
+
+def test_builder_pads_edge_tiles_with_their_edge_pixels():
+    rng = np.random.default_rng(0)
+    patch = (8, 8)
+    image = rng.integers(100, 200, (37, 45, 3), dtype=np.uint8)
+    level_dimensions = pyramid_dimensions((45, 37), 8)   # (45, 37), (23, 19), (12, 10), (6, 5)
+    grid_sizes = [(-(-w // 8), -(-h // 8)) for w, h in level_dimensions]
+    builder = pyramid_builder(grid_sizes, patch, level_dimensions=level_dimensions)
+    padded = np.zeros((40, 48, 3), np.uint8)   # black past the slide, as read from OpenSlide
+    padded[:37, :45] = image
+    levels = {}
+    for r in range(grid_sizes[0][1]):
+        for c in range(grid_sizes[0][0]):
+            for level, column, row, level_tile in builder.push(c, r, padded[r * 8:(r + 1) * 8, c * 8:(c + 1) * 8]):
+                levels.setdefault(level, {})[(column, row)] = level_tile
+    expected = image
+    for level in range(1, len(level_dimensions)):
+        w, h = level_dimensions[level]
+        columns, rows = grid_sizes[level]
+        assembled = np.zeros((rows * 8, columns * 8, 3), np.uint8)
+        for (column, row), tile in levels[level].items():
+            assembled[row * 8:(row + 1) * 8, column * 8:(column + 1) * 8] = tile
+        # each level is the previous one with its odd last column and row replicated, downsampled: no dark border
+        expected = downsample_2x(np.pad(expected, ((0, expected.shape[0] % 2), (0, expected.shape[1] % 2), (0, 0)), mode="edge"))
+        assert np.array_equal(assembled[:h, :w], expected)
+        assert assembled[:h, :w].min() >= 100
+
+
+@pytest.mark.parametrize("image_levels, wsi_level, read_size", [(range(2, 4), 1, (256, 256)), (range(1, 4), 0, (512, 512))])
+def test_pyramid_is_built_from_the_finest_converted_level(slide_fn, convert, tmp_path, monkeypatch, image_levels, wsi_level, read_size):
+    reads = []
+    read = region_reader.read
+
+    def recorded_read(reader, img_level, patch_size, locations, times=None):
+        reads.append((img_level, tuple(patch_size)))
+        return read(reader, img_level, patch_size, locations, times)
+    monkeypatch.setattr(region_reader, "read", recorded_read)
+    converter = convert(slide_fn, tmp_path, patch_size=(256, 256), GENERATE_PYRAMID=True, image_levels=image_levels,
+                        codec="jpeg2000_lossless", TISSUE_DETECTION=False, workers=0)
+    assert sorted({info.img_level for info in converter.frame_items_info_list}) == list(image_levels)
+    assert reads and set(reads) == {(wsi_level, read_size)}
+    if wsi_level == 1:
+        # level 2 of the generated pyramid is WSI level 1, read as it is
+        ds = pydicom.dcmread(converter.instance_filename(0))
+        assert int(ds.TotalPixelMatrixColumns) == 320
+        wsi_obj = openslide.open_slide(slide_fn)
+        expected = np.asarray(wsi_obj.read_region((0, 0), 1, (256, 256)))[:, :, :3]
+        assert np.array_equal(ds.pixel_array[0], expected)
@@ -0,0 +1,55 @@
+import numpy as np
+import openslide
+import pytest
+from WSI_DICOM_Reader import WSIDICOM_Reader
+
+
+def slide_region(slide_fn, location, level, size):
+    return np.asarray(openslide.open_slide(slide_fn).read_region(location, level, size).convert("RGB"))
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(TILED_FULL=True), dict(max_frame=5)])
+def test_read_region_of_a_lossless_conversion(slide_fn, convert, tmp_path, kwargs):
+    convert(slide_fn, tmp_path, patch_size=(256, 256), codec="uncompressed", **kwargs)
+    for use_spatial_index in (True, False):
+        with WSIDICOM_Reader(str(tmp_path), use_spatial_index=use_spatial_index) as reader:
+            assert (reader.spatial_index is not None) == use_spatial_index
+            assert reader.level_dimensions == [(1280, 1024), (320, 256)]
+            # across tiles, and past the right edge of the slide (background)
+            region = reader.read_region((200, 300), 0, (1100, 400))
+            assert np.array_equal(region[:, :1080], slide_region(slide_fn, (200, 300), 0, (1080, 400)))
+            assert np.all(region[:, 1080:] == 255)
+            assert np.array_equal(reader.read_region((400, 0), 1, (200, 256)), slide_region(slide_fn, (400, 0), 1, (200, 256)))
+            assert np.array_equal(reader.read_tile(0, 1, 2), slide_region(slide_fn, (256, 512), 0, (256, 256)))
+
+
+def test_missing_frames_are_background(slide_fn, convert, tmp_path):
+    convert(slide_fn, tmp_path, patch_size=(256, 256), codec="uncompressed", TISSUE_DETECTION=True, image_levels=range(0, 1))
+    with WSIDICOM_Reader(str(tmp_path), background=7) as reader:
+        assert reader.read_frame(0, 4, 0) is None   # glass in the top right corner
+        assert np.all(reader.read_tile(0, 4, 0) == 7)
+        assert reader.read_frame(0, 2, 2) is not None
+
+
+@pytest.mark.parametrize("kwargs", [dict(GENERATE_PYRAMID=True), dict()])
+def test_level_downsamples_with_and_without_spatial_index(slide_fn, convert, tmp_path, kwargs):
+    convert(slide_fn, tmp_path, patch_size=(128, 128), **kwargs)
+    with WSIDICOM_Reader(str(tmp_path)) as indexed, WSIDICOM_Reader(str(tmp_path), use_spatial_index=False) as built:
+        assert indexed.spatial_index is not None and indexed.source_downsamples and not built.source_downsamples
+        assert indexed.level_downsamples == built.level_downsamples
+        assert indexed.level_downsamples[0] == 1.0
+        level = len(indexed.level_dimensions) - 1
+        assert np.array_equal(indexed.read_region((100, 60), level, (50, 40)), built.read_region((100, 60), level, (50, 40)))
+
+
+def test_level_downsamples_without_level_0(slide_fn, convert, tmp_path):
+    convert(slide_fn, tmp_path, patch_size=(128, 128), codec="uncompressed", image_levels=range(1, 2))
+    with WSIDICOM_Reader(str(tmp_path)) as indexed, WSIDICOM_Reader(str(tmp_path), use_spatial_index=False) as built:
+        # the downsamples of the source, locations in pixels of the source level 0 as in OpenSlide
+        assert indexed.source_downsamples
+        assert tuple(indexed.level_downsamples) == openslide.open_slide(slide_fn).level_downsamples[1:] == (4.0,)
+        expected = slide_region(slide_fn, (400, 256), 1, (100, 50))
+        assert np.array_equal(indexed.read_region((400, 256), 0, (100, 50)), expected)
+        # the instances don't tell, locations are in pixels of the largest converted level
+        assert not built.source_downsamples and built.level_downsamples == [1.0]
+        assert np.array_equal(built.read_region((100, 64), 0, (100, 50)), expected)
@@ -0,0 +1,75 @@
+import glob
+import io
+import os
+import numpy as np
+import openslide
+import pydicom
+import pytest
+import tifffile
+from PIL import Image, ImageCms
+from pydicom.encaps import generate_frames
+from region_reader import region_reader, tile_cache, runs
+from WSI_DICOM_Converter import frame_encoder, plan_grid
+
+
+def openslide_frames(wsi_obj, img_level, patch_size, locations):
+    return [np.asarray(wsi_obj.read_region((int(x), int(y)), img_level, patch_size))[:, :, :3] for x, y in locations]
+
+
+@pytest.mark.parametrize("decode_tiles", [True, False])
+@pytest.mark.parametrize("img_level", [0, 1])
+def test_frames_are_read_as_openslide_reads_them(slide_fn, decode_tiles, img_level):
+    wsi_obj = openslide.open_slide(slide_fn)
+    reader = region_reader(wsi_obj, slide_fn if decode_tiles else None)
+    assert (img_level in reader.decoded_levels) == decode_tiles
+    # frames not lined up with the 256 pixels native tiles, across the edges of the level
+    patch_size = (200, 150)
+    ds = int(wsi_obj.level_downsamples[img_level])
+    step = (patch_size[0] * ds, patch_size[1] * ds)
+    grid_size = (-(-wsi_obj.dimensions[0] // step[0]), -(-wsi_obj.dimensions[1] // step[1]))
+    locations = plan_grid(grid_size, step)[1]
+    frames = reader.read(img_level, patch_size, locations)
+    for frame, expected in zip(frames, openslide_frames(wsi_obj, img_level, patch_size, locations)):
+        assert np.array_equal(frame, expected)
+    if decode_tiles and img_level == 0:
+        assert reader.cache.hits > 0   # tiles across the edges of the bands are decoded once
+    reader.close()
+
+
+def test_tile_cache_evicts_the_least_recently_used_tiles():
+    tile = np.zeros((10, 10, 3), dtype=np.uint8)
+    cache = tile_cache(3 * tile.nbytes)
+    for key in range(3):
+        cache.put(key, tile.copy())
+    assert cache.get(0) is not None
+    cache.put(3, tile.copy())
+    assert cache.get(1) is None and cache.get(0) is not None
+    assert cache.nbytes == 3 * tile.nbytes
+    cache.put(4, np.zeros((20, 20, 3), dtype=np.uint8))   # larger than the cache, not kept
+    assert cache.get(4) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert tile_cache(0).get(0) is None
+
+
+def test_runs():
+    assert runs(np.array([True, True, False, True])) == [(0, 2), (3, 4)]
+    assert runs(np.zeros(3, dtype=bool)) == []
+
+
+def test_frames_keep_the_icc_profile_of_the_slide(tmp_path, convert):
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    img = np.full((512, 512, 3), 240, np.uint8)
+    img[100:400, 100:400] = np.random.default_rng(0).integers(80, 200, (300, 300, 3)).astype(np.uint8)
+    wsi_fn = str(tmp_path / "icc.tiff")
+    tifffile.imwrite(wsi_fn, img, tile=(256, 256), photometric="rgb", compression="jpeg",
+                     extratags=[(34675, 7, len(icc), icc, True)])
+    wsi_obj = openslide.open_slide(wsi_fn)
+    if wsi_obj.color_profile is None:
+        pytest.skip("OpenSlide doesn't read ICC profiles of generic TIFF slides")
+    encoder = frame_encoder(wsi_obj, "jpeg_baseline", 75)
+    frames, _ = encoder.encode(0, (256, 256), [(0, 0), (0, 256)])
+    assert all(Image.open(io.BytesIO(frame)).info.get("icc_profile") == icc for frame in frames)
+    convert(wsi_fn, tmp_path / "dcm", patch_size=(256, 256), workers=2)
+    ds = pydicom.dcmread(glob.glob(os.path.join(str(tmp_path / "dcm"), "*.dcm"))[0])
+    frame = next(generate_frames(ds.PixelData, number_of_frames=int(ds.NumberOfFrames)))
+    assert Image.open(io.BytesIO(frame)).info.get("icc_profile") == icc
@@ -0,0 +1,72 @@
+import glob
+import os
+import numpy as np
+import pytest
+from roi import level_regions, region_grid, polygon_grid
+
+
+def patches(converter):
+    return sorted((info.img_level, int(c), int(r)) for info in converter.frame_items_info_list
+                  for c, r in info.DimensionIndexValues)
+
+
+def test_level_regions():
+    box = (0, 0, 10, 10)
+    assert level_regions(None, 0) is None
+    assert level_regions([box], 3) == [box]
+    assert level_regions({1: [box]}, 1) == [box]
+    assert level_regions({1: [box]}, 0) is None
+
+
+def test_region_grid_boxes():
+    grid = region_grid([(250, 100, 310, 120)], (1000, 1000), (100, 100), (10, 10))
+    assert np.array_equal(np.argwhere(grid), [[2, 1], [3, 1]])
+    # partly outside the slide, only the patches it covers
+    grid = region_grid([(-50, 950, 150, 1200)], (1000, 1000), (100, 100), (10, 10))
+    assert np.array_equal(np.argwhere(grid), [[0, 9], [1, 9]])
+    with pytest.raises(Exception, match="Region box"):
+        region_grid([(10, 10, 5, 20)], (1000, 1000), (100, 100), (10, 10))
+
+
+def test_boxes_outside_the_slide_mark_nothing():
+    for box in [(-300, 0, -100, 500), (0, -300, 500, -100), (1200, 0, 1500, 500), (0, 1100, 500, 1300)]:
+        assert not region_grid([box], (1000, 1000), (100, 100), (10, 10)).any(), box
+
+
+def test_polygon_grid():
+    triangle = np.array([(0, 0), (399, 0), (0, 399)], dtype=np.float64)
+    grid = polygon_grid(triangle, (100, 100), (10, 10))
+    assert grid[0, 0] and grid[3, 0] and grid[0, 3]
+    assert not grid[3, 3] and not grid[4, 0]
+    # smaller than a sub-cell, the patch of its vertices is kept
+    tiny = np.array([(555, 555), (556, 555), (555, 556)], dtype=np.float64)
+    assert np.array_equal(np.argwhere(polygon_grid(tiny, (100, 100), (10, 10))), [[5, 5]])
+
+
+def test_region_grid_masks():
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[9, 0] = True   # bottom left corner
+    assert np.array_equal(np.argwhere(region_grid([mask], (1000, 1000), (250, 250), (4, 4))), [[0, 3]])
+    with pytest.raises(Exception, match="2D boolean"):
+        region_grid([np.zeros((2, 2, 2), dtype=bool)], (1000, 1000), (250, 250), (4, 4))
+    with pytest.raises(Exception, match="Unknown region"):
+        region_grid([[(0, 0), (1, 1)]], (1000, 1000), (250, 250), (4, 4))
+
+
+def test_conversion_of_regions(slide_fn, convert, tmp_path):
+    converter = convert(slide_fn, tmp_path, patch_size=(256, 256), image_levels=range(0, 2),
+                        regions={0: [(300, 300, 600, 400)]})
+    level0 = [p for p in patches(converter) if p[0] == 0]
+    assert level0 == [(0, 2, 2), (0, 3, 2)]
+    assert len([p for p in patches(converter) if p[0] == 1]) == 2   # whole level 1, 320 x 256 pixels
+
+
+def test_incremental_conversion_adds_the_new_patches(slide_fn, convert, tmp_path):
+    first, second = (100, 100, 300, 300), [(700, 500), (900, 500), (800, 700)]
+    convert(slide_fn, tmp_path / "inc", patch_size=(256, 256), image_levels=range(0, 1), regions=[first])
+    instances = set(glob.glob(os.path.join(str(tmp_path / "inc"), "*.dcm")))
+    incremental = convert(slide_fn, tmp_path / "inc", patch_size=(256, 256), image_levels=range(0, 1),
+                          regions=[second], incremental=True)
+    assert instances < set(glob.glob(os.path.join(str(tmp_path / "inc"), "*.dcm")))
+    both = convert(slide_fn, tmp_path / "both", patch_size=(256, 256), image_levels=range(0, 1), regions=[first, second])
+    assert patches(incremental) == patches(both)
@@ -0,0 +1,112 @@
+import filecmp
+import os
+import threading
+import pytest
+import WSI_DICOM_Converter
+from frame_codecs import get_codec
+from scheduler import parse_size, pipeline_memory, schedule_pipeline, pipeline_stage
+
+
+def test_parse_size():
+    assert parse_size(1000) == 1000
+    assert parse_size("2GB") == parse_size("2G") == 2 * 10 ** 9
+    assert parse_size("2GiB") == parse_size("2gi") == 2 * 2 ** 30
+    assert parse_size("1.5M") == 1500000
+    with pytest.raises(Exception, match="Can't read memory size"):
+        parse_size("2 gigabytes")
+
+
+def test_schedule_without_limit():
+    memory = pipeline_memory((512, 512), get_codec("jpeg_baseline"), "process")
+    schedule = schedule_pipeline(memory, 8, 16, 256 * 2 ** 20)
+    assert (schedule["workers"], schedule["frames_per_task"], schedule["tasks_in_flight"]) == (8, 16, 16)
+    assert schedule["estimate"]["total"] == sum(v for k, v in schedule["estimate"].items() if k != "total")
+    assert not schedule["adjustments"]
+
+
+def test_schedule_within_a_memory_limit():
+    memory = pipeline_memory((512, 512), get_codec("jpeg_baseline"), "process")
+    unlimited = schedule_pipeline(memory, 8, 16, 256 * 2 ** 20)["estimate"]["total"]
+    for limit in ("2GiB", "1GiB", "400MiB"):
+        schedule = schedule_pipeline(memory, 8, 16, 256 * 2 ** 20, limit)
+        assert schedule["estimate"]["total"] <= parse_size(limit) < unlimited
+        assert schedule["adjustments"] and schedule["workers"] >= 1 and schedule["frames_per_task"] >= 1
+        assert schedule["write_queue_frames"] >= schedule["frames_per_task"]
+    # the read cache goes first, the workers last
+    schedule = schedule_pipeline(memory, 8, 16, 256 * 2 ** 20, "2.5GiB")
+    assert schedule["workers"] == 8 and schedule["read_cache_size"] < 256 * 2 ** 20
+    with pytest.raises(Exception, match="too small"):
+        schedule_pipeline(memory, 8, 16, 256 * 2 ** 20, "50MiB")
+
+
+def test_pipeline_stage_runs_calls_in_order():
+    done = []
+    stage = pipeline_stage("write", 2)
+    for idx in range(10):
+        stage.put(done.append, idx)
+    stage.join()
+    stage.close()
+    assert done == list(range(10))
+
+
+@pytest.mark.parametrize("depth", [0, 3])
+def test_pipeline_stage_drops_the_calls_after_an_error(depth):
+    done, errors = [], []
+    release = threading.Event()
+
+    def call(idx):
+        if idx == 0:
+            release.wait()
+        if idx == 1:
+            raise OSError("disk full")
+        done.append(idx)
+    stage = pipeline_stage("write", depth, on_error=errors.append)
+    if depth:
+        stage.put(call, 0)
+        stage.put(call, 1)
+        stage.put(call, 2)   # queued after the failing call
+        release.set()
+        with pytest.raises(OSError):
+            stage.join()
+        assert stage.dropped == 1
+    else:
+        release.set()
+        stage.put(call, 0)
+        with pytest.raises(OSError):
+            stage.put(call, 1)
+    assert done == [0]
+    assert len(errors) == 1 and isinstance(errors[0], OSError)   # on_error is called as soon as the call fails
+    # cancelled, the stage takes calls again
+    stage.cancel()
+    stage.put(call, 3)
+    stage.join()
+    stage.close()
+    assert done == [0, 3]
+
+
+def test_failed_write_leaves_no_partial_instance(slide_fn, convert, tmp_path, monkeypatch):
+    kwargs = dict(patch_size=(256, 256), max_frame=8, workers=2, memory_limit="1GiB")
+    full = convert(slide_fn, tmp_path / "full", **kwargs)
+    assert full.schedule["estimate"]["total"] <= parse_size("1GiB")
+    names = sorted(fn for fn in os.listdir(str(tmp_path / "full")) if fn.endswith(".dcm"))
+
+    write_frame = WSI_DICOM_Converter.instance_writer.write_frame
+    frames = []
+
+    def failing_write_frame(writer, frame):
+        frames.append(frame)
+        if len(frames) == 12:
+            raise OSError("disk full")
+        return write_frame(writer, frame)
+    monkeypatch.setattr(WSI_DICOM_Converter.instance_writer, "write_frame", failing_write_frame)
+    with pytest.raises(OSError):
+        convert(slide_fn, tmp_path / "failed", **kwargs)
+    monkeypatch.setattr(WSI_DICOM_Converter.instance_writer, "write_frame", write_frame)
+    written = os.listdir(str(tmp_path / "failed"))
+    assert not [fn for fn in written if fn.endswith(".partial")]
+    assert [fn for fn in written if fn.endswith(".dcm")] == names[:1]
+    # resumed, as if it never failed
+    convert(slide_fn, tmp_path / "failed", resume=True, **kwargs)
+    match, mismatch, errors = filecmp.cmpfiles(str(tmp_path / "full"), str(tmp_path / "failed"),
+                                               names + ["spatial_index.bin"], shallow=False)
+    assert not mismatch and not errors
@@ -0,0 +1,88 @@
+import contextlib
+import filecmp
+import io
+import os
+import pytest
+from WSI_DICOM_Converter import parameters
+from WSI_DICOM_Shard import split_shards, plan_shards, work_shard, finalize, run_local, SHARD_CHECKPOINT_FILENAME
+from checkpoint import CHECKPOINT_FILENAME
+
+KWARGS = dict(patch_size=(256, 256), max_frame=4)
+
+
+def test_split_shards():
+    assert split_shards([4, 4, 4, 4], 2) == [(0, 2), (2, 4)]
+    assert split_shards([10, 1, 1, 1, 1], 2) == [(0, 1), (1, 5)]
+    assert split_shards([1, 1, 1], 5) == [(0, 1), (1, 2), (2, 3)]   # no more shards than instances
+    assert split_shards([5], 1) == [(0, 1)]
+
+
+def test_plan_work_finalize_is_the_same_as_one_conversion(slide_fn, convert, tmp_path):
+    out = str(tmp_path / "shards")
+    os.makedirs(out)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan = plan_shards(slide_fn, out, parameters(**KWARGS), 3)
+        assert len(plan["shards"]) == 3 and plan["shards"][-1][1] == len(plan["instances"])
+        work_shard(out, 2)
+        work_shard(out, 0, runtime_parameters={"workers": 2})
+        report = finalize(out)
+        # shard 1 isn't done yet, nothing is written
+        assert report["status"] == "failed"
+        assert report["missing"] == list(range(*plan["shards"][1]))
+        assert [status["status"] for status in report["shards"]] == ["done", "incomplete", "done"]
+        assert not os.path.exists(os.path.join(out, "spatial_index.bin"))
+        result = work_shard(out, 1)
+        assert result["instances"] == plan["shards"][1]
+        report = finalize(out)
+    assert report["status"] == "done" and not report["problems"]
+    assert not [fn for fn in os.listdir(out) if fn.startswith(SHARD_CHECKPOINT_FILENAME.split("%")[0])]
+    # same instances, index and checkpoint as a conversion on one machine, UIDs being derived from the slide path
+    single = convert(slide_fn, tmp_path / "single", UID_seed=os.path.abspath(slide_fn), **KWARGS)
+    names = sorted(fn for fn in os.listdir(str(tmp_path / "single")) if fn.endswith(".dcm"))
+    assert [instance["filename"] for instance in plan["instances"]] == names
+    assert report["frames"] == sum(len(info.locations) for info in single.frame_items_info_list)
+    match, mismatch, errors = filecmp.cmpfiles(str(tmp_path / "single"), out, names + ["spatial_index.bin"], shallow=False)
+    assert not mismatch and not errors
+    assert os.path.exists(os.path.join(out, CHECKPOINT_FILENAME))
+
+
+def test_work_shard_checks_its_arguments(slide_fn, tmp_path):
+    out = str(tmp_path)
+    with pytest.raises(Exception, match="No shard plan"):
+        work_shard(out, 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan_shards(slide_fn, out, parameters(**KWARGS), 2)
+    with pytest.raises(Exception, match="Shard should be"):
+        work_shard(out, 2)
+    with pytest.raises(Exception, match="changes the output"):
+        work_shard(out, 0, runtime_parameters={"Quality": 50})
+    with pytest.raises(Exception, match="GENERATE_PYRAMID"):
+        plan_shards(slide_fn, out, parameters(GENERATE_PYRAMID=True, **KWARGS), 2)
+
+
+def test_finalize_finds_truncated_instances(slide_fn, tmp_path):
+    out = str(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan = plan_shards(slide_fn, out, parameters(**KWARGS), 1)
+        work_shard(out, 0)
+        truncated = os.path.join(out, plan["instances"][1]["filename"])
+        with open(truncated, "r+b") as fp:
+            fp.truncate(os.path.getsize(truncated) - 10)
+        report = finalize(out)
+        assert report["status"] == "failed" and report["missing"] == [1]
+        assert not os.path.exists(os.path.join(out, "spatial_index.bin"))
+        # the shard is run again, only the truncated instance is converted again
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            work_shard(out, 0)
+        assert output.getvalue().count("already converted, skipped") == len(plan["instances"]) - 1
+        assert finalize(out)["status"] == "done"
+
+
+def test_run_local(slide_fn, tmp_path):
+    report_fn = str(tmp_path / "report.json")
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = run_local(slide_fn, str(tmp_path / "out"), parameters(**KWARGS), 2, report_fn=report_fn)
+    assert report["status"] == "done"
+    assert len(report["shards"]) == 2 and all(status["status"] == "done" for status in report["shards"])
+    assert os.path.exists(report_fn)
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pytest
+from spatial_index import SPATIAL_INDEX_FILENAME, ALIGNMENT, BLANK, empty_grid, write_spatial_index, spatial_index
+
+
+def test_write_and_load(tmp_path):
+    (tmp_path / "a.dcm").write_bytes(b"a" * 100)
+    grids = [empty_grid((5, 3)), empty_grid((2, 1))]
+    grids[0][1, 4] = (0, 1, 1000, 200, 0)
+    grids[1][0, 0] = (0, 2, 1200, 50, 0)
+    fn = str(tmp_path / SPATIAL_INDEX_FILENAME)
+    write_spatial_index(fn, "1.2.840.10008.1.2.4.50", [("a.dcm", 100)],
+                        [dict(img_level=0, dimensions=(1200, 700), tile_size=(256, 256), downsample=1.0, grid=grids[0]),
+                         dict(img_level=2, dimensions=(300, 175), tile_size=(256, 256), downsample=4.0, grid=grids[1])])
+    with spatial_index(fn) as index:
+        assert index.TransferSyntaxUID == "1.2.840.10008.1.2.4.50"
+        assert [level["grid_size"] for level in index.levels] == [[5, 3], [2, 1]]
+        assert all(level["offset"] % ALIGNMENT == 0 for level in index.levels)
+        assert np.array_equal(index.grids[0], grids[0]) and np.array_equal(index.grids[1], grids[1])
+        assert index.tile(0, 4, 1)["offset"] == 1000
+        assert index.tile(0, 0, 0)["flags"] == BLANK
+        assert index.is_current()
+    (tmp_path / "a.dcm").write_bytes(b"a" * 101)
+    with spatial_index(fn) as index:
+        assert not index.is_current()
+
+
+def test_not_an_index(tmp_path):
+    (tmp_path / "x.bin").write_bytes(b"not an index at all")
+    with pytest.raises(Exception, match="not a spatial index"):
+        spatial_index(str(tmp_path / "x.bin"))
+
+
+def test_index_of_a_conversion(slide_fn, convert, tmp_path):
+    converter = convert(slide_fn, tmp_path, patch_size=(256, 256), max_frame=6, TISSUE_DETECTION=True)
+    with spatial_index(str(tmp_path / SPATIAL_INDEX_FILENAME)) as index:
+        assert index.is_current()
+        # the frames of each instance, in the order of the frame plan
+        for (img_level, DimensionIndexValues), info in zip(index.instance_frames(), converter.frame_items_info_list):
+            assert img_level == info.img_level
+            assert np.array_equal(DimensionIndexValues, np.asarray(info.DimensionIndexValues))
+        # byte ranges of the frames are the JPEG frames of the instances
+        for level, grid in zip(index.levels, index.grids):
+            for record in grid[grid["instance"] >= 0]:
+                with open(os.path.join(str(tmp_path), index.instances[record["instance"]]["filename"]), "rb") as fp:
+                    fp.seek(int(record["offset"]))
+                    frame = fp.read(int(record["length"]))
+                assert frame[:2] == b"\xff\xd8" and frame[-2:] == b"\xff\xd9"
+        assert int((index.grids[0]["flags"] == BLANK).sum()) > 0   # glass skipped by tissue detection
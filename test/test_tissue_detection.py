@@ -0,0 +1,43 @@
+import glob
+import os
+import numpy as np
+import openslide
+import pydicom
+from tissue_detection import detect_tissue, tissue_grid, dilate, erode
+
+
+def test_detect_tissue_finds_the_tissue_not_the_glass(slide_fn):
+    mask = detect_tissue(openslide.open_slide(slide_fn), mask_size=256)
+    h, w = mask.shape
+    assert mask[h // 2, int(w * 0.45)]
+    assert not mask[0, 0] and not mask[-1, -1] and not mask[h // 2, -1]
+
+
+def test_closing_fills_holes_and_opening_removes_dust():
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[10:30, 10:30] = True
+    mask[20, 20] = False   # hole
+    mask[2, 35] = True   # dust
+    closed = erode(dilate(mask, 2), 2)
+    assert closed[20, 20]
+    opened = dilate(erode(closed, 2), 2)
+    assert not opened[2, 35] and opened[15, 15]
+
+
+def test_tissue_grid():
+    mask = np.zeros((100, 100), dtype=bool)
+    mask[0:10, 60:70] = True   # top of the 4th column of patches
+    grid = tissue_grid(mask, (1000, 1000), (250, 250), (4, 4))
+    assert grid.shape == (4, 4)
+    assert np.array_equal(np.argwhere(grid), [[2, 0]])
+
+
+def test_tissue_detection_skips_glass_patches(slide_fn, convert, tmp_path):
+    full = convert(slide_fn, tmp_path / "full", patch_size=(256, 256), image_levels=range(0, 1))
+    sparse = convert(slide_fn, tmp_path / "sparse", patch_size=(256, 256), image_levels=range(0, 1), TISSUE_DETECTION=True)
+    full_frames = sum(len(info.locations) for info in full.frame_items_info_list)
+    sparse_frames = sum(len(info.locations) for info in sparse.frame_items_info_list)
+    assert 0 < sparse_frames < full_frames
+    ds = pydicom.dcmread(glob.glob(os.path.join(str(tmp_path / "sparse"), "*.dcm"))[0], stop_before_pixels=True)
+    assert ds.DimensionOrganizationType == "TILED_SPARSE"
+    assert int(ds.NumberOfFrames) == sparse_frames
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pytest
+from WSI_DICOM_Upload import stow_uploader, make_uploader
+
+
+class stow_server:
+    '''
+    Stand-in STOW-RS server on localhost. respond(digest, attempt) gives the HTTP status of each request, attempt
+    counting from 1 for each instance (by the digest of its content), or None to drop the connection
+    '''
+    def __init__(self, respond=lambda digest, attempt: 200):
+        self.respond = respond
+        self.attempts = {}
+        self.stored = {}   # digest -> instance bytes
+        self.connections = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                assert self.path == "/dicom-web/studies"
+                boundary = self.headers["Content-Type"].split("boundary=")[1].encode()
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                data = body.split(b"\r\n\r\n", 1)[1][:-len(b"\r\n--%s--\r\n" % boundary)]
+                digest = hashlib.sha1(data).hexdigest()
+                with server.lock:
+                    attempt = server.attempts[digest] = server.attempts.get(digest, 0) + 1
+                status = server.respond(digest, attempt)
+                if status is None:
+                    self.close_connection = True
+                    return   # no response
+                if status == 200:
+                    with server.lock:
+                        server.stored[digest] = data
+                response = b"{}" if status == 200 else b"busy"
+                self.send_response(status)
+                self.send_header("Content-Type", "application/dicom+json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:%d/dicom-web" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def instances(tmp_path):
+    filenames = []
+    for idx in range(6):
+        fn = tmp_path / ("instance_%d.dcm" % idx)
+        fn.write_bytes(np.random.default_rng(idx).bytes(1000 + 300000 * idx))   # up to a few chunks
+        filenames.append(str(fn))
+    return filenames
+
+
+def digest(fn):
+    return hashlib.sha1(open(fn, "rb").read()).hexdigest()
+
+
+def upload(server, filenames, **kwargs):
+    with stow_uploader(server.url, retry_delay=0.01, **kwargs) as uploader:
+        for fn in filenames:
+            uploader.submit(fn)
+    return uploader
+
+
+def test_upload_over_keep_alive_connections(instances):
+    server = stow_server()
+    try:
+        uploader = upload(server, instances, max_connections=2, max_pending=2)
+    finally:
+        server.close()
+    report = uploader.report()
+    assert report["instances"] == 6 and report["failed"] == 0
+    assert report["bytes"] == sum(os.path.getsize(fn) for fn in instances)
+    assert {digest(fn): open(fn, "rb").read() for fn in instances} == server.stored
+    assert server.connections <= 2
+
+
+def test_503_and_dropped_connections_are_retried(instances):
+    # busy for the first attempt of every instance, connection dropped for the second attempt of some
+    server = stow_server(lambda digest, attempt: 503 if attempt == 1 else None if attempt == 2 and digest < "8" else 200)
+    try:
+        uploader = upload(server, instances, retries=3)
+    finally:
+        server.close()
+    assert uploader.report()["failed"] == 0
+    assert len(server.stored) == 6
+    assert sorted(r["attempts"] for r in uploader.results) == sorted(3 if digest(fn) < "8" else 2 for fn in instances)
+
+
+def test_partial_failures(instances):
+    rejected, busy = digest(instances[1]), digest(instances[2])
+    server = stow_server(lambda digest, attempt: 400 if digest == rejected else 503 if digest == busy else 200)
+    try:
+        uploader = upload(server, instances, retries=2, delete=True)
+    finally:
+        server.close()
+    report = uploader.report()
+    assert report["failed"] == 2
+    assert sorted(fn for fn, error in report["errors"]) == sorted(instances[1:3])
+    attempts = {r["filename"]: r["attempts"] for r in uploader.results}
+    assert attempts[instances[1]] == 1   # 400 isn't retried
+    assert attempts[instances[2]] == 3   # 503 is, up to retries times
+    assert server.attempts[busy] == 3
+    # uploaded instances are deleted, failed ones are kept
+    assert [os.path.exists(fn) for fn in instances] == [False, True, True, False, False, False]
+
+
+def test_upload_while_converting(slide_fn, tmp_path):
+    from WSI_DICOM_Converter import WSIDICOM_Converter, parameters
+    server = stow_server(lambda digest, attempt: 503 if attempt == 1 else 200)
+    try:
+        converter = WSIDICOM_Converter(slide_fn, str(tmp_path), parameters(patch_size=(256, 256), max_frame=8))
+        with make_uploader(server.url) as uploader:
+            uploader.retry_delay = 0.01
+            converter.add_sink(uploader.submit)
+            converter.convert()
+    finally:
+        server.close()
+    written = sorted(fn for fn in os.listdir(str(tmp_path)) if fn.endswith(".dcm"))
+    assert len(written) == len(converter.frame_items_info_list)
+    assert sorted(digest(os.path.join(str(tmp_path), fn)) for fn in written) == sorted(server.stored)
+    assert uploader.report()["failed"] == 0
@@ -0,0 +1,114 @@
+import contextlib
+import io
+import os
+import numpy as np
+import pytest
+import tifffile
+from checkpoint import CHECKPOINT_FILENAME, recorded_parameters
+from WSI_DICOM_Converter import parameters
+from WSI_DICOM_Verify import verify_slide, sample_frames, frame_extent
+
+
+def verify(wsi_fn, dicom_dir, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return verify_slide(wsi_fn, str(dicom_dir), **kwargs)
+
+
+def test_sample_frames():
+    samples = sample_frames([10, 0, 30], 0.5)
+    assert sum(len(s) for s in samples) == 20 and len(samples[1]) == 0
+    assert all(0 <= idx < count for s, count in zip(samples, [10, 0, 30]) for idx in s)
+    assert [s.tolist() for s in samples] == [s.tolist() for s in sample_frames([10, 0, 30], 0.5)]   # same seed, same frames
+    assert sum(len(s) for s in sample_frames([10, 0, 30], 0.5, max_samples=5)) == 5
+    assert [s.tolist() for s in sample_frames([3, 2], 1)] == [[0, 1, 2], [0, 1]]
+
+
+def test_frame_extent():
+    assert frame_extent((0, 0), 1, (256, 256), (1000, 600)) == (256, 256)
+    assert frame_extent((768, 512), 1, (256, 256), (1000, 600)) == (232, 88)
+    assert frame_extent((3072, 2048), 4, (256, 256), (1000, 600)) == (232, 88)
+
+
+def test_lossless_conversion_passes(slide_fn, convert, tmp_path):
+    kwargs = dict(codec="jpeg2000_lossless", patch_size=(256, 256), max_frame=8)
+    convert(slide_fn, tmp_path, **kwargs)
+    report = verify(slide_fn, tmp_path, p=parameters(**kwargs), sample_rate=0.5, workers=1)
+    assert report["status"] == "passed"
+    assert report["sampled"] == report["identical"] > 0
+
+
+def test_padding_past_the_slide_is_not_compared(tmp_path, convert):
+    # JPEG tiles of the slide padded with white past its edges, as scanners do, copied into the frames
+    img = np.full((600, 700, 3), 235, np.uint8)
+    img[100:500, 100:600] = np.random.default_rng(0).integers(120, 160, (400, 500, 3)).astype(np.uint8)
+
+    def tiles():
+        for r in range(0, img.shape[0], 256):
+            for c in range(0, img.shape[1], 256):
+                tile = np.full((256, 256, 3), 255, np.uint8)
+                part = img[r:r + 256, c:c + 256]
+                tile[:part.shape[0], :part.shape[1]] = part
+                yield tile
+    wsi_fn = str(tmp_path / "padded.tiff")
+    tifffile.imwrite(wsi_fn, tiles(), shape=img.shape, dtype=np.uint8, tile=(256, 256), photometric="rgb",
+                     compression="jpeg", compressionargs={"level": 95})
+    kwargs = dict(JPEG_PASSTHROUGH=True, patch_size=(256, 256))
+    convert(wsi_fn, tmp_path / "dcm", **kwargs)
+    report = verify(wsi_fn, tmp_path / "dcm", p=parameters(**kwargs), sample_rate=1, workers=1)
+    assert report["status"] == "passed", report["instances"][0]["problems"]
+    assert report["sampled"] == report["frames"] == 9
+
+
+def test_corrupted_and_missing_instances_fail(slide_fn, convert, tmp_path):
+    kwargs = dict(JPEG_COMPRESS=False, patch_size=(256, 256), max_frame=10, image_levels=range(0, 1))
+    converter = convert(slide_fn, tmp_path, **kwargs)
+    assert len(converter.frame_items_info_list) == 2
+    # pixels in the middle of the first instance, uncompressed frames fill the level without padding
+    first = converter.instance_filename(0)
+    with open(first, "r+b") as fp:
+        fp.seek(os.path.getsize(first) // 2)
+        fp.write(b"\x00" * 64)
+    os.remove(converter.instance_filename(1))
+    report = verify(slide_fn, tmp_path, p=parameters(**kwargs), sample_rate=1, workers=1)
+    assert report["status"] == "failed"
+    first_report, second_report = report["instances"]
+    assert first_report["failed"] == 1 and "differ from the source" in first_report["problems"][0]
+    assert second_report["problems"] == ["missing"]
+
+
+def test_lossy_frames_are_checked_against_the_thresholds(slide_fn, convert, tmp_path):
+    kwargs = dict(patch_size=(256, 256), max_frame=8, Quality=95)
+    convert(slide_fn, tmp_path, **kwargs)
+    report = verify(slide_fn, tmp_path, p=parameters(**kwargs), sample_rate=1, workers=2)
+    assert report["status"] == "passed" and report["lossy"]
+    assert report["sampled"] == report["frames"] and report["min_psnr"] > 30
+    report = verify(slide_fn, tmp_path, p=parameters(**kwargs), sample_rate=1, workers=1, psnr_threshold=60)
+    assert report["status"] == "failed"
+    assert 0 < sum(r.get("failed", 0) for r in report["instances"]) <= report["sampled"] - report["identical"]
+
+
+@pytest.mark.parametrize("kwargs", [dict(codec="jpeg2000_lossless", max_frame=7, image_levels=range(1, 2)),
+                                    dict(JPEG_COMPRESS=False, TISSUE_DETECTION=True, patch_size=(128, 128), max_frame=5)])
+def test_parameters_are_read_from_the_checkpoint(slide_fn, convert, tmp_path, kwargs):
+    converter = convert(slide_fn, tmp_path, **dict(dict(patch_size=(256, 256)), **kwargs))
+    report = verify(slide_fn, tmp_path, sample_rate=1, workers=1)
+    assert report["status"] == "passed", report["problems"]
+    assert report["codec"] == converter.codec
+    assert len(report["instances"]) == len(converter.frame_items_info_list)
+    assert report["frames"] == sum(len(info.locations) for info in converter.frame_items_info_list)
+
+
+def test_parameters_of_a_resumed_conversion(slide_fn, convert, tmp_path):
+    kwargs = dict(codec="jpeg2000_lossless", patch_size=(256, 256), max_frame=8)
+    convert(slide_fn, tmp_path, image_levels=range(0, 1), **kwargs)
+    converter = convert(slide_fn, tmp_path, image_levels=range(0, 2), resume=True, **kwargs)
+    assert recorded_parameters(str(tmp_path))["image_levels"] == range(0, 2)
+    report = verify(slide_fn, tmp_path, sample_rate=0.5, workers=1)
+    assert report["status"] == "passed" and len(report["instances"]) == len(converter.frame_items_info_list) == 4
+
+
+def test_no_parameters_to_verify_with(slide_fn, convert, tmp_path):
+    convert(slide_fn, tmp_path, patch_size=(256, 256), codec="jpeg2000_lossless")
+    os.remove(str(tmp_path / CHECKPOINT_FILENAME))
+    with pytest.raises(Exception, match="No parameters recorded"):
+        verify(slide_fn, tmp_path)
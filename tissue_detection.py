@@ -0,0 +1,66 @@
+import numpy as np
+'''
+Find tissue on a low resolution image of the WSI, so the patches falling on empty glass can be skipped.
+Everything is vectorized with NumPy, the slide is only read once (as a thumbnail).
+'''
+
+
+# sum of mask values in a (2 * radius + 1) square window around each pixel
+def box_sum(mask, radius):
+    k = 2 * radius + 1
+    padded = np.pad(mask.astype(np.int32), radius)
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.int32)
+    integral[1:, 1:] = padded.cumsum(0).cumsum(1)
+    return integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k]
+
+
+def dilate(mask, radius):
+    return box_sum(mask, radius) > 0
+
+
+def erode(mask, radius):
+    return box_sum(mask, radius) == (2 * radius + 1) ** 2
+
+
+def detect_tissue(wsi_obj, threshold=20, mask_size=1024, radius=2):
+    '''
+    create a tissue mask from the thumbnail of a WSI
+    :param wsi_obj: openslide object
+    :param threshold: minimum color saturation (max - min of RGB channels) of tissue pixels, glass is gray/white
+    :param mask_size: maximum width/height of the mask
+    :param radius: radius (in mask pixels) of the morphological closing, opening and the final safety margin
+    :return: boolean mask, True for tissue
+    '''
+    rgb = np.asarray(wsi_obj.get_thumbnail((mask_size, mask_size)).convert("RGB")).astype(np.int16)
+    saturation = rgb.max(axis=2) - rgb.min(axis=2)
+    brightness = rgb.mean(axis=2)
+    # transparent/padded regions are black, they are not tissue either
+    mask = (saturation >= threshold) & (brightness > 10)
+    mask = erode(dilate(mask, radius), radius)   # closing: fill small holes within tissue
+    mask = dilate(erode(mask, radius), radius)   # opening: remove dust and noise
+    return dilate(mask, radius)   # margin, so tiles on the tissue border are kept
+
+
+def tissue_grid(mask, dimensions, step, grid_size):
+    '''
+    whether each patch of a grid covers any tissue
+    :param mask: tissue mask from detect_tissue
+    :param dimensions: (width, height) of the WSI at level 0
+    :param step: (x, y) step between patches, in level 0 pixels
+    :param grid_size: (columns, rows) of the patch grid
+    :return: boolean array of shape (columns, rows)
+    '''
+    mask_h, mask_w = mask.shape
+    integral = np.zeros((mask_h + 1, mask_w + 1), dtype=np.int64)
+    integral[1:, 1:] = mask.cumsum(0).cumsum(1)
+    scale_x = mask_w / dimensions[0]
+    scale_y = mask_h / dimensions[1]
+    w = np.arange(grid_size[0]) * step[0]
+    h = np.arange(grid_size[1]) * step[1]
+    x0 = np.clip(np.floor(w * scale_x).astype(np.int64), 0, mask_w)
+    x1 = np.clip(np.ceil((w + step[0]) * scale_x).astype(np.int64), 0, mask_w)
+    y0 = np.clip(np.floor(h * scale_y).astype(np.int64), 0, mask_h)
+    y1 = np.clip(np.ceil((h + step[1]) * scale_y).astype(np.int64), 0, mask_h)
+    tissue = integral[y1[None, :], x1[:, None]] - integral[y0[None, :], x1[:, None]] \
+        - integral[y1[None, :], x0[:, None]] + integral[y0[None, :], x0[:, None]]
+    return tissue > 0